@@ -0,0 +1,172 @@
+import numpy as np
+
+DEFAULT_NLIST = 1024     # 粗い量子化 (IVF) のクラスタ数
+DEFAULT_M = 16           # 直積量子化 (PQ) のサブ空間数
+DEFAULT_NPROBE = 16      # 検索時に調べるクラスタ数 (精度と速度のつまみ)
+PQ_CODEBOOK_SIZE = 256   # サブ空間あたりのコード数 (uint8)
+
+
+def _sq_distances(x, centroids, c_sq=None):
+    """x の各行と各セントロイドの二乗距離 (|c|² - 2x·c、x 側の定数項は省略)。"""
+    if c_sq is None:
+        c_sq = np.einsum("ij,ij->i", centroids, centroids)
+    return c_sq[None, :] - 2.0 * (x @ centroids.T)
+
+
+def kmeans(x, k, iters=20, seed=0, block_rows=65536):
+    """NumPy だけで書いた素朴な Lloyd 法の k-means。"""
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = assign_clusters(x, centroids, block_rows)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=k).astype(np.float32)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # 空のクラスタはランダムな点で置き直す
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+
+def assign_clusters(x, centroids, block_rows=65536):
+    c_sq = np.einsum("ij,ij->i", centroids, centroids)
+    out = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), block_rows):
+        block = np.asarray(x[start:start + block_rows], dtype=np.float32)
+        out[start:start + len(block)] = np.argmin(_sq_distances(block, centroids, c_sq), axis=1)
+    return out
+
+
+class IVFPQIndex:
+    """
+    IVF (転置ファイル) + PQ (直積量子化) による近似最近傍インデックス。
+    ベクトルは L2 正規化済みを前提とし、L2 距離の順位がコサイン類似度の順位と一致します。
+    nprobe を増やすほど再現率が上がり、検索は遅くなります。
+    """
+
+    def __init__(self, dim, nlist=DEFAULT_NLIST, m=DEFAULT_M):
+        if dim % m != 0:
+            raise ValueError(f"次元数 {dim} はサブ空間数 {m} で割り切れる必要があります。")
+        self.dim = dim
+        self.nlist = nlist
+        self.m = m
+        self.dsub = dim // m
+        self.coarse = None
+        self.codebooks = None
+        self.list_ids = [np.empty(0, dtype=np.int64) for _ in range(nlist)]
+        self.list_codes = [np.empty((0, m), dtype=np.uint8) for _ in range(nlist)]
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.list_ids)
+
+    def train(self, x, iters=20, seed=0):
+        """粗いセントロイドと、残差の PQ コードブックを学習します。"""
+        x = np.asarray(x, dtype=np.float32)
+        self.coarse = kmeans(x, self.nlist, iters, seed)
+        self.nlist = len(self.coarse)
+        self.list_ids = self.list_ids[:self.nlist]
+        self.list_codes = self.list_codes[:self.nlist]
+        residual = x - self.coarse[assign_clusters(x, self.coarse)]
+        self.codebooks = np.stack([
+            kmeans(residual[:, j * self.dsub:(j + 1) * self.dsub], PQ_CODEBOOK_SIZE, iters, seed + j)
+            for j in range(self.m)
+        ])
+        return self
+
+    def encode(self, residual):
+        codes = np.empty((len(residual), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            sub = residual[:, j * self.dsub:(j + 1) * self.dsub]
+            codes[:, j] = assign_clusters(sub, self.codebooks[j])
+        return codes
+
+    def add(self, x, ids):
+        """ベクトルを対応するリストに PQ コードとして追加します。"""
+        x = np.asarray(x, dtype=np.float32)
+        ids = np.asarray(ids, dtype=np.int64)
+        assign = assign_clusters(x, self.coarse)
+        codes = self.encode(x - self.coarse[assign])
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(self.nlist + 1))
+        for lst in np.unique(assign):
+            sel = order[bounds[lst]:bounds[lst + 1]]
+            self.list_ids[lst] = np.concatenate([self.list_ids[lst], ids[sel]])
+            self.list_codes[lst] = np.concatenate([self.list_codes[lst], codes[sel]])
+
+    def search(self, query, k=10, nprobe=DEFAULT_NPROBE, rerank_vectors=None, rerank_factor=4):
+        """
+        上位 k 件を (ID 配列, 類似度配列) で返します。
+        rerank_vectors (例: EmbeddingStore.vectors) を渡すと、k × rerank_factor 件の候補を
+        元のベクトルで正確に並べ直します。
+        """
+        q = np.asarray(query, dtype=np.float32).ravel()
+        q = q / (np.linalg.norm(q) or 1.0)
+        coarse_d = _sq_distances(q[None, :], self.coarse)[0]
+        probes = np.argpartition(coarse_d, min(nprobe, self.nlist) - 1)[:nprobe]
+
+        shortlist = k * rerank_factor if rerank_vectors is not None else k
+        # 調べる全リスト分の距離表 (nprobe, m, 256) を一度に作る
+        r = (q[None, :] - self.coarse[probes]).reshape(len(probes), self.m, self.dsub)
+        luts = (np.einsum("mkd,mkd->mk", self.codebooks, self.codebooks)[None]
+                - 2.0 * np.einsum("pmd,mkd->pmk", r, self.codebooks)
+                + np.einsum("pmd,pmd->pm", r, r)[:, :, None])
+        sub_idx = np.arange(self.m)
+        cand_ids, cand_d = [], []
+        for lut, lst in zip(luts, probes):
+            codes = self.list_codes[lst]
+            if len(codes) == 0:
+                continue
+            # 残差クエリの距離表をコードで引いて合計する
+            d = lut[sub_idx, codes].sum(axis=1)
+            cand_ids.append(self.list_ids[lst])
+            cand_d.append(d)
+        if not cand_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids = np.concatenate(cand_ids)
+        d = np.concatenate(cand_d)
+        if len(d) > shortlist:
+            keep = np.argpartition(d, shortlist)[:shortlist]
+            ids, d = ids[keep], d[keep]
+
+        if rerank_vectors is not None:
+            sims = np.asarray(rerank_vectors[np.sort(ids)], dtype=np.float32) @ q
+            ids = np.sort(ids)
+        else:
+            sims = 1.0 - d / 2.0
+        order = np.argsort(-sims)[:k]
+        return ids[order], sims[order].astype(np.float32)
+
+    def save(self, path):
+        lengths = np.array([len(ids) for ids in self.list_ids], dtype=np.int64)
+        np.savez(path, dim=self.dim, m=self.m, coarse=self.coarse, codebooks=self.codebooks,
+                 lengths=lengths, ids=np.concatenate(self.list_ids),
+                 codes=np.concatenate(self.list_codes))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(int(data["dim"]), nlist=len(data["coarse"]), m=int(data["m"]))
+        index.coarse = data["coarse"]
+        index.codebooks = data["codebooks"]
+        bounds = np.concatenate([[0], np.cumsum(data["lengths"])])
+        index.list_ids = [data["ids"][a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        index.list_codes = [data["codes"][a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        return index
+
+    @classmethod
+    def from_store(cls, store, nlist=DEFAULT_NLIST, m=DEFAULT_M, train_size=100_000,
+                   block_rows=65536, seed=0):
+        """EmbeddingStore の全ページからインデックスを作ります (ID はストアの行番号)。"""
+        vectors = store.vectors
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(len(vectors), min(train_size, len(vectors)), replace=False))
+        index = cls(store.dim, nlist=min(nlist, len(sample)), m=m)
+        index.train(np.asarray(vectors[sample], dtype=np.float32), seed=seed)
+        for start in range(0, len(vectors), block_rows):
+            block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+            index.add(block, np.arange(start, start + len(block)))
+        return index
@@ -0,0 +1,303 @@
+import os
+import time
+import json
+import random
+import asyncio
+import base64
+import threading
+import numpy as np
+import httpx
+from embedding_cache import get_default_cache, payload_key
+from embedding_batch import MAX_BATCH_BYTES, MAX_BATCH_ITEMS, make_batches
+from embedding_config import OUTPUT_DIMENSIONALITY
+
+# REST API のエンドポイント (ローカルの疑似サーバーで試す場合は環境変数で差し替える)
+DEFAULT_BASE_URL = os.getenv("GEMINI_API_BASE_URL", "https://generativelanguage.googleapis.com/v1beta")
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_RATE = 10.0      # 1秒あたりのリクエスト数の初期値
+MAX_RETRIES = 6
+BACKOFF_BASE = 0.5       # 秒
+BACKOFF_CAP = 30.0       # 秒
+THROTTLE_STATUS = (429, 503)
+
+
+class TokenBucket:
+    """
+    トークンバケット方式のレートリミッタ。rate は AIMD で外から調整されます。
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate):
+        """レートを変えます。バースト (capacity) もレートに合わせて縮め、溜まったトークンを切り詰めます。"""
+        self._refill()
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = min(self.tokens, self.capacity)
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return
+            await asyncio.sleep((1.0 - self.tokens) / self.rate)
+
+
+def backoff_delay(attempt, retry_after=None):
+    """指数バックオフ + フルジッター。Retry-After があればそれを下限にします。"""
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def to_rest_content(content):
+    """embed_content 形式のコンテンツを REST API の Content JSON に変換します。"""
+    if isinstance(content, str):
+        return {"parts": [{"text": content}]}
+    data = content["data"]
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = base64.b64encode(data).decode("utf-8")
+    return {"parts": [{"inline_data": {"mime_type": content["mime_type"], "data": data}}]}
+
+
+class AsyncEmbeddingClient:
+    """
+    asyncio ベースの並行エンベディングクライアント。
+    同時リクエスト数 (ウィンドウ) とリクエストレートを、429/503 が返ってきたら半分に、
+    成功が続けば少しずつ増やす (AIMD) ことで、サービスの上限ぎりぎりで送り続けます。
+    """
+
+    def __init__(self, model_name, api_key=None, base_url=DEFAULT_BASE_URL,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, rate=DEFAULT_RATE,
+                 output_dimensionality=OUTPUT_DIMENSIONALITY, cache=None, timeout=120.0):
+        self.model_name = model_name
+        self.api_key = api_key or os.getenv("GOOGLE_API_KEY", "")
+        self.base_url = base_url.rstrip("/")
+        self.max_in_flight = max_in_flight
+        self.window = float(max_in_flight)
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate)
+        self.output_dimensionality = output_dimensionality
+        self.cache = cache or get_default_cache()
+        self.timeout = timeout
+        self.stats = {"requests": 0, "throttled": 0, "retries": 0, "splits": 0, "failed": 0}
+        self._in_flight = 0
+        self._cond = None
+
+    # ---- AIMD ----
+    def _on_success(self):
+        self.window = min(self.max_in_flight, self.window + 1.0 / self.window)
+        self.bucket.set_rate(min(self.max_rate, self.bucket.rate + 1.0 / self.bucket.rate))
+
+    def _on_throttle(self):
+        self.stats["throttled"] += 1
+        self.window = max(1.0, self.window / 2)
+        self.bucket.set_rate(max(0.5, self.bucket.rate / 2))
+
+    async def _acquire_slot(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight < int(self.window))
+            self._in_flight += 1
+        await self.bucket.acquire()
+
+    async def _release_slot(self):
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    # ---- HTTP ----
+    def _request_body(self, batch):
+        requests = []
+        for _, content, _ in batch:
+            req = {"model": self.model_name, "content": to_rest_content(content)}
+            if self.output_dimensionality:
+                req["outputDimensionality"] = self.output_dimensionality
+            requests.append(req)
+        return {"requests": requests}
+
+    async def _post_batch(self, http, batch):
+        """
+        1バッチを送信します。戻り値は (index, ベクトル or None) のリストです。
+
+        - 429/503・通信エラー・5xx はバックオフして同じバッチを再送し、MAX_RETRIES 回で
+          解消しなければバッチ全体を失敗とする (スロットリング中に分割すると要求が増えるため)
+        - 400 は特定のアイテムが原因とみなし、半分に分割して失敗した側だけを再送する
+        - それ以外 (401/403/404 など) はリクエスト全体の問題なので、分割せずに失敗とする
+        """
+        url = f"{self.base_url}/{self.model_name}:batchEmbedContents"
+        body = self._request_body(batch)
+        error, split = None, False
+        for attempt in range(MAX_RETRIES):
+            await self._acquire_slot()
+            try:
+                self.stats["requests"] += 1
+                resp = await http.post(url, params={"key": self.api_key}, json=body)
+            except httpx.TransportError as e:
+                resp, error = None, e
+            finally:
+                await self._release_slot()
+
+            if resp is not None and resp.status_code == 200:
+                self._on_success()
+                vectors = [np.asarray(e["values"], dtype=np.float32)
+                           for e in resp.json()["embeddings"]]
+                return [(idx, vec) for (idx, _, _), vec in zip(batch, vectors)]
+
+            retry_after = None
+            if resp is not None:
+                # 直前の通信エラーではなく、最後に返ってきた応答を失敗の理由として残す
+                error = f"HTTP {resp.status_code}: {resp.text[:200]}"
+                if resp.status_code in THROTTLE_STATUS:
+                    self._on_throttle()
+                    if resp.headers.get("Retry-After", "").isdigit():
+                        retry_after = float(resp.headers["Retry-After"])
+                elif resp.status_code < 500:
+                    split = resp.status_code == 400 and len(batch) > 1
+                    break
+            if attempt + 1 < MAX_RETRIES:
+                self.stats["retries"] += 1
+                await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+        if not split:
+            print(f"❌ {len(batch)} 件のエンベディング取得に失敗しました: {error}")
+            self.stats["failed"] += len(batch)
+            return [(idx, None) for idx, _, _ in batch]
+        self.stats["splits"] += 1
+        mid = len(batch) // 2
+        halves = await asyncio.gather(self._post_batch(http, batch[:mid]),
+                                      self._post_batch(http, batch[mid:]))
+        return halves[0] + halves[1]
+
+    async def embed_many(self, contents, max_items=MAX_BATCH_ITEMS, max_bytes=MAX_BATCH_BYTES):
+        """
+        コンテンツのリストを並行して埋め込みます。戻り値は入力と同じ順序です (失敗は None)。
+        """
+        if self._cond is None:
+            # 同じクライアントで並行に呼ばれても、ウィンドウの管理は1つにする
+            self._cond = asyncio.Condition()
+        start = time.perf_counter()
+        results = [None] * len(contents)
+        pending = []
+        for i, content in enumerate(contents):
+            key = payload_key(self.model_name, content, self.output_dimensionality)
+            vec = self.cache.get(key)
+            if vec is not None:
+                results[i] = vec
+            else:
+                pending.append((i, content, key))
+
+        keys = {i: key for i, _, key in pending}
+        async with httpx.AsyncClient(timeout=self.timeout) as http:
+            batches = make_batches(pending, max_items, max_bytes)
+            for done in asyncio.as_completed([self._post_batch(http, b) for b in batches]):
+                for i, vec in await done:
+                    if vec is not None:
+                        self.cache.put(keys[i], vec)
+                    results[i] = vec
+
+        elapsed = time.perf_counter() - start
+        self.stats["items_per_second"] = len(contents) / elapsed if elapsed > 0 else float("inf")
+        print(f"⚡ {len(contents)} 件を {elapsed:.2f} 秒で取得 "
+              f"({self.stats['items_per_second']:.1f} items/s, リクエスト {self.stats['requests']} 回, "
+              f"スロットリング {self.stats['throttled']} 回, 最終ウィンドウ {int(self.window)})")
+        return results
+
+
+def embed_concurrently(model_name, contents, **kwargs):
+    """同期コードから AsyncEmbeddingClient を使うためのヘルパーです。"""
+    client = AsyncEmbeddingClient(model_name, **kwargs)
+    return asyncio.run(client.embed_many(contents))
+
+
+class SharedEmbeddingClient:
+    """
+    複数のスレッドから1つの AsyncEmbeddingClient を使うための同期ラッパー。
+    専用スレッドで1つのイベントループを動かし、呼び出しはすべてそこで実行するので、
+    同時リクエスト数・トークンバケット・AIMD の状態がスレッド間で共有されます。
+    embed_batch と同じ (model_name, contents) で呼べるため、embed_pdf_pages の
+    embed_fn にそのまま渡せます (スレッドごとに embed_concurrently を呼ぶと、
+    それぞれが別のリミッタで 429 を受けてしまいます)。
+    """
+
+    def __init__(self, **client_kwargs):
+        self.client_kwargs = client_kwargs
+        self._clients = {}      # モデル名 → AsyncEmbeddingClient
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def _client(self, model_name):
+        with self._lock:
+            client = self._clients.get(model_name)
+            if client is None:
+                client = self._clients[model_name] = AsyncEmbeddingClient(model_name, **self.client_kwargs)
+            return client
+
+    def __call__(self, model_name, contents):
+        future = asyncio.run_coroutine_threadsafe(self._client(model_name).embed_many(contents), self._loop)
+        return future.result()
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    # ローカルの疑似サーバーに対して動作確認を行います (一定確率で 429 を返す)
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from embedding_cache import EmbeddingCache
+
+    class FakeEmbeddingHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if random.random() < 0.2:
+                self.send_response(429)
+                self.end_headers()
+                return
+            time.sleep(0.05)
+            embeddings = [{"values": [float(len(r["content"]["parts"][0]["text"]))] * 4}
+                          for r in body["requests"]]
+            data = json.dumps({"embeddings": embeddings}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeEmbeddingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    texts = ["x" * (i % 50 + 1) for i in range(1000)]
+    results = embed_concurrently(
+        "models/fake-embedding",
+        texts,
+        base_url=f"http://127.0.0.1:{server.server_address[1]}",
+        cache=EmbeddingCache(":memory:"),
+        max_in_flight=16,
+        rate=200.0,
+    )
+    assert all(r is not None and r[0] == len(t) for r, t in zip(results, texts))
+    print("✅ 疑似サーバーでの動作確認完了 (順序も一致)")
+    server.shutdown()
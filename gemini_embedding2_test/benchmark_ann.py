@@ -0,0 +1,72 @@
+import time
+import numpy as np
+from ann_index import IVFPQIndex
+from embedding_store import EmbeddingStore
+
+
+def make_synthetic_corpus(n, dim, n_clusters=8192, spread=1.0, seed=0):
+    """
+    ページエンベディングを模したクラスタ構造を持つ正規化済みベクトルを作ります。
+    クラスタ数が IVF のリスト数 (nlist) より少なくまとまりが強いと、近傍がすべて1つの
+    リストに入って nprobe を変えても recall が変わらないため、nlist より多いクラスタを
+    広めに (spread) 散らし、近傍が複数のリストにまたがるようにしています。
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    x = centers[rng.integers(0, n_clusters, n)] + spread * rng.standard_normal((n, dim)).astype(np.float32)
+    x /= np.linalg.norm(x, axis=1, keepdims=True)
+    return x
+
+
+def exact_search(vectors, q, k):
+    scores = vectors @ q
+    top = np.argpartition(-scores, k)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def run_benchmark(vectors, queries, k=10, nlist=1024, m=16, nprobes=(1, 4, 16, 64)):
+    print(f"--- コーパス {len(vectors)} 件 × {vectors.shape[1]} 次元, クエリ {len(queries)} 件 ---")
+
+    t0 = time.perf_counter()
+    index = IVFPQIndex(vectors.shape[1], nlist=nlist, m=m)
+    index.train(vectors[:min(len(vectors), 100_000)])
+    index.add(vectors, np.arange(len(vectors)))
+    print(f"インデックス構築: {time.perf_counter() - t0:.1f} 秒")
+
+    t0 = time.perf_counter()
+    truth = [exact_search(vectors, q, k) for q in queries]
+    exact_ms = (time.perf_counter() - t0) / len(queries) * 1000
+    print(f"\n{'方式':<22}{'recall@' + str(k):>12}{'ms/query':>12}")
+    print(f"{'exact':<22}{1.0:>12.3f}{exact_ms:>12.2f}")
+
+    for nprobe in nprobes:
+        for rerank in (None, vectors):
+            t0 = time.perf_counter()
+            found = [index.search(q, k=k, nprobe=nprobe, rerank_vectors=rerank)[0] for q in queries]
+            ms = (time.perf_counter() - t0) / len(queries) * 1000
+            recall = np.mean([len(np.intersect1d(f, t)) / k for f, t in zip(found, truth)])
+            name = f"ivfpq nprobe={nprobe}" + (" +rerank" if rerank is not None else "")
+            print(f"{name:<22}{recall:>12.3f}{ms:>12.2f}")
+
+
+def main():
+    STORE_DIR = None        # EmbeddingStore のディレクトリを指定すると実データで計測 (合成データより信頼できる)
+    N, DIM = 200_000, 768   # 合成データを使う場合のサイズ
+    N_QUERIES = 100
+
+    if STORE_DIR:
+        store = EmbeddingStore(STORE_DIR)
+        vectors = np.asarray(store.vectors, dtype=np.float32)
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.choice(len(vectors), N_QUERIES, replace=False)]
+    else:
+        vectors = make_synthetic_corpus(N, DIM)
+        # コーパス中の点に少しノイズを加えたものをクエリにする
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.choice(N, N_QUERIES, replace=False)]
+        queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    run_benchmark(vectors, queries)
+
+
+if __name__ == "__main__":
+    main()
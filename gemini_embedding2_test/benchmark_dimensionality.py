@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import tempfile
+import numpy as np
+from embedding_batch import embed_batch
+from embedding_config import MODEL_NAME, describe_config
+from embedding_store import EmbeddingStore, content_hash
+from image_payload import image_payload
+from image_matrix_similarity import list_images
+
+
+def load_labelled_queries(labels_path):
+    """
+    正解付きのクエリを読み込みます。JSON は次の形のリストです。
+    [{"text": "赤いロゴ", "relevant": ["a.png", "b.png"]}, {"image": "query.png", "relevant": ["c.png"]}]
+    relevant はコーパスのファイル名 (フォルダを除く) です。
+    """
+    with open(labels_path, encoding="utf-8") as fp:
+        return json.load(fp)
+
+
+def _query_content(query):
+    return query["text"] if "text" in query else image_payload(query["image"])
+
+
+def evaluate_dimension(image_paths, queries, dim, k=10, embed_fn=embed_batch):
+    """
+    出力次元数 dim でコーパスとクエリを埋め込み、一時的な EmbeddingStore に入れて検索し、
+    {dim, stored, megabytes, ms_per_query, recall, mrr} を返します (dim=None はモデル本来の次元数)。
+    embed_fn は embed_batch と同じ (model_name, contents, output_dimensionality=...) を受け取る関数です。
+    """
+    corpus = embed_fn(MODEL_NAME, [image_payload(p) for p in image_paths], output_dimensionality=dim)
+    kept = [(os.path.basename(p), emb) for p, emb in zip(image_paths, corpus) if emb is not None]
+    query_embs = embed_fn(MODEL_NAME, [_query_content(q) for q in queries], output_dimensionality=dim)
+    names = [name for name, _ in kept]
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        vectors = np.array([emb for _, emb in kept], dtype=np.float32)
+        store = EmbeddingStore(store_dir, dim=vectors.shape[1], config=describe_config(MODEL_NAME, dim))
+        store.append("corpus", range(len(names)), vectors, [content_hash(name) for name in names])
+        megabytes = os.path.getsize(os.path.join(store_dir, "vectors.bin")) / 1e6
+
+        recalls, reciprocal_ranks, seconds = [], [], 0.0
+        for query, emb in zip(queries, query_embs):
+            if emb is None:
+                continue
+            t0 = time.perf_counter()
+            hits = store.search(emb, k=k)
+            seconds += time.perf_counter() - t0
+            found = [names[store.describe(row)[1]] for row, _ in hits]
+            relevant = set(query["relevant"])
+            recalls.append(len(relevant.intersection(found)) / len(relevant))
+            rank = next((i + 1 for i, name in enumerate(found) if name in relevant), None)
+            reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+        del store   # Windows では memmap を閉じないと一時フォルダを消せない
+
+    return {
+        "dim": vectors.shape[1],
+        "stored": len(names),
+        "megabytes": megabytes,
+        "ms_per_query": seconds / max(len(recalls), 1) * 1000,
+        "recall": float(np.mean(recalls)) if recalls else 0.0,
+        "mrr": float(np.mean(reciprocal_ranks)) if reciprocal_ranks else 0.0,
+    }
+
+
+def run_benchmark(image_paths, queries, dimensions, k=10, min_recall=None, embed_fn=embed_batch):
+    print(f"--- {MODEL_NAME}: コーパス {len(image_paths)} 件, 正解付きクエリ {len(queries)} 件 ---")
+    print(f"\n{'次元数':<10}{'MB':>10}{'ms/query':>12}{'recall@' + str(k):>12}{'MRR':>10}")
+    results = []
+    for dim in dimensions:
+        r = evaluate_dimension(image_paths, queries, dim, k=k, embed_fn=embed_fn)
+        results.append(r)
+        print(f"{r['dim']:<10}{r['megabytes']:>10.2f}{r['ms_per_query']:>12.2f}{r['recall']:>12.3f}{r['mrr']:>10.3f}")
+
+    if min_recall is not None:
+        ok = [r for r in results if r["recall"] >= min_recall]
+        if ok:
+            best = min(ok, key=lambda r: r["dim"])
+            print(f"\n✅ recall@{k} >= {min_recall} を満たす最小の次元数: {best['dim']} "
+                  f"(GEMINI_OUTPUT_DIMENSIONALITY={best['dim']})")
+        else:
+            print(f"\n⚠️ recall@{k} >= {min_recall} を満たす次元数はありませんでした。")
+    return results
+
+
+def main():
+    IMAGE_DIR = "images"                        # 検索対象の画像フォルダ
+    LABELS_PATH = "labelled_queries.json"       # 正解付きクエリ (load_labelled_queries の形式)
+    DIMENSIONS = (None, 1536, 768, 256, 128)    # None はモデル本来の次元数
+    TOP_K = 10
+    MIN_RECALL = 0.9                            # この recall@k を満たす最小の次元数を表示
+
+    run_benchmark(list_images(IMAGE_DIR), load_labelled_queries(LABELS_PATH), DIMENSIONS,
+                  k=TOP_K, min_recall=MIN_RECALL)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import time
+import numpy as np
+from benchmark_ann import exact_search, make_synthetic_corpus
+from embedding_store import EmbeddingStore
+from quantized_index import QuantizedIndex
+
+
+def run_benchmark(vectors, queries, k=10, rerank_factors=(1, 4, 10, 40)):
+    print(f"--- コーパス {len(vectors)} 件 × {vectors.shape[1]} 次元, クエリ {len(queries)} 件 ---")
+    # 以前は np.array(result['embedding']) の float64 のまま持っていたので、それとも比べる
+    float64_bytes = vectors.size * 8
+    float32_bytes = vectors.size * 4
+    indexes = {mode: QuantizedIndex(vectors.shape[1], mode).add(vectors) for mode in ("int8", "binary")}
+    print(f"\n{'形式':<10}{'MB':>10}{'float64 比':>12}{'float32 比':>12}")
+    print(f"{'float64':<10}{float64_bytes / 1e6:>10.1f}{1.0:>12.1f}{0.5:>12.1f}")
+    print(f"{'float32':<10}{float32_bytes / 1e6:>10.1f}{2.0:>12.1f}{1.0:>12.1f}")
+    for mode, index in indexes.items():
+        print(f"{mode:<10}{index.nbytes / 1e6:>10.1f}"
+              f"{float64_bytes / index.nbytes:>12.1f}{float32_bytes / index.nbytes:>12.1f}")
+
+    t0 = time.perf_counter()
+    truth = [exact_search(vectors, q, k) for q in queries]
+    exact_ms = (time.perf_counter() - t0) / len(queries) * 1000
+    print(f"\n{'方式':<22}{'recall@' + str(k):>12}{'ms/query':>12}")
+    print(f"{'float32 exact':<22}{1.0:>12.3f}{exact_ms:>12.2f}")
+
+    for mode, index in indexes.items():
+        runs = [(None, 1)] + [(vectors, factor) for factor in rerank_factors]
+        for rerank, factor in runs:
+            t0 = time.perf_counter()
+            found = [index.search(q, k=k, rerank_vectors=rerank, rerank_factor=factor)[0] for q in queries]
+            ms = (time.perf_counter() - t0) / len(queries) * 1000
+            recall = np.mean([len(np.intersect1d(f, t)) / k for f, t in zip(found, truth)])
+            name = mode + (f" +rerank x{factor}" if rerank is not None else "")
+            print(f"{name:<22}{recall:>12.3f}{ms:>12.2f}")
+
+
+def main():
+    STORE_DIR = None        # EmbeddingStore のディレクトリを指定すると実データで計測
+    N, DIM = 200_000, 768   # 合成データを使う場合のサイズ
+    N_QUERIES = 100
+
+    if STORE_DIR:
+        store = EmbeddingStore(STORE_DIR)
+        vectors = np.asarray(store.vectors, dtype=np.float32)
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.choice(len(vectors), N_QUERIES, replace=False)]
+    else:
+        vectors = make_synthetic_corpus(N, DIM)
+        # コーパス中の点に少しノイズを加えたものをクエリにする
+        rng = np.random.default_rng(1)
+        queries = vectors[rng.choice(N, N_QUERIES, replace=False)]
+        queries = queries + 0.05 * rng.standard_normal(queries.shape).astype(np.float32)
+    run_benchmark(vectors, queries)
+
+
+if __name__ == "__main__":
+    main()
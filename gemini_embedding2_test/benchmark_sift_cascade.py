@@ -0,0 +1,81 @@
+import io
+import os
+import tempfile
+import time
+from contextlib import redirect_stdout
+from extract_pdf_pages_sift import extract_pages_with_sift
+from logo_model import LogoModel
+from orb_prefilter import OrbPrefilter
+from template_matching import load_logo_gray
+
+
+def run_corpus(pdf_paths, logo_path, min_match_count=4):
+    """
+    1つのコーパス (PDF のリスト) を、ORB 前段フィルタなし/ありで処理して比較します。
+    ページ特徴量キャッシュが効かないよう、毎回メモリ上の新しい LogoModel を使います。
+    missed_pages は SIFT のみでは見つかったのに前段フィルタで落ちた (PDF, ページ番号) のリストです。
+    """
+    prefilter = OrbPrefilter({"logo": load_logo_gray(logo_path)})
+    seconds = {False: 0.0, True: 0.0}
+    found = {False: 0, True: 0}
+    missed_pages = []
+    tmp = tempfile.TemporaryDirectory()
+    output_path = os.path.join(tmp.name, "extracted.pdf")
+    for pdf_path in pdf_paths:
+        pages = {}
+        for use_prefilter in (False, True):
+            model = LogoModel(":memory:")
+            start = time.perf_counter()
+            with redirect_stdout(io.StringIO()):
+                pages[use_prefilter] = set(extract_pages_with_sift(
+                    pdf_path, logo_path, output_path, min_match_count, model,
+                    prefilter=prefilter if use_prefilter else False))
+            seconds[use_prefilter] += time.perf_counter() - start
+            found[use_prefilter] += len(pages[use_prefilter])
+            model.close()
+        # 前段フィルタで除外したせいで見つからなくなったページ
+        missed_pages.extend((pdf_path, page_num) for page_num in sorted(pages[False] - pages[True]))
+    tmp.cleanup()
+    return {
+        "pdfs": len(pdf_paths),
+        "pages": prefilter.pages,
+        "rejection_rate": prefilter.rejected / prefilter.pages if prefilter.pages else 0.0,
+        "found": found[False],
+        "missed": len(missed_pages),
+        "missed_pages": missed_pages,
+        "seconds": seconds[False],
+        "seconds_cascade": seconds[True],
+        "speedup": seconds[False] / seconds[True] if seconds[True] else 0.0,
+    }
+
+
+def main():
+    LOGO_FILE = "logo.png"
+    # コーパス名: PDF のリスト (ロゴを含むページの割合が違うものを並べると傾向が分かる)
+    CORPORA = {
+        "sample": ["sample.pdf"],
+    }
+    MIN_MATCH_COUNT = 4
+
+    print(f"{'コーパス':<12}{'ページ':>8}{'除外率':>8}{'検出':>6}{'見逃し':>8}"
+          f"{'SIFTのみ(秒)':>14}{'前段あり(秒)':>14}{'高速化':>8}")
+    missed = {}
+    for name, pdf_paths in CORPORA.items():
+        r = run_corpus(pdf_paths, LOGO_FILE, MIN_MATCH_COUNT)
+        print(f"{name:<12}{r['pages']:>8}{r['rejection_rate']:>8.0%}{r['found']:>6}{r['missed']:>8}"
+              f"{r['seconds']:>14.2f}{r['seconds_cascade']:>14.2f}{r['speedup']:>7.1f}x")
+        if r["missed_pages"]:
+            missed[name] = r["missed_pages"]
+
+    # 速度より先に見逃しを確認する。1ページでも見逃すコーパスでは prefilter を使わないこと
+    for name, missed_pages in missed.items():
+        print(f"\n⚠️ 見逃しあり: コーパス '{name}' で、SIFT のみでは見つかった {len(missed_pages)} ページを"
+              f"前段フィルタが除外しました。このコーパスでは prefilter=True を使わないでください。")
+        for pdf_path, page_num in missed_pages:
+            print(f"   - {pdf_path} ページ {page_num + 1}")
+    if not missed:
+        print("\n✅ どのコーパスでも、前段フィルタによる見逃しはありませんでした。")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import os
+from functools import partial
+import time
+import cv2
+import numpy as np
+from fft_correlation import FFTCorrelator, PageSpectrum, match_fft
+from page_raster import rasterize_pages
+from template_matching import (LogoTemplates, ScalePrior, load_logo_gray, match_brute_force,
+                               match_pyramid, match_with_prior)
+
+
+def make_synthetic_pages(logo_gray, n_pages=12, size=(1684, 1190), seed=0):
+    """
+    A4 (zoom=2.0 相当) の白いページに文字風の線を引き、半分のページにだけ
+    ロゴを貼り付けたテスト用ページを作ります。実際の文書と同じく、ロゴの縮尺は
+    文書内でほぼ一定 (±3%) で、位置はページごとに変えます。
+    """
+    rng = np.random.default_rng(seed)
+    base_scale = rng.uniform(0.3, 1.5)
+    pages = []
+    for i in range(n_pages):
+        page = np.full(size, 255, dtype=np.uint8)
+        for y in range(150, size[0] - 150, 40):
+            cv2.putText(page, "lorem ipsum dolor sit amet " * 2, (100, y),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.9, 0, 2)
+        if i % 2 == 0:
+            scale = base_scale * rng.uniform(0.97, 1.03)
+            logo = cv2.resize(logo_gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            h, w = logo.shape
+            y, x = rng.integers(0, size[0] - h), rng.integers(0, size[1] - w)
+            page[y:y + h, x:x + w] = logo
+        pages.append(page)
+    return pages
+
+
+def run_benchmark(pages, logo_gray, threshold=0.75, methods=None):
+    """
+    各方式で全ページを判定し、1ページあたりの時間・総当たりとの判定一致数・
+    最大スコアの差を表示します。しきい値を超えない (ロゴなし) ページは全候補を
+    探索するため、最も時間がかかるケースになります。
+    方式はページ順に呼ばれるので、prior のようにページをまたいで状態を持つものも比較できます。
+    """
+    if methods is None:
+        templates = LogoTemplates(logo_gray)
+        prior = ScalePrior(templates.scales)
+        fft_prior = ScalePrior(templates.scales)
+        correlator = FFTCorrelator()
+        methods = {
+            "brute_force": match_brute_force,
+            "pyramid": match_pyramid,
+            # リサイズ済みロゴのキャッシュと縮尺の事前情報を全ページで共有する
+            "prior": lambda page, _, thr: match_with_prior(page, templates, thr, prior),
+            "fft": lambda page, _, thr: match_fft(page, templates, thr, correlator=correlator),
+            "fft+prior": lambda page, _, thr: match_with_prior(
+                page, templates, thr, fft_prior,
+                method=partial(match_fft, correlator=correlator, page=PageSpectrum(page))),
+        }
+    print(f"--- {len(pages)} ページ, ロゴ {logo_gray.shape[1]}x{logo_gray.shape[0]}, しきい値 {threshold} ---")
+
+    results = {}
+    for name, match in methods.items():
+        t0 = time.perf_counter()
+        results[name] = [match(page, logo_gray, threshold) for page in pages]
+        results[name + "_ms"] = (time.perf_counter() - t0) / len(pages) * 1000
+
+    reference = results["brute_force"]
+    base_ms = results["brute_force_ms"]
+    print(f"\n{'方式':<14}{'ms/page':>10}{'高速化':>8}{'判定一致':>10}{'スコア差(最大)':>16}")
+    for name in methods:
+        found = [r[0] >= threshold for r in results[name]]
+        agree = sum(f == (r[0] >= threshold) for f, r in zip(found, reference))
+        # しきい値未満のページは両方式とも最大スコアを返すので値そのものを比較できる
+        diffs = [abs(a[0] - b[0]) for a, b in zip(results[name], reference) if b[0] < threshold]
+        ms = results[name + "_ms"]
+        print(f"{name:<14}{ms:>10.1f}{base_ms / ms:>7.1f}x{agree:>6}/{len(pages):<4}"
+              f"{max(diffs, default=0.0):>16.4f}")
+
+
+def main():
+    PDF_FILE = "sample.pdf"     # 存在すれば実際のページで計測 (なければ合成ページ)
+    LOGO_FILE = "logo.png"
+    MAX_PAGES = 20
+    MATCH_THRESHOLD = 0.75
+
+    logo_gray = load_logo_gray(LOGO_FILE)
+    if os.path.exists(PDF_FILE):
+        pages = []
+        for page_num, img_array in rasterize_pages(PDF_FILE, zoom=2.0):
+            if page_num >= MAX_PAGES:
+                break
+            pages.append(cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY))
+    else:
+        pages = make_synthetic_pages(logo_gray)
+    run_benchmark(pages, logo_gray, MATCH_THRESHOLD)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import time
+import random
+import numpy as np
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+from embedding_cache import get_default_cache, payload_key, split_payload
+from embedding_config import OUTPUT_DIMENSIONALITY
+
+# BatchEmbedContents で1リクエストにまとめられる最大件数
+MAX_BATCH_ITEMS = 100
+# 1リクエストのペイロード上限 (API のリクエストサイズ上限より余裕を持たせた値)
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+# 1件だけになったサブバッチを諦めるまでの再試行回数
+MAX_RETRIES = 3
+# 429/503 (レート制限・過負荷) のときに、分割せずに同じバッチを再送する回数と待ち時間
+MAX_THROTTLE_RETRIES = 6
+BACKOFF_BASE = 1.0       # 秒
+BACKOFF_CAP = 30.0       # 秒
+THROTTLE_ERRORS = (api_exceptions.TooManyRequests, api_exceptions.ResourceExhausted,
+                   api_exceptions.ServiceUnavailable)
+
+
+def _payload_size(content):
+    parts = split_payload(content)
+    return len(parts[1]) if parts else 0
+
+
+def make_batches(items, max_items=MAX_BATCH_ITEMS, max_bytes=MAX_BATCH_BYTES):
+    """
+    (index, content, key) のリストを件数とバイト数の上限に収まるバッチに分割します。
+    入力の順序はそのまま保たれます。
+    """
+    batches = []
+    current, current_bytes = [], 0
+    for item in items:
+        size = _payload_size(item[1])
+        if current and (len(current) >= max_items or current_bytes + size > max_bytes):
+            batches.append(current)
+            current, current_bytes = [], 0
+        current.append(item)
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _is_throttled(error):
+    return isinstance(error, THROTTLE_ERRORS) or getattr(error, "code", None) in (429, 503)
+
+
+def _embed_sub_batch(model_name, batch, kwargs, stats):
+    """
+    1つのバッチを送信します。戻り値は (index, ベクトル or None) のリストです。
+
+    - 429/503 はバッチの中身ではなく送り方の問題なので、分割せずに指数バックオフ
+      (フルジッター) で同じバッチを再送する。分割するとリクエスト数が増えて逆効果になる
+    - それ以外のエラーは特定のアイテムが原因とみなし、半分に分割して失敗した側だけを再送する
+    """
+    error, attempts, throttled = None, 0, 0
+    while True:
+        try:
+            stats["requests"] += 1
+            result = genai.embed_content(
+                model=model_name,
+                content=[content for _, content, _ in batch],
+                **kwargs
+            )
+            vectors = [np.asarray(v, dtype=np.float32) for v in result['embedding']]
+            return [(idx, vec) for (idx, _, _), vec in zip(batch, vectors)]
+        except Exception as e:
+            error = e
+            if _is_throttled(e):
+                if throttled >= MAX_THROTTLE_RETRIES:
+                    break
+                stats["throttled"] += 1
+                time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** throttled)))
+                throttled += 1
+                continue
+            attempts += 1
+            if len(batch) > 1 or attempts >= MAX_RETRIES:
+                break
+            time.sleep(2 ** (attempts - 1))
+
+    if len(batch) == 1 or _is_throttled(error):
+        print(f"❌ {len(batch)} 件のエンベディング取得に失敗しました: {error}")
+        stats["failed"] += len(batch)
+        return [(idx, None) for idx, _, _ in batch]
+
+    stats["splits"] += 1
+    mid = len(batch) // 2
+    return (_embed_sub_batch(model_name, batch[:mid], kwargs, stats)
+            + _embed_sub_batch(model_name, batch[mid:], kwargs, stats))
+
+
+def embed_batch(model_name, contents, output_dimensionality=OUTPUT_DIMENSIONALITY, cache=None,
+                max_items=MAX_BATCH_ITEMS, max_bytes=MAX_BATCH_BYTES, stats=None):
+    """
+    複数のコンテンツのエンベディングをまとめて取得します。
+    キャッシュにあるものは送信せず、残りを上限いっぱいのバッチにまとめて送ります。
+    戻り値は入力と同じ順序のベクトルのリストです (失敗したものは None)。
+    stats に辞書を渡すと、リクエスト数やスループットが書き込まれます。
+    """
+    cache = cache or get_default_cache()
+    stats = stats if stats is not None else {}
+    stats.update({"items": len(contents), "cached": 0, "requests": 0,
+                  "throttled": 0, "splits": 0, "failed": 0})
+    kwargs = {}
+    if output_dimensionality:
+        kwargs["output_dimensionality"] = output_dimensionality
+
+    start = time.perf_counter()
+    results = [None] * len(contents)
+    pending = []
+    for i, content in enumerate(contents):
+        key = payload_key(model_name, content, output_dimensionality)
+        vec = cache.get(key)
+        if vec is not None:
+            results[i] = vec
+            stats["cached"] += 1
+        else:
+            pending.append((i, content, key))
+
+    keys = {i: key for i, _, key in pending}
+    for batch in make_batches(pending, max_items, max_bytes):
+        for i, vec in _embed_sub_batch(model_name, batch, kwargs, stats):
+            if vec is not None:
+                cache.put(keys[i], vec)
+            results[i] = vec
+
+    elapsed = time.perf_counter() - start
+    stats["seconds"] = elapsed
+    stats["items_per_second"] = len(contents) / elapsed if elapsed > 0 else float("inf")
+    print(f"⚡ {len(contents)} 件を {elapsed:.2f} 秒で取得 "
+          f"({stats['items_per_second']:.1f} items/s, キャッシュ {stats['cached']} 件, "
+          f"リクエスト {stats['requests']} 回)")
+    return results
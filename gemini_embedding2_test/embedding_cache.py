@@ -0,0 +1,196 @@
+import os
+import base64
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+import google.generativeai as genai
+from embedding_config import OUTPUT_DIMENSIONALITY
+
+# キャッシュファイルの保存先と上限サイズ (環境変数で上書き可能)
+DEFAULT_CACHE_PATH = os.getenv("GEMINI_EMBEDDING_CACHE", ".embedding_cache.sqlite3")
+DEFAULT_MAX_BYTES = int(os.getenv("GEMINI_EMBEDDING_CACHE_MAX_BYTES", str(1024 ** 3)))
+HASH_CHUNK_BYTES = 1024 * 1024    # ファイルからキーを作るときに一度に読む大きさ
+
+
+def split_payload(content):
+    """
+    embed_content に渡すコンテンツを (MIMEタイプ, ペイロードのバイト列) に分解します。
+    キャッシュできない種類 (アップロード済みファイル等) の場合は None を返します。
+    """
+    if isinstance(content, str):
+        return "text/plain", content.encode("utf-8")
+    if isinstance(content, dict) and "mime_type" in content and "data" in content:
+        data = content["data"]
+        if isinstance(data, str):
+            # Base64文字列はデコードして元のバイト列でキーを作る
+            data = base64.b64decode(data)
+        return content["mime_type"], bytes(data)
+    return None
+
+
+def payload_key(model_name, content, output_dimensionality=None):
+    """
+    (モデル名, MIMEタイプ, ペイロード, 出力次元数) のハッシュからキャッシュキーを作ります。
+    """
+    parts = split_payload(content)
+    if parts is None:
+        return None
+    mime_type, data = parts
+    h = _key_hasher(model_name, mime_type, output_dimensionality)
+    h.update(data)
+    return h.hexdigest()
+
+
+def _key_hasher(model_name, mime_type, output_dimensionality):
+    h = hashlib.sha256()
+    for field in (model_name, mime_type, str(output_dimensionality or "")):
+        h.update(field.encode("utf-8"))
+        h.update(b"\0")
+    return h
+
+
+def file_payload_key(model_name, path, mime_type, output_dimensionality=None, chunk_size=HASH_CHUNK_BYTES):
+    """
+    ファイルの中身を chunk_size ずつ読んで payload_key と同じキーを作ります。
+    動画のような大きなファイルでも、全体をメモリに読み込みません。
+    """
+    h = _key_hasher(model_name, mime_type, output_dimensionality)
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite を使ったコンテンツアドレス型のエンベディングキャッシュ。
+    合計サイズが max_bytes を超えると、最後に参照された時刻が古いものから削除 (LRU) します。
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " key TEXT PRIMARY KEY,"
+            " dim INTEGER NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " nbytes INTEGER NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)"
+        )
+        self._conn.commit()
+        row = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()
+        self.total_bytes = row[0]
+
+    def get(self, key):
+        """キーに対応するベクトルを返します。無ければ None (ミス) です。"""
+        if key is None:
+            self.misses += 1
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+            self.hits += 1
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+
+    def put(self, key, vector):
+        """ベクトルを float32 で保存し、必要なら古いエントリを削除します。"""
+        if key is None:
+            return
+        blob = np.ascontiguousarray(vector, dtype=np.float32).tobytes()
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT nbytes FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, dim, vector, nbytes, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, len(blob) // 4, blob, len(blob), time.time()),
+            )
+            self.total_bytes += len(blob) - (old[0] if old else 0)
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, nbytes FROM embeddings ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, nbytes in rows:
+                self._conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self.total_bytes -= nbytes
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def stats(self):
+        """ヒット数・ミス数・エントリ数・合計サイズを返します。"""
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": count,
+            "bytes": self.total_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_default_cache = None
+
+
+def get_default_cache():
+    """プロセス内で共有するデフォルトのキャッシュを返します。"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = EmbeddingCache()
+    return _default_cache
+
+
+def cached_embed_content(model_name, content, output_dimensionality=OUTPUT_DIMENSIONALITY, cache=None):
+    """
+    genai.embed_content のキャッシュ付き版です。
+    同じ内容が既にキャッシュにあればネットワーク呼び出しを行いません。
+    """
+    cache = cache or get_default_cache()
+    key = payload_key(model_name, content, output_dimensionality)
+    vec = cache.get(key)
+    if vec is not None:
+        return vec
+
+    kwargs = {}
+    if output_dimensionality:
+        kwargs["output_dimensionality"] = output_dimensionality
+    result = genai.embed_content(model=model_name, content=content, **kwargs)
+    vec = np.asarray(result['embedding'], dtype=np.float32)
+    cache.put(key, vec)
+    return vec
+
+
+def print_cache_stats(cache=None):
+    """キャッシュのヒット/ミス状況をターミナルに表示します。"""
+    s = (cache or get_default_cache()).stats()
+    print(f"📦 キャッシュ: ヒット {s['hits']} / ミス {s['misses']} "
+          f"(保存数 {s['entries']}, {s['bytes'] / 1024 ** 2:.1f} MB)")
@@ -0,0 +1,16 @@
+import os
+from dotenv import load_dotenv
+
+# 各スクリプトの load_dotenv() より先に import されるので、.env の設定もここで読み込む
+load_dotenv()
+
+# 全スクリプト共通のエンベディングの設定 (環境変数で変更可能)
+MODEL_NAME = os.getenv("GEMINI_EMBEDDING_MODEL", "models/gemini-embedding-2-preview")
+# 出力の次元数。未設定 (0) ならモデル本来の次元数のまま受け取る
+# 小さくするとストア・インデックス・キャッシュがその分だけ小さくなる (benchmark_dimensionality.py で精度を確認)
+OUTPUT_DIMENSIONALITY = int(os.getenv("GEMINI_OUTPUT_DIMENSIONALITY", "0")) or None
+
+
+def describe_config(model_name=MODEL_NAME, output_dimensionality=OUTPUT_DIMENSIONALITY):
+    """ストアのヘッダーに記録する、ベクトルを作った設定の辞書を返します。"""
+    return {"model": model_name, "output_dimensionality": output_dimensionality}
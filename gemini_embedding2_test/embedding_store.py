@@ -0,0 +1,188 @@
+import os
+import json
+import hashlib
+import numpy as np
+from embedding_config import MODEL_NAME, OUTPUT_DIMENSIONALITY, describe_config
+
+# メタデータ1行分の固定長レコード (ドキュメントID, ページ番号, 内容ハッシュ)
+META_DTYPE = np.dtype([("doc", "<u4"), ("page", "<u4"), ("hash", "S16")])
+DEFAULT_BLOCK_ROWS = 65536
+
+
+def content_hash(data):
+    """ページ画像などのバイト列から 16 バイトの内容ハッシュを作ります。"""
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class EmbeddingStore:
+    """
+    追記専用のページエンベディングストア。
+    ディレクトリ内に以下のファイルを持ちます。
+
+    - header.json     : 次元数と保存形式 (float32 / float16)、ベクトルを作ったモデルと出力次元数
+    - vectors.bin     : L2 正規化済みベクトルを並べた生データ (np.memmap で参照)
+    - meta.bin        : META_DTYPE の固定長レコード (np.memmap で参照)
+    - documents.txt   : ドキュメント名の一覧 (行番号がドキュメントID)
+    - tombstones.bin  : 削除扱いにした行番号 (uint32) の追記ログ
+
+    開くときは header と文書名だけを読み、ベクトルはメモリマップするだけなので
+    ページ数に依存せず O(1) で開けます。
+    """
+
+    def __init__(self, path, dim=None, dtype="float32", config=None):
+        self.path = path
+        header_path = os.path.join(path, "header.json")
+        if os.path.exists(header_path):
+            with open(header_path, encoding="utf-8") as fp:
+                header = json.load(fp)
+            if dim is not None and dim != header["dim"]:
+                raise ValueError(f"次元数が一致しません: ストア={header['dim']}, 指定={dim}")
+        else:
+            if dim is None:
+                raise ValueError("新しいストアを作るには dim の指定が必要です。")
+            os.makedirs(path, exist_ok=True)
+            # config を省略すると embedding_config の現在の設定を記録する
+            header = {"dim": int(dim), "dtype": np.dtype(dtype).name, **(config or describe_config())}
+            with open(header_path, "w", encoding="utf-8") as fp:
+                json.dump(header, fp)
+        self.header = header
+        self.dim = header["dim"]
+        self.dtype = np.dtype(header["dtype"])
+        self.row_bytes = self.dim * self.dtype.itemsize
+
+        self._vectors_path = os.path.join(path, "vectors.bin")
+        self._meta_path = os.path.join(path, "meta.bin")
+        self._docs_path = os.path.join(path, "documents.txt")
+        self._tombstones_path = os.path.join(path, "tombstones.bin")
+        for p in (self._vectors_path, self._meta_path, self._docs_path, self._tombstones_path):
+            if not os.path.exists(p):
+                open(p, "ab").close()
+        with open(self._docs_path, encoding="utf-8") as fp:
+            self.documents = [line.rstrip("\n") for line in fp]
+        self._doc_ids = {name: i for i, name in enumerate(self.documents)}
+        self._vectors = None
+        self._meta = None
+
+    def __len__(self):
+        # 途中で書き込みが中断されても、両方のファイルに揃っている行だけを有効とする
+        return min(os.path.getsize(self._vectors_path) // self.row_bytes,
+                   os.path.getsize(self._meta_path) // META_DTYPE.itemsize)
+
+    @property
+    def vectors(self):
+        """(N, dim) の読み取り専用メモリマップ。"""
+        n = len(self)
+        if self._vectors is None or self._vectors.shape[0] != n:
+            self._vectors = (np.memmap(self._vectors_path, dtype=self.dtype, mode="r",
+                                       shape=(n, self.dim))
+                             if n else np.empty((0, self.dim), dtype=self.dtype))
+        return self._vectors
+
+    @property
+    def meta(self):
+        """(N,) の読み取り専用メモリマップ (META_DTYPE)。"""
+        n = len(self)
+        if self._meta is None or self._meta.shape[0] != n:
+            self._meta = (np.memmap(self._meta_path, dtype=META_DTYPE, mode="r", shape=(n,))
+                          if n else np.empty(0, dtype=META_DTYPE))
+        return self._meta
+
+    def deleted_mask(self):
+        """削除扱いの行を True とするブール配列を返します。"""
+        mask = np.zeros(len(self), dtype=bool)
+        rows = np.fromfile(self._tombstones_path, dtype="<u4")
+        mask[rows[rows < len(mask)]] = True
+        return mask
+
+    def tombstone(self, rows):
+        """行を削除扱いにします。データ自体は追記専用のため残ります。"""
+        rows = np.asarray(list(rows), dtype="<u4")
+        if len(rows):
+            with open(self._tombstones_path, "ab") as fp:
+                fp.write(rows.tobytes())
+
+    def live_pages(self, document):
+        """
+        ドキュメントの有効な (削除扱いでない) ページを {ページ番号: (行番号, 内容ハッシュ)} で返します。
+        同じページが複数あれば後から追記された行を優先します。
+        """
+        if document not in self._doc_ids:
+            return {}
+        meta = self.meta
+        rows = np.flatnonzero((meta["doc"] == self._doc_ids[document]) & ~self.deleted_mask())
+        return {int(meta["page"][r]): (int(r), bytes(meta["hash"][r])) for r in rows}
+
+    def document_id(self, name):
+        """ドキュメント名に対応するIDを返します。未登録なら追加します。"""
+        if name not in self._doc_ids:
+            with open(self._docs_path, "a", encoding="utf-8") as fp:
+                fp.write(name + "\n")
+            self._doc_ids[name] = len(self.documents)
+            self.documents.append(name)
+        return self._doc_ids[name]
+
+    def append(self, document, pages, vectors, hashes):
+        """
+        1つのドキュメントのページベクトルを末尾に追記し、追加した行番号の範囲を返します。
+        ベクトルは保存前に L2 正規化されます。
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors = (vectors / norms).astype(self.dtype)
+
+        meta = np.empty(len(vectors), dtype=META_DTYPE)
+        meta["doc"] = self.document_id(document)
+        meta["page"] = pages
+        meta["hash"] = hashes
+
+        start = len(self)
+        with open(self._vectors_path, "ab") as fp:
+            fp.write(vectors.tobytes())
+        with open(self._meta_path, "ab") as fp:
+            fp.write(meta.tobytes())
+        return range(start, start + len(vectors))
+
+    def check_config(self, model_name=MODEL_NAME, output_dimensionality=OUTPUT_DIMENSIONALITY):
+        """
+        ストアのベクトルと同じモデル・出力次元数で埋め込もうとしているかを確認し、
+        違えば ValueError を送出します (次元数の違うベクトルは比べられないため)。
+        設定を記録していない古いストアでは、出力次元数と dim だけを比べます。
+        """
+        stored = self.header.get("model"), self.header.get("output_dimensionality")
+        if "model" in self.header and stored != (model_name, output_dimensionality):
+            raise ValueError(f"ストア '{self.path}' は {stored[0]} (出力次元数 {stored[1] or '既定'}) で作られています。"
+                             f"現在の設定: {model_name} (出力次元数 {output_dimensionality or '既定'})")
+        if output_dimensionality and output_dimensionality != self.dim:
+            raise ValueError(f"次元数が一致しません: ストア={self.dim}, 出力次元数={output_dimensionality}")
+
+    def describe(self, row):
+        """行番号から (ドキュメント名, ページ番号, 内容ハッシュ16進) を返します。"""
+        rec = self.meta[row]
+        return self.documents[rec["doc"]], int(rec["page"]), rec["hash"].hex()
+
+    def search(self, query, k=10, block_rows=DEFAULT_BLOCK_ROWS):
+        """
+        クエリとのコサイン類似度が高い上位 k 行を (行番号, 類似度) のリストで返します。
+        メモリマップをブロック単位で走査するため、全件を Python オブジェクトにしません。
+        """
+        q = np.asarray(query, dtype=np.float32).ravel()
+        q = q / (np.linalg.norm(q) or 1.0)
+        vectors = self.vectors
+        deleted = self.deleted_mask()
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, len(vectors), block_rows):
+            scores = np.asarray(vectors[start:start + block_rows], dtype=np.float32) @ q
+            scores[deleted[start:start + len(scores)]] = -np.inf
+            rows = np.arange(start, start + len(scores))
+            best_rows = np.concatenate([best_rows, rows])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best_scores) > k:
+                keep = np.argpartition(-best_scores, k)[:k]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+        order = np.argsort(-best_scores)
+        return [(int(best_rows[i]), float(best_scores[i])) for i in order
+                if np.isfinite(best_scores[i])]
@@ -5,6 +5,11 @@ import httpx
 from PIL import Image
 import google.generativeai as genai
 from dotenv import load_dotenv
+from embedding_config import MODEL_NAME
+from embedding_cache import print_cache_stats
+from image_payload import image_payload
+from embedding_batch import embed_batch
+from perceptual_dedup import dedup_embed_content
 
 # .env ファイルがあれば読み込む
 load_dotenv()
@@ -21,7 +26,7 @@ if not api_key:
     exit(1)
 
 genai.configure(api_key=api_key)
-model_name = "models/gemini-embedding-2-preview"
+model_name = MODEL_NAME
 
 # ==========================================
 # 2. ユーティリティ関数
@@ -38,22 +43,12 @@ def compute_cosine_similarity(vec1, vec2):
     v2 = np.array(vec2)
     return np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
 
-import base64
-
 def get_embedding(content):
     if isinstance(content, Image.Image):
-        # 画像をBytesに変換してBase64エンコード
-        buffered = io.BytesIO()
-        content.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        # genaiのembed_contentに渡せるフォーマットに変換
-        content = {"mime_type": "image/jpeg", "data": img_str}
-
-    result = genai.embed_content(
-        model=model_name,
-        content=content
-    )
-    return result['embedding']
+        # 画像を1回だけエンコードしてembed_contentに渡せるフォーマットに変換
+        content = image_payload(content)
+
+    return dedup_embed_content(model_name, content)
 
 # ==========================================
 # 3. Gemini Embedding 2の真価（マルチモーダル・同一空間へのマッピング）をテスト
@@ -87,9 +82,9 @@ for name, img in images.items():
     embeddings[name] = get_embedding(img)
     print(f"{name} のエンベディング取得完了 (次元数: {len(embeddings[name])})")
 
-# テキストのエンベディング
-for text in texts:
-    embeddings[text] = get_embedding(text)
+# テキストのエンベディング (まとめて1回のバッチで送信)
+for text, emb in zip(texts, embed_batch(model_name, texts)):
+    embeddings[text] = emb
     print(f"「{text}」 のエンベディング取得完了")
 
 # ==========================================
@@ -122,4 +117,5 @@ sim_mixed_text = compute_cosine_similarity(interleaved_emb, embeddings["かわ
 print(f"  vs 犬の画像のみ: {sim_mixed_dog:.4f}")
 print(f"  vs かわいい犬の写真(テキストのみ): {sim_mixed_text:.4f}")
 
+print_cache_stats()
 print("\nテスト完了！")
\ No newline at end of file
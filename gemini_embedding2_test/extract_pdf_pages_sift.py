@@ -1,37 +1,35 @@
+import os
 import fitz  # PyMuPDF
 import cv2
-import numpy as np
+from logo_model import LogoModel
+from orb_prefilter import OrbPrefilter
+from page_raster import rasterize_pages
+from template_matching import load_logo_gray
 
-def extract_pages_with_sift(pdf_path, logo_path, output_path, min_match_count=10):
+def extract_pages_with_sift(pdf_path, logo_path, output_path, min_match_count=10, model=None,
+                            prefilter=False):
     """
     OpenCVのSIFT（Scale-Invariant Feature Transform）特徴量マッチングを用いて、
     大きさや回転に依存せず、ロゴが含まれるページのみを含む新しいPDFを作成します。
+    model (LogoModel) を渡すと、多数の PDF を処理するときにロゴの特徴量・FLANN インデックス・
+    ページの特徴量を使い回します。
+    prefilter=True (または OrbPrefilter) を指定すると、ORB 照合でロゴが明らかに
+    無いページを除外し、残ったページだけを SIFT + RANSAC で検証します。
+    ロゴが見つかったページ番号 (0始まり) のリストを返します。
     """
-    # 1. ロゴ画像の読み込みと特徴点抽出
-    logo_img = cv2.imread(logo_path, cv2.IMREAD_UNCHANGED)
-    if logo_img is None:
-        raise FileNotFoundError(f"ロゴ画像が見つかりません: {logo_path}")
-    
-    # 透過PNGへの対応
-    if len(logo_img.shape) == 3 and logo_img.shape[2] == 4:
-        alpha = logo_img[:, :, 3] / 255.0
-        bg = np.ones_like(logo_img[:, :, :3]) * 255
-        fg = logo_img[:, :, :3]
-        for c in range(3):
-            bg[:, :, c] = alpha * fg[:, :, c] + (1 - alpha) * bg[:, :, c]
-        logo_gray = cv2.cvtColor(bg.astype(np.uint8), cv2.COLOR_BGR2GRAY)
-    else:
-        logo_gray = cv2.cvtColor(logo_img, cv2.COLOR_BGR2GRAY) if len(logo_img.shape) == 3 else logo_img
-
-    # SIFT検出器の初期化
-    sift = cv2.SIFT_create()
-    
-    # ロゴ画像から特徴点(keypoints)と特徴量記述子(descriptors)を計算
-    kp_logo, des_logo = sift.detectAndCompute(logo_gray, None)
-    print(f"ロゴ画像から {len(kp_logo)} 個の特徴点を抽出しました。")
-    if des_logo is None or len(kp_logo) < min_match_count:
+    # 1. ロゴモデルの準備
+    # 特徴点・記述子・FLANN インデックスはモデルファイルに保存済みならそれを使い、
+    # ロゴ画像が変わっていたときだけ計算し直す
+    model = model or LogoModel()
+    label = model.add_logo(logo_path)
+    kp_logo, _ = model.logos()[label]
+    print(f"ロゴ '{label}' の特徴点: {len(kp_logo)} 個")
+    if len(kp_logo) < min_match_count:
          print("⚠️ エラー: ロゴ画像から十分な特徴点が抽出できませんでした。もっと複雑な画像が必要です。")
-         return
+         return []
+    _, logo_points, owners, labels = model.index()
+    if prefilter is True:
+        prefilter = OrbPrefilter({label: load_logo_gray(logo_path)})
 
     # 2. PDFの読み込みと出力用PDFの準備
     try:
@@ -45,67 +43,59 @@ def extract_pages_with_sift(pdf_path, logo_path, output_path, min_match_count=10
     print(f"\nPDFを読み込みました: 全 {len(doc)} ページ")
     print("SIFT特徴量マッチングによる検索を開始します...")
 
-    # 高速な近似近傍探索（FLANN）のパラメータ設定
-    FLANN_INDEX_KDTREE = 1
-    index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-    search_params = dict(checks=50) # 精度と速度のトレードオフ
-    flann = cv2.FlannBasedMatcher(index_params, search_params)
-
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        
-        # ページを画像としてレンダリング (zoom=2.0で高解像度化)
-        zoom = 2.0
-        mat = fitz.Matrix(zoom, zoom)
-        pix = page.get_pixmap(matrix=mat, alpha=False)
-        img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
+    # ページのレンダリングは複数プロセスで並列に行い (zoom=2.0で高解像度化)、ページ順に受け取る
+    for page_num, img_array in rasterize_pages(pdf_path, zoom=2.0):
         page_gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
 
-        # ページ画像から特徴点と記述子を計算
-        kp_page, des_page = sift.detectAndCompute(page_gray, None)
+        # 前段: 縮小ページの ORB 照合でロゴが明らかに無いページは SIFT を計算せずに除外
+        if prefilter and not prefilter.candidates(page_gray):
+            print(f"❌ ページ {page_num + 1} はスキップ (ORB 前段フィルタで除外)")
+            continue
+
+        # ページ画像から特徴点と記述子を計算 (同じ画素のページはモデルのキャッシュから読む)
+        kp_page, des_page = model.page_features(page_gray)
         
-        if des_page is None or len(kp_page) == 0:
+        if len(kp_page) == 0:
             print(f"❌ ページ {page_num + 1} はスキップ (特徴点なし)")
             continue
 
-        # 特徴量マッチング（FLANN）
-        matches = flann.knnMatch(des_logo, des_page, k=2)
-
-        # Lowe's ratio test (シンプルな図形向けに0.75に緩める)
-        good_matches = []
-        for match in matches:
-            if len(match) == 2:
-                m, n = match
-                if m.distance < 0.75 * n.distance:
-                    good_matches.append(m)
+        # 特徴量マッチング: ページの各記述子を学習済みのロゴのインデックス (FLANN) で検索し、
+        # Lowe's ratio test を通ったもののうち、このロゴに対応するものだけを使う
+        page_idx, logo_idx, owner = model.match(des_page)
+        keep = owner == labels.index(label)
+        page_idx, logo_idx = page_idx[keep], logo_idx[keep]
+        good_count = len(page_idx)
         
         # 良いマッチが閾値以上見つかった場合、さらに幾何学的チェック(Homography)を行う
-        if len(good_matches) >= min_match_count:
+        if good_count >= min_match_count:
             # 良いマッチング点から座標を取得
-            src_pts = np.float32([kp_logo[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-            dst_pts = np.float32([kp_page[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
+            src_pts = logo_points[logo_idx].reshape(-1, 1, 2)
+            dst_pts = kp_page[page_idx, :2].reshape(-1, 1, 2)
             
             # ホモグラフィ行列（平面射影変換）の推定（RANSACで外れ値を除外）
             M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
             
             if M is not None:
                 # 正常な変換行列が求まった場合は、形状として見つかったと判定
-                matchesMask = mask.ravel().tolist()
-                inlier_count = sum(matchesMask)
+                inlier_count = int(mask.sum())
                 
                 # インライア（外れ値を除外した正しい対応点）の数で最終判定
                 # 数学的に4点以上あれば図形の変形が証明できます
                 if inlier_count >= min_match_count:
-                    print(f"✅ ページ {page_num + 1} にロゴを発見 (良いマッチ数: {len(good_matches)}, 形状一致点: {inlier_count})")
+                    print(f"✅ ページ {page_num + 1} にロゴを発見 (良いマッチ数: {good_count}, 形状一致点: {inlier_count})")
                     found_pages.append(page_num)
                     extracted_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
                     continue
                 else:
-                    print(f"❌ ページ {page_num + 1} はスキップ (形状チェック不合格: {inlier_count} / {len(good_matches)})")
+                    print(f"❌ ページ {page_num + 1} はスキップ (形状チェック不合格: {inlier_count} / {good_count})")
             else:
                 print(f"❌ ページ {page_num + 1} はスキップ (図形の変形が計算不可)")
         else:
-            print(f"❌ ページ {page_num + 1} はスキップ (良いマッチ数: {len(good_matches)})")
+            print(f"❌ ページ {page_num + 1} はスキップ (良いマッチ数: {good_count})")
+
+    print_page_cache_stats(model)
+    if prefilter:
+        prefilter.report()
 
     # 3. 抽出結果の保存
     if found_pages:
@@ -116,6 +106,82 @@ def extract_pages_with_sift(pdf_path, logo_path, output_path, min_match_count=10
         
     doc.close()
     extracted_doc.close()
+    return found_pages
+
+def print_page_cache_stats(model):
+    s = model.stats()
+    print(f"📦 ページ特徴量キャッシュ: ヒット {s['page_hits']} / ミス {s['page_misses']} "
+          f"(保存数 {s['pages']}, {s['page_bytes'] / 1024 ** 2:.1f} MB)")
+
+def extract_pages_with_logos(pdf_path, logo_paths, min_match_count=10, model=None, output_pattern=None,
+                             prefilter=False):
+    """
+    複数のロゴを1回の走査で探します。各ページのレンダリングと SIFT 特徴量の計算は1回だけで、
+    全ロゴの記述子をまとめた1つの FLANN インデックス (記述子ごとにロゴのラベルを記録) で
+    照合するため、処理時間はロゴ数ではなくページ数に比例します。
+
+    logo_paths は {ラベル: 画像パス} またはパスのリスト (ラベルはファイル名) です。
+    {ラベル: ロゴが見つかったページ番号 (0始まり) のリスト} を返し、output_pattern
+    (例: "extracted_{label}.pdf") を指定するとロゴごとに抽出したPDFも保存します。
+    prefilter=True なら ORB の前段フィルタで候補のロゴが残ったページ・ロゴだけを SIFT で検証します。
+    """
+    if not isinstance(logo_paths, dict):
+        # LogoModel.add_logo の既定と同じく、拡張子を除いたファイル名をラベルにする
+        logo_paths = {os.path.splitext(os.path.basename(path))[0]: path for path in logo_paths}
+    model = model or LogoModel()
+    targets = [model.add_logo(path, label) for label, path in logo_paths.items()]
+    _, logo_points, _, labels = model.index()
+    # インデックスには過去に登録した他のロゴも含まれるので、今回探すロゴだけを対象にする
+    wanted = {labels.index(label): label for label in targets}
+    found = {label: [] for label in targets}
+    if prefilter is True:
+        prefilter = OrbPrefilter({label: load_logo_gray(path)
+                                  for label, path in zip(targets, logo_paths.values())})
+
+    print(f"PDFを読み込みました: {pdf_path} / ロゴ {len(targets)} 種類を同時に検索します...")
+    for page_num, img_array in rasterize_pages(pdf_path, zoom=2.0):
+        page_gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        candidates = prefilter.candidates(page_gray) if prefilter else set(targets)
+        if not candidates:
+            continue
+        kp_page, des_page = model.page_features(page_gray)
+        if len(kp_page) == 0:
+            continue
+
+        # 1回の検索で全ロゴとの対応が得られるので、ロゴ番号ごとに分けて形状チェックする
+        page_idx, logo_idx, owner = model.match(des_page)
+        for logo_id, label in wanted.items():
+            if label not in candidates:
+                continue
+            keep = owner == logo_id
+            if keep.sum() < min_match_count:
+                continue
+            src_pts = logo_points[logo_idx[keep]].reshape(-1, 1, 2)
+            dst_pts = kp_page[page_idx[keep], :2].reshape(-1, 1, 2)
+            M, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
+            if M is not None and mask.sum() >= min_match_count:
+                print(f"✅ ページ {page_num + 1} にロゴ '{label}' を発見 "
+                      f"(良いマッチ数: {int(keep.sum())}, 形状一致点: {int(mask.sum())})")
+                found[label].append(page_num)
+
+    print_page_cache_stats(model)
+    if prefilter:
+        prefilter.report()
+    print("\n--- ロゴごとの結果 ---")
+    for label, pages in found.items():
+        print(f"{label}: {len(pages)} ページ {[p + 1 for p in pages]}")
+
+    if output_pattern:
+        with fitz.open(pdf_path) as doc:
+            for label, pages in found.items():
+                if not pages:
+                    continue
+                extracted_doc = fitz.open()
+                for page_num in pages:
+                    extracted_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
+                extracted_doc.save(output_pattern.format(label=label))
+                extracted_doc.close()
+    return found
 
 if __name__ == "__main__":
     PDF_FILE = "sample.pdf"                 # 対象のPDFファイル
@@ -125,8 +191,19 @@ if __name__ == "__main__":
     # 画像内の特徴点が何個以上(相似な配置で)一致したら「ロゴあり」とするかの閾値
     # OpenAIのロゴようなシンプルな図形は抽出される特徴点が少ないため下げます
     MIN_MATCH_COUNT = 4 
+    MODEL_FILE = "logo_model.sqlite3"       # ロゴの特徴量・インデックス・ページ特徴量のキャッシュ
+    # 複数のロゴを1回の走査で探す場合は {ラベル: 画像パス} を指定 (例: {"a": "logo_a.png", "b": "logo_b.png"})
+    LOGO_FILES = None
+    # ORB の前段フィルタでロゴが明らかに無いページを先に除外する (小さなロゴは見逃すことがあるので、
+    # benchmark_sift_cascade.py で除外率と見逃し数を確かめてから有効にする)
+    PREFILTER = False
     
     try:
-        extract_pages_with_sift(PDF_FILE, LOGO_FILE, OUTPUT_FILE, MIN_MATCH_COUNT)
+        if LOGO_FILES:
+            extract_pages_with_logos(PDF_FILE, LOGO_FILES, MIN_MATCH_COUNT, LogoModel(MODEL_FILE),
+                                     output_pattern="extracted_{label}.pdf", prefilter=PREFILTER)
+        else:
+            extract_pages_with_sift(PDF_FILE, LOGO_FILE, OUTPUT_FILE, MIN_MATCH_COUNT, LogoModel(MODEL_FILE),
+                                    prefilter=PREFILTER)
     except Exception as e:
         print(f"プログラム実行中にエラーが発生しました: {e}")
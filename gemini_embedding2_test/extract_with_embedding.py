@@ -1,11 +1,21 @@
 import os
-import io
 import fitz  # PyMuPDF
 from PIL import Image
-import numpy as np
-import base64
 import google.generativeai as genai
 from dotenv import load_dotenv
+from embedding_config import MODEL_NAME
+from embedding_cache import print_cache_stats
+from image_payload import image_payload
+from async_embedding_client import DEFAULT_MAX_IN_FLIGHT, SharedEmbeddingClient
+from embedding_batch import MAX_BATCH_ITEMS
+from similarity_engine import similarity_matrix
+from embedding_store import EmbeddingStore
+from page_pipeline import embed_pdf_pages
+from page_raster import EMBED_MAX_PIXELS
+from ann_index import DEFAULT_NPROBE, IVFPQIndex
+from quantized_index import QuantizedIndex
+from perceptual_dedup import dedup_embed_content, deduplicated, print_dedup_stats
+from tile_embeddings import TILE_GRIDS, embed_pdf_tiles, print_tile_stats
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -19,36 +29,29 @@ if not api_key:
     exit(1)
 
 genai.configure(api_key=api_key)
-model_name = "models/gemini-embedding-2-preview"
+model_name = MODEL_NAME
 
-def compute_cosine_similarity(vec1, vec2):
-    v1 = np.array(vec1)
-    v2 = np.array(vec2)
-    return np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2))
-
-def compute_cosine_distance(vec1, vec2):
-    """コサイン距離 (1 - 類似度) を計算します。"""
-    return 1.0 - compute_cosine_similarity(vec1, vec2)
+def to_payload(content):
+    """画像であればembed_contentに渡せるJPEG形式に変換します。"""
+    if isinstance(content, Image.Image):
+        # 画像を1回だけエンコードしてembed_contentに渡せるフォーマットに変換
+        content = image_payload(content)
+    return content
 
 def get_embedding(content):
-    if isinstance(content, Image.Image):
-        # 画像をBytesに変換してBase64エンコード
-        buffered = io.BytesIO()
-        content.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        # genaiのembed_contentに渡せるフォーマットに変換
-        content = {"mime_type": "image/jpeg", "data": img_str}
-        
-    result = genai.embed_content(
-        model=model_name,
-        content=content
-    )
-    return np.array(result['embedding'])
+    return dedup_embed_content(model_name, to_payload(content))
 
-def analyze_pdf_distances(pdf_path, target_image_path=None, target_text=None):
+def analyze_pdf_distances(pdf_path, target_image_path=None, target_text=None, store_dir=None,
+                          max_pixels=EMBED_MAX_PIXELS, grayscale=False, tiled=False,
+                          tile_grids=TILE_GRIDS):
     """
     PDF内の全てのページのエンベディングを取得し、
     ターゲットとの距離およびページ間の距離マトリックスを計算・表示します。
+    store_dir を指定すると、ページのエンベディングを EmbeddingStore に追記して残します。
+    max_pixels はページあたりの画素数の上限 (None なら zoom=2.0)、grayscale=True でグレースケール描画です。
+    tiled=True なら、ページを重なりのあるタイル (tile_grids 分割) に分けて埋め込み、
+    タイルの類似度の最大値でもページを順位付けします (小さなロゴの検索向け)。
+    store_dir を指定した場合、タイルのインデックスは store_dir/tiles.npz に保存します。
     """
     if not target_image_path and not target_text:
         print("検索対象の画像パスまたはテキストの少なくとも一方を指定してください。")
@@ -62,19 +65,40 @@ def analyze_pdf_distances(pdf_path, target_image_path=None, target_text=None):
         print(f"❌ PDFが開けません: {e}")
         return
 
-    all_items = [] # {"emb": embedding, "label": label}
+    all_items = [] # {"emb": embedding, "label": label, "page": page_num}
     
     # PDF各ページのエンベディング
-    for page_num in range(len(doc)):
-        print(f"\r📄 ページ {page_num + 1} / {len(doc)} を解析中...", end="")
-        page = doc[page_num]
-        pix = page.get_pixmap(matrix=fitz.Matrix(2.0, 2.0), alpha=False)
-        img_data = pix.tobytes("png")
-        page_img = Image.open(io.BytesIO(img_data)).convert("RGB")
-        
-        emb = get_embedding(page_img)
-        all_items.append({"emb": emb, "label": f"Page {page_num + 1}"})
+    # レンダリング → エンコード → エンベディング → 保存 を段ごとに並行させるパイプラインで処理する
+    print(f"📄 全 {len(doc)} ページを解析中...")
+    # 埋め込みのワーカースレッド (とタイル) で1つのクライアントを共有し、
+    # 同時リクエスト数とレートの制御 (AIMD) を1か所にまとめる
+    client = SharedEmbeddingClient(api_key=api_key)
+    embed_fn = deduplicated(client)
+    page_embs, pipeline = embed_pdf_pages(
+        pdf_path, model_name, zoom=2.0, store_dir=store_dir, embed_fn=embed_fn,
+        max_pixels=max_pixels, grayscale=grayscale
+    )
+    for page_num, emb in page_embs:
+        all_items.append({"emb": emb, "label": f"Page {page_num + 1}", "page": page_num + 1})
     print("\n✅ PDF全ページのエンベディング取得完了")
+    pipeline.report()
+    print_cache_stats()
+    print_dedup_stats()
+    if store_dir and page_embs:
+        print(f"💾 ストア '{store_dir}' に保存しました (合計 {len(EmbeddingStore(store_dir))} ページ)")
+
+    tile_index = None
+    if tiled:
+        print(f"\n🧱 タイル単位のエンベディングを取得中 (分割: {tile_grids})...")
+        # 1回の呼び出しで、クライアントの同時リクエスト数いっぱいのバッチを送る
+        tile_index, tile_stats = embed_pdf_tiles(
+            pdf_path, model_name, grids=tile_grids, grayscale=grayscale, embed_fn=embed_fn,
+            batch_size=MAX_BATCH_ITEMS * DEFAULT_MAX_IN_FLIGHT
+        )
+        print_tile_stats(tile_stats)
+        if store_dir:
+            tile_index.save(os.path.join(store_dir, "tiles.npz"))
+    client.close()
 
     # --- 2. ターゲットのエンベディング取得 ---
     print("\n--- 検索ターゲットのエンベディング取得 ---")
@@ -96,12 +120,8 @@ def analyze_pdf_distances(pdf_path, target_image_path=None, target_text=None):
 
     # --- 3. マトリックス計算 (全要素間のコサイン距離) ---
     num_elements = len(all_items)
-    dist_matrix = np.zeros((num_elements, num_elements))
     labels = [item["label"] for item in all_items]
-    
-    for i in range(num_elements):
-        for j in range(num_elements):
-            dist_matrix[i, j] = compute_cosine_distance(all_items[i]["emb"], all_items[j]["emb"])
+    dist_matrix = similarity_matrix([item["emb"] for item in all_items], distance=True)
 
     # --- 4. 結果の可視化とレポート ---
     print("\n--- 類似度解析レポート ---")
@@ -122,8 +142,9 @@ def analyze_pdf_distances(pdf_path, target_image_path=None, target_text=None):
     for t_idx in target_indices:
         print(f"\n【{labels[t_idx]} と各ページのコサイン距離】")
         page_dists = []
-        for i in range(len(doc)):
-            page_dists.append((i + 1, dist_matrix[t_idx, i]))
+        for i, item in enumerate(all_items):
+            if "page" in item:
+                page_dists.append((item["page"], dist_matrix[t_idx, i]))
         
         # 距離が近い順 (昇順) にソート
         page_dists.sort(key=lambda x: x[1])
@@ -131,15 +152,71 @@ def analyze_pdf_distances(pdf_path, target_image_path=None, target_text=None):
         for rank, (p_num, d) in enumerate(page_dists):
             print(f"{rank + 1}位: ページ {p_num:2d} (距離: {d:.4f})")
 
+        if tile_index is not None:
+            print(f"\n【{labels[t_idx]} と各ページのタイル単位の距離 (ページ内の最小値)】")
+            hits = tile_index.search_pages(all_items[t_idx]["emb"], k=len(doc))
+            for rank, (page_num, sim, (x0, y0, x1, y1)) in enumerate(hits):
+                print(f"{rank + 1}位: ページ {page_num + 1:2d} (距離: {1.0 - sim:.4f}, "
+                      f"タイル x={x0:.2f}-{x1:.2f} y={y0:.2f}-{y1:.2f})")
+
     doc.close()
 
+def search_store(store_dir, target_image_path=None, target_text=None, k=10,
+                 index_path=None, nprobe=DEFAULT_NPROBE, quantized=None):
+    """
+    保存済みの EmbeddingStore に対してターゲットを検索し、上位 k ページを表示します。
+    距離行列は作らず、メモリマップ上のベクトルを直接走査します。
+    index_path に IVFPQIndex を指定すると近似最近傍探索を使います (nprobe で精度と速度を調整)。
+    quantized に "int8" / "binary" を指定すると量子化したベクトルで候補を絞り、
+    候補だけを元のベクトルで並べ直します (量子化インデックスはストアの隣に保存されます)。
+    """
+    store = EmbeddingStore(store_dir)
+    store.check_config(model_name)
+    index = IVFPQIndex.load(index_path) if index_path else None
+    if index is not None and index.dim != store.dim:
+        raise ValueError(f"インデックス '{index_path}' の次元数 {index.dim} がストアの {store.dim} と一致しません。"
+                         "出力次元数を変えたらインデックスを作り直してください。")
+    qindex = QuantizedIndex.for_store(store, quantized) if quantized else None
+    targets = []
+    if target_image_path and os.path.exists(target_image_path):
+        targets.append(("Target (Img)", Image.open(target_image_path).convert("RGB")))
+    if target_text:
+        targets.append(("Target (Txt)", target_text))
+
+    for label, target in targets:
+        query = get_embedding(target)
+        print(f"\n【{label} に近いページ (全 {len(store)} ページ中)】")
+        if index is not None:
+            # インデックス作成後に削除扱いになった行は除外する
+            deleted = store.deleted_mask()
+            ids, sims = index.search(query, k=k * 2, nprobe=nprobe, rerank_vectors=store.vectors)
+            hits = [(row, sim) for row, sim in zip(ids, sims) if not deleted[row]][:k]
+        elif qindex is not None:
+            ids, sims = qindex.search(query, k=k, rerank_vectors=store.vectors, deleted=store.deleted_mask())
+            hits = list(zip(ids, sims))
+        else:
+            hits = store.search(query, k=k)
+        for rank, (row, score) in enumerate(hits):
+            document, page, _ = store.describe(row)
+            print(f"{rank + 1}位: {document} ページ {page:2d} (距離: {1.0 - score:.4f})")
+
 if __name__ == "__main__":
     PDF_FILE = "sample.pdf"                 # 検索対象のPDF
     LOGO_IMAGE = "logo.png"                 # 検索したいロゴ画像
     SEARCH_TEXT = None                      # 必要に応じてテキストを指定
+    STORE_DIR = None                        # 例: "page_store" を指定するとページベクトルを保存
+    MAX_PIXELS = EMBED_MAX_PIXELS           # 1ページあたりの画素数の上限 (None なら zoom=2.0 のまま)
+    GRAYSCALE = False                       # 色が不要な文書なら True でグレースケール描画
+    TILED = False                           # True でタイル単位でも埋め込む (小さなロゴ向け)
+    TILE_GRIDS = TILE_GRIDS                 # タイルの分割数 (例: (2, 3) で2段階の縮尺)
     
     analyze_pdf_distances(
         pdf_path=PDF_FILE,
         target_image_path=LOGO_IMAGE, 
-        target_text=SEARCH_TEXT
+        target_text=SEARCH_TEXT,
+        store_dir=STORE_DIR,
+        max_pixels=MAX_PIXELS,
+        grayscale=GRAYSCALE,
+        tiled=TILED,
+        tile_grids=TILE_GRIDS
     )
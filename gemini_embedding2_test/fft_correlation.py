@@ -0,0 +1,138 @@
+from collections import OrderedDict
+import cv2
+import numpy as np
+from template_matching import as_templates
+
+DEFAULT_CACHED_SPECTRA = 16   # 保持するロゴのスペクトル数 (1つあたりページと同じ大きさの float32)
+
+
+class PageSpectrum:
+    """
+    1ページ分の周波数領域の表現。ページの DFT と、窓内の画素和・二乗和を
+    O(1) で求めるための積分画像を持ち、全縮尺・全ロゴで使い回します。
+    """
+
+    def __init__(self, page_gray):
+        self.shape = page_gray.shape[:2]
+        h, w = self.shape
+        self.dft_shape = (cv2.getOptimalDFTSize(h), cv2.getOptimalDFTSize(w))
+        padded = np.zeros(self.dft_shape, dtype=np.float32)
+        padded[:h, :w] = page_gray
+        self.spectrum = cv2.dft(padded)
+        self.sum, self.sqsum = cv2.integral2(page_gray, sdepth=cv2.CV_64F, sqdepth=cv2.CV_64F)
+
+    def window_std(self, th, tw):
+        """
+        全ての (th, tw) 窓について、平均を引いた画素値の L2 ノルム
+        (sqrt(二乗和 - 和^2 / 画素数)) を float32 で返します。
+        """
+        h, w = self.shape
+
+        def box(integral):
+            out = integral[th:h + 1, tw:w + 1] - integral[:h - th + 1, tw:w + 1]
+            out -= integral[th:h + 1, :w - tw + 1]
+            out += integral[:h - th + 1, :w - tw + 1]
+            return out
+
+        sums = box(self.sum)
+        variance = box(self.sqsum)
+        sums *= sums
+        sums /= th * tw
+        variance -= sums
+        np.maximum(variance, 0.0, out=variance)
+        return np.sqrt(variance).astype(np.float32)
+
+
+class FFTCorrelator:
+    """
+    周波数領域でのマルチスケール正規化相互相関 (TM_CCOEFF_NORMED と同じ値)。
+
+    - ページの DFT はページごとに1回だけ計算し、全縮尺・複数ロゴで共有する
+    - 分子 (ページと平均を引いたロゴの相互相関) はスペクトルの積の逆 DFT で求める
+    - 分母 (窓内の分散とロゴのノルム) は積分画像とロゴの統計量から求める
+    - ロゴのスペクトルは直近 max_cached 個をキャッシュし、同じ大きさのページで再利用する
+    """
+
+    def __init__(self, max_cached=DEFAULT_CACHED_SPECTRA):
+        self.max_cached = max_cached
+        self._spectra = OrderedDict()
+
+    def _template_spectrum(self, templates, scale, template, dft_shape):
+        key = (id(templates), round(float(scale), 6), dft_shape)
+        spectrum = self._spectra.get(key)
+        if spectrum is None:
+            th, tw = template.shape
+            padded = np.zeros(dft_shape, dtype=np.float32)
+            padded[:th, :tw] = template - template.mean(dtype=np.float64)
+            spectrum = cv2.dft(padded)
+            self._spectra[key] = spectrum
+            if len(self._spectra) > self.max_cached:
+                self._spectra.popitem(last=False)
+        else:
+            self._spectra.move_to_end(key)
+        return spectrum
+
+    def correlate(self, page, templates, scale):
+        """
+        page (PageSpectrum) と縮尺 scale のロゴの NCC マップを返します。
+        形状は cv2.matchTemplate と同じ (H - h + 1, W - w + 1) で、ロゴがページより
+        大きい場合や無地の場合は None です。
+        """
+        template, stats = templates.get(scale)
+        h, w = page.shape
+        if template is None or template.shape[0] > h or template.shape[1] > w:
+            return None
+        th, tw = template.shape
+        _, norm = stats
+
+        spectrum = self._template_spectrum(templates, scale, template, page.dft_shape)
+        product = cv2.mulSpectrums(page.spectrum, spectrum, 0, conjB=True)
+        # 有効な位置 (ロゴがページに収まる位置) ではページ側の折り返しが起きないので、
+        # パディングは DFT が速くなる大きさにするだけでよい
+        numerator = cv2.idft(product, flags=cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)[:h - th + 1, :w - tw + 1]
+
+        denominator = page.window_std(th, tw)
+        denominator *= norm
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ncc = numerator / denominator
+        # OpenCV の TM_CCOEFF_NORMED と同じく、|分子| が分母をわずかに超える窓は ±1、
+        # 大きく超える窓 (無地の領域など分母がほぼ 0) は 0 とする
+        magnitude = np.abs(ncc)
+        if not (magnitude < 1.0).all():
+            ncc[magnitude >= 1.0] = np.sign(ncc[magnitude >= 1.0])
+            ncc[~(magnitude < 1.125)] = 0.0
+        return ncc
+
+
+def match_fft(page_gray, logo, threshold, scales=None, correlator=None, page=None):
+    """
+    FFT による相関で全縮尺を原寸のまま探索します。match_brute_force と同じく
+    しきい値を超えた時点で打ち切り、(スコア, 縮尺, 左上座標) を返します。
+    page に PageSpectrum を渡すと、ページの DFT を作り直さずに済みます。
+    """
+    templates = as_templates(logo, scales)
+    scales = templates.scales if scales is None else scales
+    correlator = correlator or FFTCorrelator()
+    page = page or PageSpectrum(page_gray)
+    best = (-1.0, 1.0, None)
+    for scale in scales:
+        ncc = correlator.correlate(page, templates, scale)
+        if ncc is None:
+            continue
+        _, max_val, _, max_loc = cv2.minMaxLoc(ncc)
+        if max_val > best[0]:
+            best = (max_val, scale, max_loc)
+        if max_val >= threshold:
+            return max_val, scale, max_loc
+    return best
+
+
+def match_fft_many(page_gray, logos, threshold, correlator=None):
+    """
+    複数のロゴ ({ラベル: ロゴ画像または LogoTemplates}) を、1回のページ DFT で探索します。
+    {ラベル: (スコア, 縮尺, 左上座標)} を返します。
+    """
+    correlator = correlator or FFTCorrelator()
+    page = PageSpectrum(page_gray)
+    return {label: match_fft(page_gray, logo, threshold, correlator=correlator, page=page)
+            for label, logo in logos.items()}
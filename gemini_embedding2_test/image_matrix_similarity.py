@@ -1,10 +1,14 @@
 import os
-import io
-import numpy as np
-import base64
-from PIL import Image
+import tempfile
 import google.generativeai as genai
 from dotenv import load_dotenv
+from embedding_config import MODEL_NAME, describe_config
+from embedding_cache import print_cache_stats
+from embedding_store import EmbeddingStore, content_hash
+from image_payload import image_payload
+from embedding_batch import embed_batch
+from perceptual_dedup import deduplicated, print_dedup_stats
+from similarity_engine import similarity_matrix, topk_join_to_disk
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -17,32 +21,71 @@ if not api_key:
     exit(1)
 
 genai.configure(api_key=api_key)
-model_name = "models/gemini-embedding-2-preview"
+model_name = MODEL_NAME
 
-def get_embedding(image_path):
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+HEATMAP_MAX_IMAGES = 30   # これを超える枚数ではヒートマップを作らず、上位 k 件の類似度結合に切り替える
+EMBED_CHUNK = 512         # 一度に読み込んで埋め込む画像の数 (メモリに持つペイロードはこの枚数分だけ)
+
+def load_image_payload(image_path):
+    """
+    画像ファイルを読み込み、embed_contentに渡せるJPEG形式に変換します。
+    """
+    return image_payload(image_path)
+
+def list_images(image_dir):
+    """フォルダ内の画像ファイルを名前順に返します。"""
+    return sorted(os.path.join(image_dir, f) for f in os.listdir(image_dir)
+                  if f.lower().endswith(IMAGE_EXTENSIONS))
+
+def embed_images_to_store(image_files, store_dir, chunk_size=EMBED_CHUNK):
+    """
+    画像を chunk_size 枚ずつ読み込んで埋め込み、store_dir の EmbeddingStore に追記します。
+    ペイロードとベクトルはチャンク分しかメモリに持たないので、枚数が多くてもメモリは増えません
+    (ほぼ同一の画像は代表の1枚だけ送ります)。
+    (ストアの行番号順のファイル名のリスト, ストア) を返します。1枚も埋め込めなければストアは None です。
+    """
+    embed_fn = deduplicated(embed_batch)
+    store, names = None, []
+    for start in range(0, len(image_files), chunk_size):
+        payloads, loaded_files = [], []
+        for f in image_files[start:start + chunk_size]:
+            try:
+                payloads.append(load_image_payload(f))
+                loaded_files.append(f)
+            except Exception as e:
+                print(f"❌ '{f}' の読み込みエラー: {e}")
+
+        done = [(os.path.basename(f), emb) for f, emb in zip(loaded_files, embed_fn(model_name, payloads))
+                if emb is not None]
+        if done:
+            if store is None:
+                store = EmbeddingStore(store_dir, dim=len(done[0][1]), config=describe_config(model_name))
+            store.append("images", range(len(names), len(names) + len(done)), [emb for _, emb in done],
+                         [content_hash(name) for name, _ in done])
+            names.extend(name for name, _ in done)
+        print(f"✅ {min(start + chunk_size, len(image_files))} / {len(image_files)} 枚を処理 "
+              f"(埋め込み済み {len(names)} 枚)")
+    return names, store
+
+def run_similarity_join(vectors, names, k, output_prefix, normalized=False):
     """
-    画像からエンベディングを取得します。
+    N×N の行列を作らず、各画像に似ている上位 k 枚だけを求めて .npy に書き出します。
+    クエリのブロックごとに全画像と比べ、結果を逐次ファイルへ書き込みます。
+    vectors には EmbeddingStore.vectors などのメモリマップをそのまま渡せます
+    (正規化済みなら normalized=True で正規化したコピーを作りません)。
     """
-    try:
-        img = Image.open(image_path).convert("RGB")
-        # 画像をBytesに変換してBase64エンコード
-        buffered = io.BytesIO()
-        img.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        content = {"mime_type": "image/jpeg", "data": img_str}
-        
-        result = genai.embed_content(
-            model=model_name,
-            content=content
-        )
-        return np.array(result['embedding'])
-    except Exception as e:
-        print(f"❌ '{image_path}' の取得エラー: {e}")
-        return None
-
-def main():
-    # 比較する画像のリストをユーザー指定のものに固定
-    image_files = [
+    print(f"\n--- 類似度結合 (上位 {k} 件) を計算中 ---")
+    ids, scores = topk_join_to_disk(output_prefix, vectors, k=k, normalized=normalized)
+    print(f"🎉 近傍を '{output_prefix}_ids.npy' / '{output_prefix}_scores.npy' に保存しました。")
+    print("\n【類似度結合の例 (先頭5枚)】")
+    for i in range(min(5, len(names))):
+        neighbours = ", ".join(f"{names[j]} ({s:.3f})" for j, s in zip(ids[i][:3], scores[i][:3]) if j >= 0)
+        print(f"{names[i]}: {neighbours}")
+
+def main(image_dir=None, top_k=10, join_output="similarity_join"):
+    # 比較する画像のリスト (image_dir を指定するとフォルダ内の全画像)
+    image_files = list_images(image_dir) if image_dir else [
         "image1.png",
         "image2.png",
         "image3.png",
@@ -57,28 +100,27 @@ def main():
         return
 
     print(f"--- {len(image_files)} 枚の画像のエンベディングを取得中 ---")
-    
-    embeddings = []
-    valid_files = []
-    
-    for f in image_files:
-        emb = get_embedding(f)
-        if emb is not None:
-            embeddings.append(emb)
-            valid_files.append(os.path.basename(f))
-            print(f"✅ {f} 完了")
-
-    # 類似度マトリックスの計算
-    num_images = len(embeddings)
-    matrix = np.zeros((num_images, num_images))
-    
-    for i in range(num_images):
-        for j in range(num_images):
-            # コサイン類似度
-            dot = np.dot(embeddings[i], embeddings[j])
-            norm_i = np.linalg.norm(embeddings[i])
-            norm_j = np.linalg.norm(embeddings[j])
-            matrix[i, j] = dot / (norm_i * norm_j)
+
+    # ベクトルは一時的な EmbeddingStore (ディスク上のメモリマップ) に貯め、メモリには持たない
+    with tempfile.TemporaryDirectory() as store_dir:
+        valid_files, store = embed_images_to_store(image_files, store_dir)
+        print_cache_stats()
+        print_dedup_stats()
+
+        # 類似度マトリックスの計算
+        num_images = len(valid_files)
+        if num_images < 2:
+            print("比較には少なくとも2枚以上の画像が必要です。")
+            return
+        if num_images > HEATMAP_MAX_IMAGES:
+            # ストアのベクトルは L2 正規化済み
+            run_similarity_join(store.vectors, valid_files, min(top_k, num_images - 1), join_output,
+                                normalized=True)
+            del store   # Windows では memmap を閉じないと一時フォルダを消せない
+            return
+        # コサイン類似度 (一度だけ正規化し、行列積でまとめて計算)
+        matrix = similarity_matrix(store.vectors)
+        del store
 
     print("\n--- 類似度マトリックスを作成中 ---")
     
@@ -103,4 +145,8 @@ def main():
         print(row_str)
 
 if __name__ == "__main__":
-    main()
+    IMAGE_DIR = None                # 例: "catalogue" を指定するとフォルダ内の全画像を比較
+    TOP_K = 10                      # 類似度結合で残す近傍の数
+    JOIN_OUTPUT = "similarity_join" # 類似度結合の出力先 (<JOIN_OUTPUT>_ids.npy / _scores.npy)
+
+    main(image_dir=IMAGE_DIR, top_k=TOP_K, join_output=JOIN_OUTPUT)
@@ -0,0 +1,55 @@
+import os
+import io
+import numpy as np
+from PIL import Image
+
+# 画像をエンベディング API に送るときの形式と品質 (環境変数で変更可能)
+# 品質の既定値 75 は PIL の既定値と同じで、従来のキャッシュキーと一致します
+DEFAULT_FORMAT = os.getenv("GEMINI_IMAGE_FORMAT", "JPEG").upper()
+DEFAULT_QUALITY = int(os.getenv("GEMINI_IMAGE_QUALITY", "75"))
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+def pixmap_to_image(pix):
+    """
+    fitz.Pixmap の samples バッファをコピーせずに PIL 画像として包みます。
+    返り値は pix が生きている間だけ有効です。
+    """
+    mode = {1: "L", 3: "RGB", 4: "RGBA"}[pix.n]
+    return Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, "raw", mode, pix.stride, 1)
+
+
+def array_to_image(array):
+    """(高さ, 幅[, チャンネル]) の uint8 配列をコピーせずに PIL 画像として包みます。"""
+    if array.ndim == 2 or array.shape[2] == 1:
+        mode = "L"
+    else:
+        mode = {3: "RGB", 4: "RGBA"}[array.shape[2]]
+    h, w = array.shape[:2]
+    if not array.flags["C_CONTIGUOUS"]:
+        array = np.ascontiguousarray(array)
+    return Image.frombuffer(mode, (w, h), array, "raw", mode, array.strides[0], 1)
+
+
+def image_payload(content, fmt=None, quality=None):
+    """
+    PIL 画像・NumPy 配列・fitz.Pixmap・画像ファイルのパスを、1回のエンコードだけで
+    embed_content に渡せる {"mime_type", "data"} に変換します。
+    data は Base64 文字列ではなく生のバイト列です (API クライアント側で変換されます)。
+    """
+    fmt = (fmt or DEFAULT_FORMAT).upper()
+    quality = quality or DEFAULT_QUALITY
+    if isinstance(content, str):
+        content = Image.open(content).convert("RGB")
+    elif isinstance(content, np.ndarray):
+        content = array_to_image(content)
+    elif not isinstance(content, Image.Image):
+        # fitz.Pixmap (samples_mv を持つもの)
+        content = pixmap_to_image(content)
+
+    if content.mode not in ("RGB", "L"):
+        content = content.convert("RGB")
+    buffered = io.BytesIO()
+    content.save(buffered, format=fmt, quality=quality)
+    return {"mime_type": MIME_TYPES[fmt], "data": buffered.getvalue()}
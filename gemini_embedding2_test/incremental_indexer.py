@@ -0,0 +1,123 @@
+import os
+import hashlib
+import fitz  # PyMuPDF
+import numpy as np
+from dotenv import load_dotenv
+from embedding_config import MODEL_NAME, describe_config
+from async_embedding_client import embed_concurrently
+from embedding_store import EmbeddingStore
+from image_payload import image_payload
+from page_raster import EMBED_MAX_PIXELS, render_pixmap
+
+model_name = MODEL_NAME
+
+
+def page_fingerprint(page, mode="content"):
+    """
+    ページの指紋 (16 バイト) を計算します。
+    mode="content" はコンテンツストリームと参照している画像のバイト列から、
+    mode="pixels" は低解像度でレンダリングした画素から計算します。
+    """
+    h = hashlib.blake2b(digest_size=16)
+    if mode == "pixels":
+        pix = page.get_pixmap(matrix=fitz.Matrix(0.5, 0.5), alpha=False)
+        h.update(pix.samples)
+        return h.digest()
+
+    doc = page.parent
+    h.update(page.read_contents())
+    h.update(repr(tuple(page.rect)).encode("utf-8"))
+    # コンテンツストリームは画像を名前で参照するだけなので、画像の中身もハッシュに含める
+    for img in page.get_images(full=True):
+        h.update(doc.xref_stream_raw(img[0]) or b"")
+    return h.digest()
+
+
+def render_page_payload(page, zoom=2.0, max_pixels=None, grayscale=False):
+    """ページをレンダリングし、Pixmap の画素から直接 embed_content に渡せる形式にします。"""
+    pix = render_pixmap(page, zoom, max_pixels, grayscale)
+    return image_payload(pix)
+
+
+def index_pdf_incremental(pdf_path, store_dir, fingerprint="content", zoom=2.0,
+                          max_pixels=EMBED_MAX_PIXELS, grayscale=False):
+    """
+    PDF を EmbeddingStore に差分インデックスします。
+
+    - 指紋が変わっていないページはスキップ
+    - 別のページ番号に移動しただけのページ (挿入・削除でずれた場合) は既存ベクトルを再利用
+    - 新規・変更ページだけをレンダリングしてエンベディング
+    - 無くなったページと置き換えられた古い行は削除扱い (tombstone)
+
+    max_pixels / grayscale を変えると新しく埋め込むページだけ描画条件が変わるため、
+    同じストアでは同じ値を使い続けてください。
+    """
+    doc = fitz.open(pdf_path)
+    store = EmbeddingStore(store_dir) if os.path.exists(os.path.join(store_dir, "header.json")) else None
+    if store is not None:
+        store.check_config(model_name)
+    live = store.live_pages(pdf_path) if store is not None else {}
+    rows_by_hash = {h: row for row, h in live.values()}
+
+    stats = {"unchanged": 0, "moved": 0, "embedded": 0, "deleted": 0}
+    moved, to_embed, stale = [], [], []
+    replaced = {}       # 内容が変わったページ番号 → 古い行 (新しいベクトルを追記できたら削除扱いにする)
+    for page_num in range(len(doc)):
+        page_no = page_num + 1
+        fp = page_fingerprint(doc[page_num], fingerprint)
+        if page_no in live and live[page_no][1] == fp:
+            stats["unchanged"] += 1
+            continue
+        if page_no in live:
+            replaced[page_no] = live[page_no][0]
+        if fp in rows_by_hash:
+            moved.append((page_no, rows_by_hash[fp], fp))
+        else:
+            to_embed.append((page_no, fp))
+
+    for page_no, (row, _) in live.items():
+        if page_no > len(doc):
+            stale.append(row)
+            stats["deleted"] += 1
+
+    print(f"📄 {pdf_path}: 変更なし {stats['unchanged']} / 移動 {len(moved)} / "
+          f"埋め込み対象 {len(to_embed)} / 削除 {stats['deleted']} ページ")
+
+    if moved:
+        # 移動したページは古い行のベクトルをそのまま新しいページ番号で追記する
+        pages, rows, hashes = zip(*moved)
+        store.append(pdf_path, pages, np.asarray(store.vectors[list(rows)], dtype=np.float32), hashes)
+        stats["moved"] = len(moved)
+        stale.extend(replaced.pop(page_no) for page_no in pages if page_no in replaced)
+
+    if to_embed:
+        payloads = [render_page_payload(doc[page_no - 1], zoom, max_pixels, grayscale)
+                    for page_no, _ in to_embed]
+        # 変更されたページを確実に埋め込み直すため、知覚ハッシュによる重複除去は使わない
+        # (バイト列が同じペイロードはエンベディングキャッシュが処理する)
+        embs = embed_concurrently(model_name, payloads)
+        done = [(page_no, emb, fp) for (page_no, fp), emb in zip(to_embed, embs) if emb is not None]
+        if done:
+            pages, vectors, hashes = zip(*done)
+            store = store or EmbeddingStore(store_dir, dim=len(vectors[0]), config=describe_config(model_name))
+            store.append(pdf_path, pages, vectors, hashes)
+            stale.extend(replaced.pop(page_no) for page_no in pages if page_no in replaced)
+        stats["embedded"] = len(done)
+        if len(done) < len(to_embed):
+            # 埋め込みに失敗したページは古い行を残し、次回の実行で再度埋め込む
+            print(f"⚠️ {len(to_embed) - len(done)} ページは埋め込みに失敗したため、前の版のまま残します。")
+
+    if store is not None:
+        store.tombstone(stale)
+    doc.close()
+    return stats
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    PDF_FILE = "sample.pdf"       # インデックスするPDF (改訂版を同じパスに置いて再実行)
+    STORE_DIR = "page_store"      # EmbeddingStore のディレクトリ
+    FINGERPRINT = "content"       # "content" (コンテンツストリーム) または "pixels" (レンダリング画素)
+
+    stats = index_pdf_incremental(PDF_FILE, STORE_DIR, FINGERPRINT)
+    print(f"🎉 差分インデックス完了: {stats}")
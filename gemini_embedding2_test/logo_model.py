@@ -0,0 +1,262 @@
+import os
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import time
+import cv2
+import numpy as np
+from template_matching import load_logo_gray
+
+# ロゴモデル (ロゴの特徴量・FLANN インデックス・ページ特徴量キャッシュ) の保存先 (環境変数で上書き可能)
+DEFAULT_MODEL_PATH = os.getenv("LOGO_MODEL_PATH", "logo_model.sqlite3")
+DEFAULT_MAX_PAGE_BYTES = int(os.getenv("LOGO_MODEL_MAX_PAGE_BYTES", str(1024 ** 3)))
+
+FLANN_INDEX_KDTREE = 1
+INDEX_PARAMS = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+SEARCH_PARAMS = dict(checks=50)  # 精度と速度のトレードオフ
+RATIO = 0.75                     # Lowe's ratio test (シンプルな図形向けに0.75に緩める)
+
+# キーポイント1個分の保存形式 (x, y, size, angle, response, octave, class_id)
+KEYPOINT_FIELDS = 7
+
+
+def keypoints_to_array(keypoints):
+    return np.array([(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave, k.class_id)
+                     for k in keypoints], dtype=np.float32).reshape(-1, KEYPOINT_FIELDS)
+
+
+def page_hash(page_gray):
+    """ページ画像の画素から、ページ特徴量キャッシュのキーを作ります。"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(page_gray.shape).encode("utf-8"))
+    h.update(np.ascontiguousarray(page_gray).data)
+    return h.hexdigest()
+
+
+class LogoModel:
+    """
+    SIFT によるロゴ検出のための永続モデル (SQLite の1ファイル)。
+
+    - logos       : ロゴごとのキーポイントと記述子 (元画像のハッシュ付き)
+    - flann_index : 全ロゴの記述子で学習済みの FLANN インデックス
+    - pages       : ページ画像のハッシュをキーにしたページの特徴量キャッシュ (LRU)
+
+    一度作れば、何千もの PDF を処理するときもロゴの特徴抽出とインデックス構築をやり直しません。
+    SIFT の記述子は 0〜255 の整数値なので uint8 で保存します。
+    """
+
+    def __init__(self, path=DEFAULT_MODEL_PATH, max_page_bytes=DEFAULT_MAX_PAGE_BYTES):
+        self.path = path
+        self.max_page_bytes = max_page_bytes
+        self.page_hits = 0
+        self.page_misses = 0
+        self.sift = cv2.SIFT_create()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS logos ("
+            " label TEXT PRIMARY KEY,"
+            " source_hash TEXT NOT NULL,"
+            " keypoints BLOB NOT NULL,"
+            " descriptors BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS flann_index ("
+            " id INTEGER PRIMARY KEY CHECK (id = 0),"
+            " labels TEXT NOT NULL,"
+            " data BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " key TEXT PRIMARY KEY,"
+            " keypoints BLOB NOT NULL,"
+            " descriptors BLOB NOT NULL,"
+            " nbytes INTEGER NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access)")
+        self._conn.commit()
+        row = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM pages").fetchone()
+        self.total_page_bytes = row[0]
+        self._index = None
+        self._logos = None
+
+    # --- ロゴ ---
+
+    def add_logo(self, logo_path, label=None):
+        """
+        ロゴ画像の特徴量を登録します。同じラベルで同じ画像が登録済みなら何もしません。
+        画像が変わっていれば特徴量を計算し直し、インデックスを作り直します。
+        """
+        label = label or os.path.splitext(os.path.basename(logo_path))[0]
+        with open(logo_path, "rb") as fp:
+            source_hash = hashlib.blake2b(fp.read(), digest_size=16).hexdigest()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT source_hash FROM logos WHERE label = ?", (label,)
+            ).fetchone()
+        if row is not None and row[0] == source_hash:
+            return label
+
+        logo_gray = load_logo_gray(logo_path)
+        keypoints, descriptors = self.sift.detectAndCompute(logo_gray, None)
+        if descriptors is None:
+            keypoints, descriptors = [], np.empty((0, 128), dtype=np.float32)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO logos (label, source_hash, keypoints, descriptors)"
+                " VALUES (?, ?, ?, ?)",
+                (label, source_hash, keypoints_to_array(keypoints).tobytes(),
+                 descriptors.astype(np.uint8).tobytes()),
+            )
+            # ロゴが変わったので保存済みのインデックスは無効
+            self._conn.execute("DELETE FROM flann_index")
+            self._conn.commit()
+        self._index = None
+        self._logos = None
+        print(f"🧩 ロゴ '{label}' から {len(keypoints)} 個の特徴点を抽出しました。")
+        return label
+
+    def logos(self):
+        """{ラベル: (キーポイント配列, 記述子)} を返します (ラベル順)。"""
+        if self._logos is None:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT label, keypoints, descriptors FROM logos ORDER BY label"
+                ).fetchall()
+            self._logos = {
+                label: (np.frombuffer(kp, dtype=np.float32).reshape(-1, KEYPOINT_FIELDS),
+                        np.frombuffer(des, dtype=np.uint8).reshape(-1, 128).astype(np.float32))
+                for label, kp, des in rows
+            }
+        return self._logos
+
+    def index(self):
+        """
+        全ロゴの記述子で学習済みの FLANN インデックスを返します。
+        保存済みならそれを読み込み、無ければ構築してモデルに保存します。
+        返り値は (インデックス, 記述子ごとのロゴ上の座標 (N, 2), 記述子ごとのロゴ番号, ラベルのリスト) です。
+        """
+        if self._index is not None:
+            return self._index
+        logos = self.logos()
+        labels = list(logos)
+        if not labels:
+            raise ValueError("ロゴが登録されていません。先に add_logo() を呼んでください。")
+        descriptors = np.ascontiguousarray(np.concatenate([des for _, des in logos.values()]))
+        points = np.concatenate([kp[:, :2] for kp, _ in logos.values()])
+        owners = np.concatenate([np.full(len(des), i, dtype=np.int32)
+                                 for i, (_, des) in enumerate(logos.values())])
+
+        with self._lock:
+            row = self._conn.execute("SELECT labels, data FROM flann_index").fetchone()
+        # FLANN はファイル経由でしか保存・読み込みできないため一時ファイルを使う
+        with tempfile.TemporaryDirectory() as tmp:
+            index_path = os.path.join(tmp, "flann.bin")
+            index = cv2.flann_Index()
+            if row is not None and row[0] == "\n".join(labels):
+                with open(index_path, "wb") as fp:
+                    fp.write(row[1])
+                loaded = index.load(descriptors, index_path)
+            else:
+                loaded = False
+            if not loaded:
+                index = cv2.flann_Index(descriptors, INDEX_PARAMS)
+                index.save(index_path)
+                with open(index_path, "rb") as fp:
+                    data = fp.read()
+                with self._lock:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO flann_index (id, labels, data) VALUES (0, ?, ?)",
+                        ("\n".join(labels), data),
+                    )
+                    self._conn.commit()
+        # インデックスは descriptors を参照し続けるので一緒に保持する
+        self._descriptors = descriptors
+        self._index = (index, points, owners, labels)
+        return self._index
+
+    def match(self, page_descriptors, ratio=RATIO):
+        """
+        ページの記述子をロゴのインデックスで検索し、ratio test を通った対応を
+        (ページ側の番号, ロゴ側の番号 (全ロゴ通し), ロゴ番号) の配列で返します。
+        """
+        index, _, owners, _ = self.index()
+        if page_descriptors is None or len(page_descriptors) == 0 or len(owners) < 2:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int32)
+        nearest, dists = index.knnSearch(np.ascontiguousarray(page_descriptors, dtype=np.float32),
+                                         2, params=SEARCH_PARAMS)
+        # KD-tree の距離は二乗距離なので、比も二乗で比べる
+        good = dists[:, 0] < (ratio ** 2) * dists[:, 1]
+        page_idx = np.flatnonzero(good)
+        logo_idx = nearest[good, 0].astype(np.int64)
+        return page_idx, logo_idx, owners[logo_idx]
+
+    # --- ページ特徴量キャッシュ ---
+
+    def page_features(self, page_gray):
+        """
+        ページの (キーポイント配列, 記述子) を返します。同じ画素のページは SIFT を計算し直しません。
+        キーポイント配列は KEYPOINT_FIELDS 列の float32 です。
+        """
+        key = page_hash(page_gray)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT keypoints, descriptors FROM pages WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE pages SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+        if row is not None:
+            self.page_hits += 1
+            return (np.frombuffer(row[0], dtype=np.float32).reshape(-1, KEYPOINT_FIELDS),
+                    np.frombuffer(row[1], dtype=np.uint8).reshape(-1, 128).astype(np.float32))
+
+        self.page_misses += 1
+        keypoints, descriptors = self.sift.detectAndCompute(page_gray, None)
+        kp_array = keypoints_to_array(keypoints)
+        if descriptors is None:
+            descriptors = np.empty((0, 128), dtype=np.float32)
+        kp_blob, des_blob = kp_array.tobytes(), descriptors.astype(np.uint8).tobytes()
+        nbytes = len(kp_blob) + len(des_blob)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (key, keypoints, descriptors, nbytes, last_access)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, kp_blob, des_blob, nbytes, time.time()),
+            )
+            self.total_page_bytes += nbytes
+            self._evict()
+            self._conn.commit()
+        return kp_array, descriptors
+
+    def _evict(self):
+        while self.total_page_bytes > self.max_page_bytes:
+            rows = self._conn.execute(
+                "SELECT key, nbytes FROM pages ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, nbytes in rows:
+                self._conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+                self.total_page_bytes -= nbytes
+                if self.total_page_bytes <= self.max_page_bytes:
+                    break
+
+    def stats(self):
+        with self._lock:
+            logos = self._conn.execute("SELECT COUNT(*) FROM logos").fetchone()[0]
+            pages = self._conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        return {
+            "logos": logos,
+            "page_hits": self.page_hits,
+            "page_misses": self.page_misses,
+            "pages": pages,
+            "page_bytes": self.total_page_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,10 +1,12 @@
 import os
-import io
-import numpy as np
-import base64
-from PIL import Image
 import google.generativeai as genai
 from dotenv import load_dotenv
+from embedding_config import MODEL_NAME
+from embedding_cache import print_cache_stats
+from image_payload import image_payload
+from embedding_batch import embed_batch
+from perceptual_dedup import deduplicated, print_dedup_stats
+from similarity_engine import similarity_matrix
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -17,32 +19,17 @@ if not api_key:
     exit(1)
 
 genai.configure(api_key=api_key)
-model_name = "models/gemini-embedding-2-preview"
+model_name = MODEL_NAME
 
-def get_embedding(content):
+def to_payload(content):
     """
-    テキストまたは画像からエンベディングを取得します。
+    画像ファイルのパスであればJPEG形式に変換し、テキストはそのまま返します。
     """
-    try:
-        if isinstance(content, str) and os.path.exists(content) and (content.endswith('.png') or content.endswith('.jpg') or content.endswith('.jpeg')):
-            # 画像ファイルの場合
-            img = Image.open(content).convert("RGB")
-            buffered = io.BytesIO()
-            img.save(buffered, format="JPEG")
-            img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            payload = {"mime_type": "image/jpeg", "data": img_str}
-        else:
-            # テキストの場合
-            payload = content
-            
-        result = genai.embed_content(
-            model=model_name,
-            content=payload
-        )
-        return np.array(result['embedding'])
-    except Exception as e:
-        print(f"❌ '{content}' の取得エラー: {e}")
-        return None
+    if isinstance(content, str) and os.path.exists(content) and (content.endswith('.png') or content.endswith('.jpg') or content.endswith('.jpeg')):
+        # 画像ファイルの場合
+        return image_payload(content)
+    # テキストの場合
+    return content
 
 def main():
     # 比較対象のミックスリスト (画像2つ、テキスト2つ)
@@ -59,34 +46,31 @@ def main():
     embeddings = []
     labels = []
     
+    valid_items = []
     for item in items:
         # 画像ファイルが存在するかチェック (画像タイプのみ)
         if item["type"] == "image" and not os.path.exists(item["content"]):
             print(f"⚠️ 警告: 画像ファイル {item['content']} が見当たらないためスキップします。")
             continue
-            
-        emb = get_embedding(item["content"])
+        valid_items.append(item)
+
+    # 画像とテキストをまとめて1回のバッチで送信
+    payloads = [to_payload(item["content"]) for item in valid_items]
+    for item, emb in zip(valid_items, deduplicated(embed_batch)(model_name, payloads)):
         if emb is not None:
             embeddings.append(emb)
             labels.append(item["label"])
             print(f"✅ {item['label']} 完了")
+    print_cache_stats()
+    print_dedup_stats()
 
     if len(embeddings) < 2:
         print("比較には少なくとも2つ以上の要素が必要です。")
         return
 
     # 類似度マトリックスの計算
-    num_items = len(embeddings)
-    matrix = np.zeros((num_items, num_items))
-    
-    for i in range(num_items):
-        for j in range(num_items):
-            # コサイン類似度
-            dot = np.dot(embeddings[i], embeddings[j])
-            norm_i = np.linalg.norm(embeddings[i])
-            norm_j = np.linalg.norm(embeddings[j])
-            # Gemini Embedding 2 は既に正規化されていますが念のため
-            matrix[i, j] = dot / (norm_i * norm_j)
+    # コサイン類似度 (Gemini Embedding 2 は既に正規化されていますが念のため正規化してから行列積)
+    matrix = similarity_matrix(embeddings)
 
     print("\n--- 類似度マトリックスを作成中 ---")
     
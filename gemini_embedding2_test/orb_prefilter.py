@@ -0,0 +1,111 @@
+import time
+import cv2
+import numpy as np
+
+PREFILTER_SCALE = 1.0       # ORB を計算するページの倍率 (縮小すると小さなロゴの特徴が潰れて見逃す)
+LOGO_SCALES = (1.0, 0.7, 0.5, 0.35, 0.25, 0.18)  # ロゴの ORB 記述子を取る縮尺 (ORB 自体のピラミッドでは小さいロゴに届かない)
+ORB_LOGO_FEATURES = 500
+ORB_PAGE_FEATURES = 8000    # 文字の角に特徴点を取られるので多めに取る
+ORB_EDGE = 31               # ORB の既定の patchSize / edgeThreshold。画像の縁からこの幅には特徴点が取れない
+PREFILTER_RATIO = 0.8       # SIFT 側 (0.75) より緩めにして見逃しを防ぐ
+PREFILTER_MIN_INLIERS = 6   # 相似変換で整合する対応がこれ未満のロゴは「このページには無い」とみなす (文字だけのページでも 4 前後は偶然整合する)
+MIN_LOGO_KEYPOINTS = 20     # ある縮尺のロゴの特徴点がこれ未満なら、そのロゴは ORB で判定できないので常に候補に残す
+MIN_PAGE_KEYPOINTS = 200    # ページの特徴点がこれ未満 (薄いスキャンなど) なら判定できないので除外しない
+
+FLANN_INDEX_LSH = 6
+LSH_INDEX_PARAMS = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+LSH_SEARCH_PARAMS = dict(checks=50)
+
+
+class OrbPrefilter:
+    """
+    SIFT + RANSAC の前段で、ロゴが明らかに無いページを安く除外するフィルタ。
+
+    ページで ORB (バイナリ記述子) を計算し、全ロゴ・全縮尺の ORB 記述子をまとめた
+    LSH インデックスで照合します。ratio test を通った対応を (ロゴ, 縮尺) ごとに分け、
+    相似変換 (RANSAC) で整合するものがどの縮尺でも min_inliers 未満のロゴはそのページの
+    候補から外し、候補が1つも残らないページは SIFT を計算せずに除外します。
+    ロゴは余白を付けてから縮小するので、縁に特徴点が取れない小さな縮尺でも記述子が残ります。
+    見逃しを避けるため、どこかの縮尺で特徴点が少なすぎるロゴは常に候補に残し、
+    特徴点が少なすぎるページは除外しません。
+    zoom=2.0 のページで幅 120 ピクセル (60pt) 程度より小さいロゴは ORB では見えないので、
+    コーパスごとに benchmark_sift_cascade.py で見逃しが無いことを確かめてから使ってください。
+    """
+
+    def __init__(self, logos, scale=PREFILTER_SCALE, ratio=PREFILTER_RATIO,
+                 min_inliers=PREFILTER_MIN_INLIERS):
+        self.scale = scale
+        self.ratio = ratio
+        self.min_inliers = min_inliers
+        self.page_orb = cv2.ORB_create(nfeatures=ORB_PAGE_FEATURES)
+        logo_orb = cv2.ORB_create(nfeatures=ORB_LOGO_FEATURES)
+
+        self.labels = list(logos)
+        self.always = set()
+        descriptors, points, owners = [], [], []
+        for i, label in enumerate(self.labels):
+            for j, logo_scale in enumerate(LOGO_SCALES):
+                resized = cv2.resize(logos[label], None, fx=logo_scale, fy=logo_scale,
+                                     interpolation=cv2.INTER_AREA)
+                if min(resized.shape[:2]) < ORB_EDGE:
+                    break   # これより小さい縮尺は SIFT でも見つからない
+                # ページ上のロゴは周りが白いので、白い余白を付けてから特徴点を取る
+                padded = cv2.copyMakeBorder(resized, ORB_EDGE, ORB_EDGE, ORB_EDGE, ORB_EDGE,
+                                            cv2.BORDER_CONSTANT, value=255)
+                keypoints, des = logo_orb.detectAndCompute(padded, None)
+                if des is None or len(des) < MIN_LOGO_KEYPOINTS:
+                    self.always.add(label)
+                    continue
+                descriptors.append(des)
+                # 座標は余白を除いた元のロゴの座標系に戻しておく
+                points.append((np.float32([k.pt for k in keypoints]) - ORB_EDGE) / logo_scale)
+                # (ロゴ, 縮尺) ごとに RANSAC をかけるため、縮尺も番号に含めておく
+                owners.append(np.full(len(des), i * len(LOGO_SCALES) + j, dtype=np.int32))
+        self.owners = np.concatenate(owners) if owners else np.empty(0, dtype=np.int32)
+        self.points = np.concatenate(points) if points else np.empty((0, 2), dtype=np.float32)
+        self.matcher = None
+        if descriptors:
+            self.matcher = cv2.FlannBasedMatcher(LSH_INDEX_PARAMS, LSH_SEARCH_PARAMS)
+            self.matcher.add([np.concatenate(descriptors)])
+            self.matcher.train()
+
+        self.pages = 0
+        self.rejected = 0
+        self.seconds = 0.0
+
+    def candidates(self, page_gray):
+        """ページに含まれている可能性があるロゴのラベルの集合を返します (空なら除外)。"""
+        start = time.perf_counter()
+        found = set(self.always)
+        if self.matcher is not None:
+            page = page_gray
+            if self.scale != 1.0:
+                page = cv2.resize(page_gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+            keypoints, des = self.page_orb.detectAndCompute(page, None)
+            if des is None or len(des) < MIN_PAGE_KEYPOINTS:
+                found.update(self.labels)
+            else:
+                good = [pair[0] for pair in self.matcher.knnMatch(des, k=2)
+                        if len(pair) == 2 and pair[0].distance < self.ratio * pair[1].distance]
+                logo_idx = np.array([m.trainIdx for m in good], dtype=np.int64)
+                page_pts = np.float32([keypoints[m.queryIdx].pt for m in good]).reshape(-1, 2)
+                owners = self.owners[logo_idx]
+                for owner in np.unique(owners):
+                    label = self.labels[owner // len(LOGO_SCALES)]
+                    keep = owners == owner
+                    if label in found or keep.sum() < self.min_inliers:
+                        continue
+                    # 前段では射影変換まで求めず、相似変換 (回転・拡大・平行移動) で整合を見る
+                    M, mask = cv2.estimateAffinePartial2D(self.points[logo_idx[keep]], page_pts[keep],
+                                                          method=cv2.RANSAC, ransacReprojThreshold=3.0)
+                    if M is not None and mask.sum() >= self.min_inliers:
+                        found.add(label)
+        self.pages += 1
+        self.rejected += not found
+        self.seconds += time.perf_counter() - start
+        return found
+
+    def report(self):
+        rate = self.rejected / self.pages if self.pages else 0.0
+        print(f"⚡ ORB 前段フィルタ: {self.pages} ページ中 {self.rejected} ページを除外 "
+              f"(除外率 {rate:.0%}, {self.seconds:.2f} 秒)")
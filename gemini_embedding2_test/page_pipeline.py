@@ -0,0 +1,239 @@
+import os
+import time
+import queue
+import threading
+import fitz  # PyMuPDF
+import numpy as np
+from embedding_batch import MAX_BATCH_ITEMS, embed_batch
+from embedding_config import OUTPUT_DIMENSIONALITY, describe_config
+from embedding_store import EmbeddingStore
+from image_payload import image_payload
+from incremental_indexer import page_fingerprint
+from page_raster import EMBED_MAX_PIXELS, rasterize_pages
+
+_DONE = object()
+
+
+class Stage:
+    """
+    パイプラインの1段。fn は1件 (batch_size > 1 ならリスト) を受け取り、
+    出力のリストを返します。workers 個のスレッドで並行に動きます。
+    """
+
+    def __init__(self, name, fn, workers=1, batch_size=1, queue_size=8):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        self.max_depth = 0
+        self._lock = threading.Lock()
+        self._finished_workers = 0
+
+    def stats(self, wall_seconds):
+        return {
+            "items": self.items_in,
+            "busy_seconds": self.busy_seconds,
+            # 1ワーカーが処理に使った時間あたりの件数
+            "items_per_busy_second": self.items_in / self.busy_seconds if self.busy_seconds else 0.0,
+            "utilization": self.busy_seconds / (wall_seconds * self.workers) if wall_seconds else 0.0,
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_depth,
+        }
+
+
+class StagedPipeline:
+    """
+    source → stage1 → stage2 → ... を有界キューでつないだパイプライン。
+    各段は別スレッドで動くため、CPU 処理 (レンダリング・エンコード) と
+    ネットワーク待ち (エンベディング) が重なります。キューが有界なので、
+    入力がいくら多くてもメモリ使用量は一定です。
+    """
+
+    def __init__(self, source, stages, source_name="source", output_queue_size=16):
+        self.source = source
+        self.source_stage = Stage(source_name, None)
+        self.stages = stages
+        self.output = queue.Queue(maxsize=output_queue_size)
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def _put(self, index, item):
+        target = self.stages[index].queue if index < len(self.stages) else self.output
+        target.put(item)
+        if index < len(self.stages):
+            stage = self.stages[index]
+            stage.max_depth = max(stage.max_depth, stage.queue.qsize())
+
+    def _signal_done(self, index):
+        if index < len(self.stages):
+            for _ in range(self.stages[index].workers):
+                self.stages[index].queue.put(_DONE)
+        else:
+            self.output.put(_DONE)
+
+    def _run_source(self):
+        stage = self.source_stage
+        try:
+            iterator = iter(self.source)
+            while True:
+                start = time.perf_counter()
+                item = next(iterator, _DONE)
+                stage.busy_seconds += time.perf_counter() - start
+                if item is _DONE:
+                    break
+                stage.items_in += 1
+                self._put(0, item)
+        except Exception as e:
+            self.error = self.error or e
+        finally:
+            self._signal_done(0)
+
+    def _take_batch(self, stage):
+        first = stage.queue.get()
+        if first is _DONE or stage.batch_size == 1:
+            return first, first is _DONE
+        batch = [first]
+        while len(batch) < stage.batch_size:
+            try:
+                item = stage.queue.get(timeout=0.05)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run_stage(self, index):
+        stage = self.stages[index]
+        while True:
+            work, done = self._take_batch(stage)
+            if work is not _DONE and self.error is None:
+                n = len(work) if stage.batch_size > 1 else 1
+                start = time.perf_counter()
+                try:
+                    outputs = stage.fn(work)
+                except Exception as e:
+                    self.error = self.error or e
+                    outputs = []
+                with stage._lock:
+                    stage.busy_seconds += time.perf_counter() - start
+                    stage.items_in += n
+                    stage.items_out += len(outputs)
+                for out in outputs:
+                    self._put(index + 1, out)
+            if done:
+                break
+        with stage._lock:
+            stage._finished_workers += 1
+            last = stage._finished_workers == stage.workers
+        if last:
+            self._signal_done(index + 1)
+
+    def run(self):
+        """パイプラインを起動し、最終段の出力を順次返すジェネレータです。"""
+        self.started = time.perf_counter()
+        threads = [threading.Thread(target=self._run_source, daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads += [threading.Thread(target=self._run_stage, args=(i,), daemon=True)
+                        for _ in range(stage.workers)]
+        for t in threads:
+            t.start()
+        while True:
+            item = self.output.get()
+            if item is _DONE:
+                break
+            yield item
+        for t in threads:
+            t.join()
+        self.finished = time.perf_counter()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        """段ごとの処理件数・スループット・入力キューの深さを返します。"""
+        wall = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        stats = {self.source_stage.name: self.source_stage.stats(wall)}
+        stats.update({stage.name: stage.stats(wall) for stage in self.stages})
+        return stats
+
+    def report(self):
+        wall = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        print(f"\n--- パイプライン統計 (経過 {wall:.2f} 秒) ---")
+        print(f"{'段':<10}{'件数':>8}{'件/稼働秒':>12}{'稼働率':>10}{'最大入力キュー':>14}")
+        for name, s in self.stats().items():
+            print(f"{name:<10}{s['items']:>8}{s['items_per_busy_second']:>12.1f}"
+                  f"{s['utilization']:>10.0%}{s['max_queue_depth']:>14}")
+
+
+def embed_pdf_pages(pdf_path, model_name, zoom=2.0, store_dir=None, encode_workers=4,
+                    embed_workers=4, batch_size=MAX_BATCH_ITEMS, queue_size=8, embed_fn=embed_batch,
+                    max_pixels=EMBED_MAX_PIXELS, grayscale=False, output_dimensionality=OUTPUT_DIMENSIONALITY):
+    """
+    PDF のページを「レンダリング → JPEG エンコード → エンベディング → 保存」の
+    パイプラインで処理し、(ページ番号, ベクトル) をページ順に並べたリストと
+    パイプラインを返します。失敗したページは含まれません。
+    embed_fn は embed_batch と同じ (model_name, contents) を受け取る関数です。embed_workers 個の
+    スレッドから並行に呼ばれるので、非同期クライアントを使う場合は SharedEmbeddingClient で
+    1つのリミッタを共有してください。
+    max_pixels を指定すると zoom の代わりにページあたりの画素数から倍率を決め、
+    None なら zoom のままレンダリングします。grayscale=True なら 1 チャンネルで描画します。
+    同じ PDF を同じ store_dir に再度保存すると、前回の行は削除扱いになります。
+    ストアには model_name と output_dimensionality (embed_fn が返すベクトルの出力次元数) を記録し、
+    違う設定で作られたストアには追記しません。
+    """
+    def source():
+        # レンダリング自体は page_raster のプロセスプールで並列化されている
+        with fitz.open(pdf_path) as doc:
+            for page_num, img_array in rasterize_pages(pdf_path, zoom=zoom, max_pixels=max_pixels,
+                                                          grayscale=grayscale):
+                # 共有メモリは次のページで解放されるため、ここでコピーしてキューに流す
+                yield page_num, np.array(img_array), page_fingerprint(doc[page_num])
+
+    def encode(item):
+        page_num, img_array, fp = item
+        # 画素配列をコピーせずに包み、JPEG/WebP へ1回だけエンコードする
+        return [(page_num, image_payload(img_array), fp)]
+
+    def embed(batch):
+        embs = embed_fn(model_name, [payload for _, payload, _ in batch])
+        out = []
+        for (page_num, _, fp), emb in zip(batch, embs):
+            if emb is None:
+                print(f"⚠️ ページ {page_num + 1} はエンベディングが取得できなかったため除外します。")
+                continue
+            out.append((page_num, emb, fp))
+        return out
+
+    store, live = None, {}
+    if store_dir and os.path.exists(os.path.join(store_dir, "header.json")):
+        # 設定の違うストアに追記しないよう、埋め込みを始める前に確認する
+        store = EmbeddingStore(store_dir)
+        store.check_config(model_name, output_dimensionality)
+        # 同じ PDF を再実行したときは、追記したページの前の行を削除扱いにして重複させない
+        live = store.live_pages(pdf_path)
+    def save(batch):
+        nonlocal store
+        if store_dir:
+            store = store or EmbeddingStore(store_dir, dim=len(batch[0][1]),
+                                            config=describe_config(model_name, output_dimensionality))
+            pages, vectors, hashes = zip(*[(page_num + 1, emb, fp) for page_num, emb, fp in batch])
+            store.append(pdf_path, pages, vectors, hashes)
+            store.tombstone(live[page_no][0] for page_no in pages if page_no in live)
+        return [(page_num, emb) for page_num, emb, _ in batch]
+
+    pipeline = StagedPipeline(source(), source_name="rasterize", stages=[
+        Stage("encode", encode, workers=encode_workers, queue_size=queue_size),
+        Stage("embed", embed, workers=embed_workers, batch_size=batch_size, queue_size=batch_size * 2),
+        Stage("store", save, batch_size=batch_size, queue_size=batch_size * 2),
+    ])
+    results = sorted(pipeline.run(), key=lambda x: x[0])
+    if live:
+        # PDF が短くなっていれば、無くなったページの行も削除扱いにする
+        with fitz.open(pdf_path) as doc:
+            store.tombstone(row for page_no, (row, _) in live.items() if page_no > len(doc))
+    return results, pipeline
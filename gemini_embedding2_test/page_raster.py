@@ -0,0 +1,125 @@
+import os
+import math
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+import fitz  # PyMuPDF
+import numpy as np
+
+DEFAULT_ZOOM = 2.0
+DEFAULT_CHUNK_PAGES = 4   # 1タスクでレンダリングするページ数
+# エンベディング用にページをレンダリングするときの画素数の目安 (環境変数で変更可能)
+# zoom=2.0 の A4 ページ (約 1190x1684 = 200 万画素) はサーバー側で縮小されるだけなので、
+# 約 100 万画素に抑えてレンダリング・エンコード・送信のバイト数を減らす
+EMBED_MAX_PIXELS = int(os.getenv("GEMINI_PAGE_MAX_PIXELS", str(1024 * 1024)))
+
+# ワーカープロセスごとに開いたPDFを使い回す
+_worker_docs = {}
+
+
+def _open_in_worker(pdf_path):
+    doc = _worker_docs.get(pdf_path)
+    if doc is None:
+        doc = _worker_docs[pdf_path] = fitz.open(pdf_path)
+    return doc
+
+
+def zoom_for_pixel_budget(rect, max_pixels, tiles=1, max_zoom=None):
+    """
+    ページ (fitz.Rect) の画素数が max_pixels x tiles 以下になる zoom を返します。
+    タイルに分割して埋め込む場合は tiles にタイル数を渡すと、1タイルあたりの画素数が
+    max_pixels に収まります。max_zoom を指定するとそれ以上は拡大しません。
+    """
+    area = max(rect.width * rect.height, 1.0)
+    zoom = math.sqrt(max_pixels * tiles / area)
+    return min(zoom, max_zoom) if max_zoom else zoom
+
+
+def render_pixmap(page, zoom=DEFAULT_ZOOM, max_pixels=None, grayscale=False, tiles=1):
+    """
+    ページを Pixmap にレンダリングします。
+    max_pixels を指定すると画素数の上限から倍率を決めます。小さなページを拡大して
+    画素を増やさないよう、倍率は zoom (既定では従来の 2.0) を上限にします。
+    grayscale=True なら 1 チャンネルのグレースケールで描画します (画素数は RGB の 1/3)。
+    """
+    if max_pixels:
+        zoom = zoom_for_pixel_budget(page.rect, max_pixels, tiles, max_zoom=zoom)
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    return page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False)
+
+
+def _render_range(pdf_path, start, stop, zoom, max_pixels=None, grayscale=False, tiles=1):
+    """
+    ワーカー側でページ範囲をレンダリングし、画素を共有メモリに書き込みます。
+    画像そのものは返さず、(ページ番号, 共有メモリ名, 形状) だけを返します。
+    """
+    doc = _open_in_worker(pdf_path)
+    results = []
+    for page_num in range(start, stop):
+        pix = render_pixmap(doc[page_num], zoom, max_pixels, grayscale, tiles)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(pix.samples_mv)))
+        shm.buf[:len(pix.samples_mv)] = pix.samples_mv
+        results.append((page_num, shm.name, (pix.h, pix.w, pix.n), pix.stride))
+        # 解放は受け取った親プロセスが行うため、ワーカー側の後始末の対象から外す
+        resource_tracker.unregister(shm._name, "shared_memory")
+        shm.close()
+    return results
+
+
+def rasterize_pages(pdf_path, zoom=DEFAULT_ZOOM, workers=None, chunk_pages=DEFAULT_CHUNK_PAGES,
+                    max_pending=None, max_pixels=None, grayscale=False, tiles=1):
+    """
+    PDF の全ページを複数プロセスでレンダリングし、ページ順に (ページ番号, 画素配列) を返すジェネレータ。
+    画素配列は (高さ, 幅, チャンネル) の uint8 で、共有メモリ上のビューです。
+    max_pixels / grayscale / tiles は render_pixmap と同じ意味で、grayscale ならチャンネル数は 1 です。
+    次の要素を取り出した時点で解放されるため、残したい場合は呼び出し側でコピーしてください。
+    max_pending で先読みするタスク数を制限し、メモリ使用量を一定に保ちます。
+    """
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 2
+    ranges = deque((s, min(s + chunk_pages, page_count)) for s in range(0, page_count, chunk_pages))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()   # 投入済みタスク
+        current = deque()   # 受け取り済みで、まだ返していないページ
+        opened = deque()    # 呼び出し側に渡した共有メモリ
+        try:
+            while ranges or pending or current:
+                if not current:
+                    while ranges and len(pending) < max_pending:
+                        start, stop = ranges.popleft()
+                        pending.append(pool.submit(_render_range, pdf_path, start, stop, zoom,
+                                                   max_pixels, grayscale, tiles))
+                    current.extend(pending.popleft().result())
+                    continue
+                page_num, name, (h, w, n), stride = current.popleft()
+                # 名前はすぐに削除し、マッピングは配列が使われている間だけ残す
+                shm = shared_memory.SharedMemory(name=name)
+                shm.unlink()
+                opened.append(shm)
+                rows = np.ndarray((h, stride), dtype=np.uint8, buffer=shm.buf)
+                yield page_num, rows[:, :w * n].reshape(h, w, n)
+                del rows
+                _close_released(opened, keep=1)
+        finally:
+            # 途中で打ち切られた場合も、作成済みの共有メモリを解放する
+            leftovers = list(current) + [item for future in pending for item in future.result()]
+            for _, name, _, _ in leftovers:
+                shm = shared_memory.SharedMemory(name=name)
+                shm.unlink()
+                shm.close()
+            _close_released(opened, keep=0)
+
+
+def _close_released(opened, keep):
+    """呼び出し側が参照を手放した共有メモリを閉じます (直近 keep 個は残す)。"""
+    candidates = list(opened)[:len(opened) - keep]
+    for shm in candidates:
+        try:
+            shm.close()
+            opened.remove(shm)
+        except BufferError:
+            # まだ配列が参照されている場合は後で閉じる
+            pass
@@ -0,0 +1,218 @@
+import os
+import threading
+import cv2
+import numpy as np
+from embedding_batch import embed_batch
+from embedding_cache import cached_embed_content, split_payload
+from embedding_config import OUTPUT_DIMENSIONALITY
+
+HASH_SIZE = 16              # 16x16 = 256 ビットのハッシュ (8x8 だと小さな違いを見落としやすい)
+# これ以下のハミング距離の画像を「ほぼ同一」とみなす (環境変数で変更可能、0 でハッシュの完全一致のみ)
+# 文字が1行違うだけのページでも 2 しか離れないため、既定ではハッシュが一致する画像だけをまとめる
+DEFAULT_MAX_DISTANCE = int(os.getenv("GEMINI_DEDUP_MAX_DISTANCE", "0"))
+ASPECT_TOLERANCE = 0.05     # 縦横比がこれ以上違う画像は同じグループにしない
+
+
+def _to_gray(content):
+    """画像のペイロード・NumPy 配列をグレースケールの配列にします。画像でなければ None です。"""
+    if isinstance(content, np.ndarray):
+        return cv2.cvtColor(content, cv2.COLOR_RGB2GRAY) if content.ndim == 3 else content
+    parts = split_payload(content)
+    if parts is None or not parts[0].startswith("image/"):
+        return None
+    # ハッシュは 64x64 まで縮めるので、デコード時点で 1/4 に縮小して速くする
+    return cv2.imdecode(np.frombuffer(parts[1], dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_4)
+
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def phash(gray, hash_size=HASH_SIZE):
+    """DCT の低周波成分が中央値より大きいかどうかのビット列 (pHash) を int で返します。"""
+    small = cv2.resize(gray, (hash_size * 4, hash_size * 4), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small.astype(np.float32))[:hash_size, :hash_size]
+    # 直流成分 (全体の明るさ) は中央値の計算から外す
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+def dhash(gray, hash_size=HASH_SIZE):
+    """隣り合う画素の明暗の向きのビット列 (dHash) を int で返します。pHash より速く、やや粗いです。"""
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """ハミング距離の BK-tree。距離 max_distance 以内の要素を全件走査せずに探します。"""
+
+    def __init__(self):
+        self.root = None    # [ハッシュ, 値, {距離: 子ノード}]
+        self.size = 0
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, value, {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(key, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [key, value, {}]
+                return
+            node = child
+
+    def find(self, key, max_distance):
+        """距離 max_distance 以内の (距離, 値) を近い順に返します。"""
+        found, stack = [], [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(key, node[0])
+            if d <= max_distance:
+                found.append((d, node[1]))
+            # 三角不等式により、子への距離が d ± max_distance の範囲外の枝は調べなくてよい
+            stack.extend(child for dist, child in node[2].items() if abs(dist - d) <= max_distance)
+        found.sort(key=lambda item: item[0])
+        return found
+
+
+class _Group:
+    """ほぼ同一の画像のグループ。代表の1枚だけを埋め込み、ベクトルを全員で共有します。"""
+
+    def __init__(self, model_name, output_dimensionality, aspect):
+        self.model_name = model_name
+        self.output_dimensionality = output_dimensionality
+        self.aspect = aspect
+        self.vector = None
+        self.failed = False
+        self.done = threading.Event()
+
+
+class PerceptualDeduper:
+    """
+    埋め込み前の知覚ハッシュによる重複除去。
+
+    画像ごとに pHash (または dHash) を計算し、BK-tree で距離 max_distance 以内の
+    画像を同じグループにまとめ、グループの代表1枚だけを API に送ります。
+    表紙・定型スライド・同じ写真などは、文書をまたいでも同じベクトルを再利用します。
+    テキストと動画はそのまま埋め込みます (完全一致はエンベディングキャッシュが処理します)。
+    グループはモデル名と出力次元数ごとに分けるので、次元数の違うベクトルが混ざることはありません。
+    内容がわずかに違うだけの画像も同じベクトルになるため、ページの変更を検出したい
+    用途 (incremental_indexer など) では使わないでください。
+    dHash は小さなロゴの有無で数ビットしか変わらないため、ロゴを探す用途では pHash を使ってください。
+    """
+
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE, method="phash"):
+        self.max_distance = max_distance
+        self.hash_fn = {"phash": phash, "dhash": dhash}[method]
+        self.tree = BKTree()
+        self.items = 0
+        self.images = 0
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    def _group_for(self, model_name, output_dimensionality, gray):
+        """画像の属するグループと、新しく作ったグループかどうかを返します。"""
+        key = self.hash_fn(gray)
+        aspect = gray.shape[1] / max(gray.shape[0], 1)
+        with self._lock:
+            for _, group in self.tree.find(key, self.max_distance):
+                if group.model_name == model_name and group.output_dimensionality == output_dimensionality \
+                        and not group.failed \
+                        and abs(group.aspect - aspect) <= ASPECT_TOLERANCE * aspect:
+                    self.duplicates += 1
+                    return group, False
+            group = _Group(model_name, output_dimensionality, aspect)
+            self.tree.add(key, group)
+            return group, True
+
+    def embed(self, model_name, contents, embed_fn=embed_batch, output_dimensionality=OUTPUT_DIMENSIONALITY):
+        """
+        contents を embed_fn (embed_batch と同じ形の関数) で埋め込みます。
+        ほぼ同一の画像は代表だけを送り、入力と同じ順序のベクトルのリストを返します。
+        output_dimensionality は embed_fn が返すベクトルの出力次元数で、グループを分けるのに使います。
+        """
+        groups = [None] * len(contents)
+        send = []           # (入力の番号, 新しく作ったグループ or None)
+        for i, content in enumerate(contents):
+            gray = _to_gray(content)
+            if gray is None:
+                send.append((i, None))
+                continue
+            group, created = self._group_for(model_name, output_dimensionality, gray)
+            groups[i] = group
+            if created:
+                send.append((i, group))
+        with self._lock:
+            self.items += len(contents)
+            self.images += sum(g is not None for g in groups)
+
+        results = [None] * len(contents)
+        try:
+            embs = embed_fn(model_name, [contents[i] for i, _ in send]) if send else []
+            for (i, group), emb in zip(send, embs):
+                results[i] = emb
+                if group is not None:
+                    group.vector = emb
+                    group.failed = emb is None
+        finally:
+            for _, group in send:
+                if group is not None:
+                    group.failed = group.failed or group.vector is None
+                    group.done.set()
+
+        for i, group in enumerate(groups):
+            if group is not None and results[i] is None:
+                # 別スレッドが埋め込み中の代表なら、その結果を待つ
+                group.done.wait()
+                results[i] = group.vector
+        return results
+
+    def stats(self):
+        return {
+            "items": self.items,
+            "images": self.images,
+            "duplicates": self.duplicates,
+            "groups": self.tree.size,
+        }
+
+
+_default_deduper = None
+
+
+def get_default_deduper():
+    """プロセス内で共有するデフォルトの重複除去器を返します。"""
+    global _default_deduper
+    if _default_deduper is None:
+        _default_deduper = PerceptualDeduper()
+    return _default_deduper
+
+
+def deduplicated(embed_fn=embed_batch, deduper=None, output_dimensionality=OUTPUT_DIMENSIONALITY):
+    """
+    embed_fn (model_name, contents) を、ほぼ同一の画像を1回だけ送る関数に包みます。
+    embed_pdf_pages などの embed_fn 引数にそのまま渡せます。
+    output_dimensionality には embed_fn が返すベクトルの出力次元数を指定してください。
+    """
+    def embed(model_name, contents):
+        return (deduper or get_default_deduper()).embed(model_name, contents, embed_fn, output_dimensionality)
+    return embed
+
+
+def dedup_embed_content(model_name, content, deduper=None, output_dimensionality=OUTPUT_DIMENSIONALITY):
+    """cached_embed_content の重複除去付き版です (1件ずつ埋め込む get_embedding 用)。"""
+    single = lambda m, contents: [cached_embed_content(m, c, output_dimensionality) for c in contents]
+    return (deduper or get_default_deduper()).embed(model_name, [content], single, output_dimensionality)[0]
+
+
+def print_dedup_stats(deduper=None):
+    """重複除去で API に送らずに済んだ画像の数をターミナルに表示します。"""
+    s = (deduper or get_default_deduper()).stats()
+    rate = s["duplicates"] / s["images"] if s["images"] else 0.0
+    print(f"🪞 重複除去: 画像 {s['images']} 件中 {s['duplicates']} 件を代表のベクトルで代用 "
+          f"(削減率 {rate:.0%}, グループ数 {s['groups']})")
@@ -0,0 +1,135 @@
+import os
+import numpy as np
+
+RERANK_FACTOR = 10          # 量子化したスコアで残す候補数 (k の何倍か)。元のベクトルで並べ直す
+DEFAULT_BLOCK_ROWS = 4096     # int8 を float32 に戻すブロックが CPU キャッシュに収まる大きさ
+MODES = ("int8", "binary")
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(x):
+        return _POPCOUNT_TABLE[x]
+
+
+class QuantizedIndex:
+    """
+    エンベディングを量子化して持つ、メモリの小さい全件検索インデックス。
+
+    - int8   : 次元ごとの最大絶対値で [-127, 127] に丸める (float32 の 1/4)
+    - binary : 符号の1ビットだけを持ち、ハミング距離で比べる (float32 の 1/32)
+
+    量子化したスコアで k × rerank_factor 件の候補に絞り、rerank_vectors
+    (EmbeddingStore.vectors など) を渡せばその候補だけを元のベクトルで並べ直します。
+    追記専用のストアに合わせ、add() は新しい行だけを量子化して末尾に足します。
+    """
+
+    def __init__(self, dim, mode="int8"):
+        if mode not in MODES:
+            raise ValueError(f"mode は {MODES} のいずれかを指定してください: {mode}")
+        self.dim = dim
+        self.mode = mode
+        self.scale = None   # int8 の次元ごとの倍率
+        width = dim if mode == "int8" else (dim + 7) // 8
+        self.codes = np.empty((0, width), dtype=np.int8 if mode == "int8" else np.uint8)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def train(self, x):
+        """int8 の倍率を、サンプルの次元ごとの最大絶対値から決めます (binary では不要)。"""
+        if self.mode == "int8":
+            peak = np.abs(np.asarray(x, dtype=np.float32)).max(axis=0)
+            self.scale = (np.where(peak == 0, 1.0, peak) / 127.0).astype(np.float32)
+        return self
+
+    def encode(self, x):
+        x = np.asarray(x, dtype=np.float32).reshape(-1, self.dim)
+        if self.mode == "int8":
+            return np.clip(np.rint(x / self.scale), -127, 127).astype(np.int8)
+        return np.packbits(x > 0, axis=1)
+
+    def add(self, vectors, block_rows=DEFAULT_BLOCK_ROWS):
+        """vectors の、まだ量子化していない行 (len(self) 以降) を追加します。"""
+        if self.mode == "int8" and self.scale is None:
+            self.train(vectors[:min(len(vectors), 100_000)])
+        new = [self.encode(vectors[start:start + block_rows])
+               for start in range(len(self), len(vectors), block_rows)]
+        if new:
+            self.codes = np.concatenate([self.codes] + new)
+        return self
+
+    def scores(self, query, block_rows=DEFAULT_BLOCK_ROWS):
+        """全行の量子化したスコア (大きいほど近い) を返します。"""
+        q = np.asarray(query, dtype=np.float32).ravel()
+        out = np.empty(len(self), dtype=np.float32)
+        if self.mode == "int8":
+            # 倍率はクエリ側に掛けておけば、行ごとに元のスケールへ戻す必要がない
+            qs = q * self.scale
+            for start in range(0, len(self), block_rows):
+                out[start:start + block_rows] = self.codes[start:start + block_rows].astype(np.float32) @ qs
+        else:
+            q_bits = np.packbits(q > 0)
+            for start in range(0, len(self), block_rows):
+                block = self.codes[start:start + block_rows]
+                out[start:start + len(block)] = -_popcount(block ^ q_bits).sum(axis=1, dtype=np.int32)
+        return out
+
+    def search(self, query, k=10, rerank_vectors=None, rerank_factor=RERANK_FACTOR, deleted=None):
+        """
+        上位 k 件を (ID 配列, 類似度配列) で返します。
+        rerank_vectors を渡すと、k × rerank_factor 件の候補を元のベクトルとの
+        コサイン類似度で並べ直します。渡さなければ量子化したスコアのままです。
+        deleted (ブール配列) で True の行は除外します。
+        """
+        scores = self.scores(query)
+        if deleted is not None:
+            scores[deleted[:len(scores)]] = -np.inf
+        shortlist = min(len(scores), k * rerank_factor if rerank_vectors is not None else k)
+        if shortlist == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids = np.argpartition(-scores, shortlist - 1)[:shortlist]
+        ids = ids[np.isfinite(scores[ids])]
+        if rerank_vectors is not None:
+            ids = np.sort(ids)
+            q = np.asarray(query, dtype=np.float32).ravel()
+            sims = np.asarray(rerank_vectors[ids], dtype=np.float32) @ (q / (np.linalg.norm(q) or 1.0))
+        else:
+            sims = scores[ids]
+        order = np.argsort(-sims)[:k]
+        return ids[order].astype(np.int64), sims[order].astype(np.float32)
+
+    def save(self, path):
+        np.savez(path, dim=self.dim, mode=self.mode, codes=self.codes,
+                 scale=self.scale if self.scale is not None else np.empty(0, dtype=np.float32))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(int(data["dim"]), str(data["mode"]))
+        index.codes = data["codes"]
+        index.scale = data["scale"] if len(data["scale"]) else None
+        return index
+
+    @classmethod
+    def for_store(cls, store, mode="int8"):
+        """
+        EmbeddingStore に対応する量子化インデックスを返します (ID はストアの行番号)。
+        ストアのディレクトリに quantized_<mode>.npz として保存し、次回はストアに
+        追記された行だけを量子化します。
+        """
+        path = os.path.join(store.path, f"quantized_{mode}.npz")
+        index = cls.load(path) if os.path.exists(path) else cls(store.dim, mode)
+        # ストアが作り直された (行数が減った・出力次元数が変わった) ときは最初から量子化し直す
+        if len(index) > len(store) or index.dim != store.dim:
+            index = cls(store.dim, mode)
+        if len(index) < len(store):
+            index.add(store.vectors)
+            index.save(path)
+        return index
@@ -1,10 +1,13 @@
 import os
-import io
 import numpy as np
-import base64
 from PIL import Image
 import google.generativeai as genai
 from dotenv import load_dotenv
+from embedding_config import MODEL_NAME
+from embedding_cache import print_cache_stats
+from image_payload import image_payload
+from embedding_batch import embed_batch
+from perceptual_dedup import dedup_embed_content
 
 # .env ファイルから API キーを読み込む
 load_dotenv()
@@ -15,24 +18,17 @@ if not api_key:
     exit(1)
 
 genai.configure(api_key=api_key)
-model_name = "models/gemini-embedding-2-preview"
+model_name = MODEL_NAME
 
 def get_embedding(content):
     """
     テキストまたは画像からエンベディングを取得します。
     """
     if isinstance(content, Image.Image):
-        # 画像をBytesに変換してBase64エンコード
-        buffered = io.BytesIO()
-        content.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        content = {"mime_type": "image/jpeg", "data": img_str}
+        # 画像を1回だけエンコードしてembed_contentに渡せるフォーマットに変換
+        content = image_payload(content)
         
-    result = genai.embed_content(
-        model=model_name,
-        content=content
-    )
-    return np.array(result['embedding'])
+    return dedup_embed_content(model_name, content)
 
 def main():
     image_path = "image1.png"
@@ -55,9 +51,13 @@ def main():
     img_emb = get_embedding(img)
     print("✅ 画像のエンベディング取得完了")
 
+    # テキストはまとめて1回のバッチで送信
+    text_embs = embed_batch(model_name, texts)
+
     results = []
-    for i, text in enumerate(texts):
-        text_emb = get_embedding(text)
+    for i, (text, text_emb) in enumerate(zip(texts, text_embs)):
+        if text_emb is None:
+            continue
         # 内積 (Dot Product) の計算
         dot_product = np.dot(img_emb, text_emb)
         
@@ -73,6 +73,7 @@ def main():
             "cosine": cosine_sim
         })
         print(f"✅ テキスト {i+1} の処理完了")
+    print_cache_stats()
 
     print("\n--- 比較結果 (類似度) ---")
     # 類似度が高い順にソートして表示
@@ -0,0 +1,326 @@
+import numpy as np
+
+DEFAULT_TABLES = 8          # ハッシュテーブルの数 (増やすほど見逃しが減り、メモリが増える)
+DEFAULT_BITS = 16           # 1テーブルあたりの超平面の数 (バケットの細かさ)
+DEFAULT_PROBES = 8          # 検索・クラスタリングで追加で調べる、1ビットだけ違うバケットの数
+DEFAULT_THRESHOLD = 0.95    # クラスタリングでほぼ同一とみなすコサイン類似度
+CLUSTER_BLOCK = 1024        # バケット内の照合を何件ずつ行列積にするか
+SMALL_BUCKET = 8            # これ以下の大きさのバケットは全ペアをまとめて照合する (リーダーを作らない)
+
+
+class UnionFind:
+    """経路半減つきの素集合データ構造。"""
+
+    def __init__(self, n):
+        self.parent = np.arange(n, dtype=np.int64)
+
+    def find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            # 小さい番号を根にしておくと、クラスタの代表が入力順で最初の要素になる
+            if ra < rb:
+                self.parent[rb] = ra
+            else:
+                self.parent[ra] = rb
+
+    def labels(self):
+        """要素ごとのクラスタ番号 (0 から連番) を返します。"""
+        # 全要素の親を祖父に置き換える操作を変化がなくなるまで繰り返し、根まで一度に圧縮する
+        parent = self.parent
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+        self.parent = parent
+        return np.unique(parent, return_inverse=True)[1]
+
+
+def bits_for(n):
+    """
+    件数 n に合わせた超平面の数。バケットの平均の大きさを数件に保ち、
+    件数が増えてもバケット内の照合が増えない (全体で線形に近い) ようにします。
+    """
+    return int(min(32, max(DEFAULT_BITS, np.ceil(np.log2(max(n, 1))) - 2)))
+
+
+def _expand_ranges(lo, hi):
+    """各 i の範囲 [lo[i], hi[i]) を連結し、(範囲の番号, 位置) の配列で返します。"""
+    n = np.maximum(hi - lo, 0)
+    owner = np.repeat(np.arange(len(lo)), n)
+    return owner, np.repeat(lo, n) + np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+
+
+class _Rows:
+    """vectors の一部の行 (rows) を、コピーせずに 0 からの行番号で参照するビュー。"""
+
+    def __init__(self, vectors, rows):
+        self.vectors = vectors
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, key):
+        return self.vectors[self.rows[key]]
+
+
+def _normalized(vectors, ids):
+    block = np.asarray(vectors[np.sort(ids)], dtype=np.float32)
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.sort(ids), block / norms
+
+
+class SimHashIndex:
+    """
+    ランダム超平面による LSH (SimHash) のインデックス。
+
+    ベクトルを n_bits 枚の超平面のどちら側にあるかのビット列にし、n_tables 個の
+    テーブルでそれぞれバケットに分けます。コサイン類似度が高いほど同じバケットに入りやすく、
+    検索ではさらに境界に近い (符号が反転しやすい) ビットを反転したバケットも調べます (multi-probe)。
+    ベクトル本体は持たず、照合には元の行列 (EmbeddingStore.vectors など) を使います。
+    """
+
+    def __init__(self, dim, n_tables=DEFAULT_TABLES, n_bits=DEFAULT_BITS, seed=0):
+        if n_bits > 32:
+            raise ValueError(f"n_bits は 32 以下にしてください: {n_bits}")
+        self.dim = dim
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        rng = np.random.default_rng(seed)
+        self.planes = rng.standard_normal((n_tables * n_bits, dim)).astype(np.float32)
+        self.weights = (1 << np.arange(n_bits, dtype=np.uint64)).astype(np.uint32)
+        self.vectors = None
+        self.codes = np.empty((0, n_tables), dtype=np.uint32)
+        self.flips = np.empty((0, DEFAULT_PROBES), dtype=np.int16)  # 境界に近い (テーブル, ビット) の通し番号
+        self.inv_norms = np.empty(0, dtype=np.float32)
+        self._tables = None
+
+    def __len__(self):
+        return len(self.codes)
+
+    def project(self, x):
+        """(件数, テーブル数, ビット数) の射影値を返します。符号がハッシュのビットです。"""
+        x = np.asarray(x, dtype=np.float32).reshape(-1, self.dim)
+        return (x @ self.planes.T).reshape(len(x), self.n_tables, self.n_bits)
+
+    def add(self, vectors, probes=DEFAULT_PROBES, block_rows=65536):
+        """
+        vectors (ndarray や np.memmap) の全行を登録します。行番号が ID になります。
+        バケット番号と一緒に、クラスタリングで反転して調べる probes 個の境界に近いビットと
+        ノルムの逆数も記録しておきます。
+        """
+        n = len(vectors)
+        self.vectors = vectors
+        self.codes = np.empty((n, self.n_tables), dtype=np.uint32)
+        self.flips = np.empty((n, probes), dtype=np.int16)
+        self.inv_norms = np.empty(n, dtype=np.float32)
+        for start in range(0, n, block_rows):
+            block = np.asarray(vectors[start:start + block_rows], dtype=np.float32)
+            proj = self.project(block)
+            stop = start + len(block)
+            self.codes[start:stop] = ((proj > 0) * self.weights).sum(axis=2, dtype=np.uint32)
+            if probes:
+                margins = np.abs(proj).reshape(len(block), -1)
+                self.flips[start:stop] = np.argpartition(margins, probes - 1, axis=1)[:, :probes]
+            norms = np.linalg.norm(block, axis=1)
+            self.inv_norms[start:stop] = 1.0 / np.where(norms == 0, 1.0, norms)
+        self._tables = None
+        return self
+
+    @classmethod
+    def from_store(cls, store, n_tables=DEFAULT_TABLES, n_bits=None, seed=0):
+        """
+        EmbeddingStore の全ページからインデックスを作ります (ID はストアの行番号)。
+        n_bits を省略すると件数から決めます (bits_for)。
+        """
+        return cls(store.dim, n_tables, n_bits or bits_for(len(store)), seed).add(store.vectors)
+
+    def tables(self):
+        """テーブルごとの (バケット番号の昇順に並べた ID, その並びのバケット番号) を返します。"""
+        if self._tables is None:
+            self._tables = []
+            for t in range(self.n_tables):
+                order = np.argsort(self.codes[:, t], kind="stable")
+                self._tables.append((order, self.codes[order, t]))
+        return self._tables
+
+    def bucket(self, table, code):
+        order, sorted_codes = self.tables()[table]
+        # code + 1 は n_bits=32 で 0xFFFFFFFF のときに桁あふれするので、左右の端を別々に探す
+        lo = np.searchsorted(sorted_codes, code, side="left")
+        hi = np.searchsorted(sorted_codes, code, side="right")
+        return order[lo:hi]
+
+    def candidates(self, query, probes=DEFAULT_PROBES):
+        """クエリと同じバケット、および境界に近いビットを1つ反転したバケットの ID を返します。"""
+        proj = self.project(query)[0]
+        codes = ((proj > 0) * self.weights).sum(axis=1, dtype=np.uint32)
+        found = [self.bucket(t, codes[t]) for t in range(self.n_tables)]
+        if probes:
+            # |射影値| が小さいビットほど、近いベクトルとの間で符号が反転しやすい
+            margins = np.abs(proj)
+            flat = np.argsort(margins, axis=None)[:probes]
+            for t, bit in zip(*np.unravel_index(flat, margins.shape)):
+                found.append(self.bucket(t, codes[t] ^ self.weights[bit]))
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+
+    def search(self, query, k=10, probes=DEFAULT_PROBES):
+        """候補を元のベクトルで正確に並べ直し、上位 k 件を (ID 配列, 類似度配列) で返します。"""
+        ids = self.candidates(query, probes)
+        if len(ids) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        q = np.asarray(query, dtype=np.float32).ravel()
+        q = q / (np.linalg.norm(q) or 1.0)
+        ids, block = _normalized(self.vectors, ids)
+        sims = block @ q
+        order = np.argsort(-sims)[:k]
+        return ids[order], sims[order]
+
+    def _bucket_leaders(self, ids, uf, threshold):
+        """
+        バケット内の要素を、既存のリーダーとの類似度で振り分けてリーダーの ID を返します。
+        どのリーダーにも threshold 未満の要素は新しいリーダーになります。
+        リーダーとの比較だけで済むので、重複の多いバケットでも計算量は線形に近くなります。
+        """
+        leaders, leader_vecs = [], np.empty((0, self.dim), dtype=np.float32)
+        for start in range(0, len(ids), CLUSTER_BLOCK):
+            block_ids, block = _normalized(self.vectors, ids[start:start + CLUSTER_BLOCK])
+            if leaders:
+                sims = block @ leader_vecs.T
+                best = sims.argmax(axis=1)
+                matched = sims[np.arange(len(block)), best] >= threshold
+                for i in np.flatnonzero(matched):
+                    uf.union(block_ids[i], leaders[best[i]])
+                block_ids, block = block_ids[~matched], block[~matched]
+            if len(block_ids) == 0:
+                continue
+            sims = block @ block.T
+            assigned = np.zeros(len(block_ids), dtype=bool)
+            new_leaders = []
+            for i in range(len(block_ids)):
+                if assigned[i]:
+                    continue
+                new_leaders.append(i)
+                members = np.flatnonzero(~assigned & (sims[i] >= threshold))
+                for j in members:
+                    uf.union(block_ids[i], block_ids[j])
+                assigned[members] = True
+            leaders.extend(block_ids[new_leaders])
+            leader_vecs = np.concatenate([leader_vecs, block[new_leaders]])
+        return np.asarray(leaders, dtype=np.int64)
+
+    def _union_similar(self, a, b, uf, threshold, block_pairs=65536):
+        """ID のペア (a[i], b[i]) のうち、類似度が threshold 以上のものを統合します。"""
+        for start in range(0, len(a), block_pairs):
+            pa, pb = a[start:start + block_pairs], b[start:start + block_pairs]
+            sims = np.einsum("ij,ij->i", np.asarray(self.vectors[pa], dtype=np.float32),
+                             np.asarray(self.vectors[pb], dtype=np.float32))
+            sims *= self.inv_norms[pa] * self.inv_norms[pb]
+            for i in np.flatnonzero(sims >= threshold):
+                uf.union(pa[i], pb[i])
+
+    def cluster(self, threshold=DEFAULT_THRESHOLD, probe=True):
+        """
+        コサイン類似度が threshold 以上のものを同じクラスタにまとめ、要素ごとの
+        クラスタ番号を返します (全ペアは比較しません)。
+
+        1. テーブルごとに、同じバケットの要素を union-find に統合する
+           (小さなバケットは全ペア、大きなバケットはリーダーとの比較)
+        2. probe=True なら、各要素の境界に近いビットを反転したバケットのリーダーとも比較する
+        Python のループは大きなバケットの数だけで、件数には比例しません。
+        """
+        uf = UnionFind(len(self))
+        for t, (order, sorted_codes) in enumerate(self.tables()):
+            codes, starts, counts = np.unique(sorted_codes, return_index=True, return_counts=True)
+            # 小さなバケットは、バケット内の全ペアをまとめて照合する
+            small = counts <= SMALL_BUCKET
+            bucket, pos = _expand_ranges(starts[small], starts[small] + counts[small])
+            ends = (starts[small] + counts[small])[bucket]
+            first, partner = _expand_ranges(pos + 1, ends)
+            self._union_similar(order[pos[first]], order[partner], uf, threshold)
+            # 大きなバケットはリーダーとの比較で統合し、リーダーだけを残す
+            leader_ids, leader_codes = [order[pos]], [sorted_codes[pos]]
+            for code, lo, n in zip(codes[~small], starts[~small], counts[~small]):
+                ids = self._bucket_leaders(order[lo:lo + n], uf, threshold)
+                leader_ids.append(ids)
+                leader_codes.append(np.full(len(ids), code, dtype=np.uint32))
+            if not probe or not self.flips.shape[1]:
+                continue
+            ids, lc = np.concatenate(leader_ids), np.concatenate(leader_codes)
+            by_code = np.argsort(lc, kind="stable")
+            ids, lc = ids[by_code], lc[by_code]
+            rows, cols = np.nonzero(self.flips // self.n_bits == t)
+            flipped = self.codes[rows, t] ^ self.weights[self.flips[rows, cols] % self.n_bits]
+            lo = np.searchsorted(lc, flipped, side="left")
+            hi = np.searchsorted(lc, flipped, side="right")
+            owner, partner = _expand_ranges(lo, hi)
+            self._union_similar(rows[owner], ids[partner], uf, threshold)
+        return uf.labels()
+
+    def save(self, path):
+        np.savez(path, dim=self.dim, n_tables=self.n_tables, n_bits=self.n_bits,
+                 planes=self.planes, codes=self.codes, flips=self.flips, inv_norms=self.inv_norms)
+
+    @classmethod
+    def load(cls, path, vectors=None):
+        """保存したインデックスを読み込みます。検索・クラスタリングには元の vectors が必要です。"""
+        data = np.load(path)
+        index = cls(int(data["dim"]), int(data["n_tables"]), int(data["n_bits"]))
+        index.planes = data["planes"]
+        index.codes = data["codes"]
+        index.flips = data["flips"]
+        index.inv_norms = data["inv_norms"]
+        index.vectors = vectors
+        return index
+
+
+def cluster_near_duplicates(vectors, threshold=DEFAULT_THRESHOLD, n_tables=DEFAULT_TABLES,
+                            n_bits=None, probe=True, seed=0):
+    """
+    vectors をほぼ同一のもの同士でクラスタリングし、要素ごとのクラスタ番号を返します。
+    n_bits を省略すると件数から決めます (bits_for)。
+    """
+    vectors = np.asarray(vectors, dtype=np.float32) if isinstance(vectors, list) else vectors
+    index = SimHashIndex(vectors.shape[1], n_tables, n_bits or bits_for(len(vectors)), seed).add(vectors, probes=DEFAULT_PROBES if probe else 0)
+    return index.cluster(threshold, probe)
+
+
+def print_store_clusters(store, threshold=DEFAULT_THRESHOLD, max_clusters=10):
+    """
+    EmbeddingStore のページをほぼ同一のものでまとめ、大きいクラスタから表示します。
+    ストアの行ごとのクラスタ番号を返します (削除扱いの行は -1)。
+    """
+    # 削除扱いの行が有効なページ同士をつながないよう、有効な行だけをクラスタリングする
+    # (store.vectors[live] は全件をメモリにコピーするので、行番号を読み替えるビューで渡す)
+    live = np.flatnonzero(~store.deleted_mask())
+    index = SimHashIndex(store.dim, n_bits=bits_for(len(live))).add(_Rows(store.vectors, live))
+    live_labels = index.cluster(threshold)
+    labels = np.full(len(store), -1, dtype=np.int64)
+    labels[live] = live_labels
+    sizes = np.bincount(live_labels, minlength=live_labels.max() + 1 if len(live_labels) else 0)
+    groups = [c for c in np.argsort(-sizes) if sizes[c] > 1][:max_clusters]
+    print(f"🧬 {len(live)} ページ中 {int(sizes[sizes > 1].sum())} ページが "
+          f"{int((sizes > 1).sum())} 個のほぼ同一クラスタに属しています (しきい値 {threshold})")
+    for c in groups:
+        rows = live[live_labels == c]
+        pages = ", ".join(f"{doc} p{page}" for doc, page, _ in (store.describe(r) for r in rows[:5]))
+        print(f"  [{sizes[c]} ページ] {pages}{' ...' if len(rows) > 5 else ''}")
+    return labels
+
+
+if __name__ == "__main__":
+    from embedding_store import EmbeddingStore
+
+    STORE_DIR = "page_store"      # EmbeddingStore のディレクトリ
+    THRESHOLD = DEFAULT_THRESHOLD # ほぼ同一とみなすコサイン類似度
+
+    print_store_clusters(EmbeddingStore(STORE_DIR), THRESHOLD)
@@ -0,0 +1,139 @@
+import numpy as np
+
+# 1ブロックあたりの行数。block_size² × 4 バイトが1タイルの作業メモリになります
+DEFAULT_BLOCK_SIZE = 4096
+
+
+def normalize_rows(embeddings, dtype=np.float32, block_size=DEFAULT_BLOCK_SIZE, out=None):
+    """
+    エンベディングを L2 正規化し、連続した (N, D) 行列として返します。
+    out に np.memmap などを渡すと、ブロック単位でそこに書き込みます。
+    """
+    if isinstance(embeddings, np.ndarray) and embeddings.ndim == 2:
+        source = embeddings
+    else:
+        source = np.asarray([np.asarray(e, dtype=np.float32) for e in embeddings], dtype=np.float32)
+    if out is None:
+        out = np.empty(source.shape, dtype=dtype)
+    for start in range(0, source.shape[0], block_size):
+        block = np.asarray(source[start:start + block_size], dtype=np.float32)
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        out[start:start + block_size] = block / norms
+    return out
+
+
+def iter_similarity_blocks(a, b=None, block_size=DEFAULT_BLOCK_SIZE, distance=False):
+    """
+    正規化済みの行列 a, b のコサイン類似度 (distance=True ならコサイン距離) を
+    (行の開始位置, 列の開始位置, タイル) の形でブロックごとに返します。
+    """
+    b = a if b is None else b
+    for i in range(0, a.shape[0], block_size):
+        a_block = np.asarray(a[i:i + block_size], dtype=np.float32)
+        for j in range(0, b.shape[0], block_size):
+            b_block = np.asarray(b[j:j + block_size], dtype=np.float32)
+            tile = a_block @ b_block.T
+            if distance:
+                np.subtract(1.0, tile, out=tile)
+            yield i, j, tile
+
+
+def similarity_matrix(a, b=None, block_size=DEFAULT_BLOCK_SIZE, distance=False,
+                      dtype=np.float32, normalized=False, out=None):
+    """
+    コサイン類似度 (distance=True ならコサイン距離) の行列を計算します。
+    a, b はエンベディングのリストまたは行列です。normalized=True なら正規化を省略します。
+    dtype=np.float16 を指定すると結果を半精度で保持します。
+    """
+    a_n = a if normalized else normalize_rows(a, block_size=block_size)
+    if b is None:
+        b_n = a_n
+    else:
+        b_n = b if normalized else normalize_rows(b, block_size=block_size)
+    if out is None:
+        out = np.empty((a_n.shape[0], b_n.shape[0]), dtype=dtype)
+    for i, j, tile in iter_similarity_blocks(a_n, b_n, block_size, distance):
+        out[i:i + tile.shape[0], j:j + tile.shape[1]] = tile
+    return out
+
+
+def similarity_matrix_to_disk(path, a, b=None, block_size=DEFAULT_BLOCK_SIZE,
+                              distance=False, dtype=np.float16, normalized=False):
+    """
+    巨大な類似度行列をメモリに載せず、.npy ファイルへタイル単位で書き出します。
+    作業メモリは入力の正規化済み行列と block_size² 程度のタイルのみです。
+    """
+    a_n = a if normalized else normalize_rows(a, block_size=block_size)
+    b_n = a_n if b is None else (b if normalized else normalize_rows(b, block_size=block_size))
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=dtype,
+                                    shape=(a_n.shape[0], b_n.shape[0]))
+    for i, j, tile in iter_similarity_blocks(a_n, b_n, block_size, distance):
+        out[i:i + tile.shape[0], j:j + tile.shape[1]] = tile
+    out.flush()
+    return out
+
+
+def iter_topk_join(a, b=None, k=10, block_size=DEFAULT_BLOCK_SIZE, normalized=False, exclude_self=None):
+    """
+    a の各行について b の中で類似度の高い上位 k 件だけを残す「類似度結合」を、
+    (行の開始位置, 近傍の番号 (rows, k), 類似度 (rows, k)) の形でブロックごとに返します。
+    N×N の行列は作らず、列方向のタイルごとに前回までの上位 k 件とまとめて argpartition で
+    絞り込むため、作業メモリは block_size × (block_size + k) 程度です。
+    b を省略した場合 (a 同士の結合) は、既定で自分自身を近傍から除きます。
+    近傍は類似度の高い順に並び、候補が k 件に満たない行は番号 -1 で埋めます。
+    """
+    self_join = b is None
+    exclude_self = self_join if exclude_self is None else exclude_self
+    a_n = a if normalized else normalize_rows(a, block_size=block_size)
+    b_n = a_n if self_join else (b if normalized else normalize_rows(b, block_size=block_size))
+    n_b = b_n.shape[0]
+    for i in range(0, a_n.shape[0], block_size):
+        a_block = np.asarray(a_n[i:i + block_size], dtype=np.float32)
+        rows = a_block.shape[0]
+        best_ids = np.full((rows, k), -1, dtype=np.int64)
+        best_scores = np.full((rows, k), -np.inf, dtype=np.float32)
+        for j in range(0, n_b, block_size):
+            tile = a_block @ np.asarray(b_n[j:j + block_size], dtype=np.float32).T
+            if exclude_self and j < i + rows and i < j + tile.shape[1]:
+                # 対角成分 (自分自身) を候補から外す
+                r = np.arange(max(i, j), min(i + rows, j + tile.shape[1]))
+                tile[r - i, r - j] = -np.inf
+            # 前回までの上位 k 件を先頭に並べ、列番号は位置から復元する (番号の配列は作らない)
+            scores = np.concatenate([best_scores, tile], axis=1)
+            top = np.argpartition(scores, -k, axis=1)[:, -k:]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_ids = np.where(top < k, np.take_along_axis(best_ids, np.minimum(top, k - 1), axis=1),
+                                top - k + j)
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        best_ids[np.isneginf(best_scores)] = -1
+        yield i, best_ids, best_scores
+
+
+def topk_join(a, b=None, k=10, block_size=DEFAULT_BLOCK_SIZE, normalized=False, exclude_self=None):
+    """iter_topk_join の結果を (近傍の番号 (N, k), 類似度 (N, k)) にまとめて返します。"""
+    blocks = list(iter_topk_join(a, b, k, block_size, normalized, exclude_self))
+    if not blocks:
+        return np.empty((0, k), dtype=np.int64), np.empty((0, k), dtype=np.float32)
+    return (np.concatenate([ids for _, ids, _ in blocks]),
+            np.concatenate([scores for _, _, scores in blocks]))
+
+
+def topk_join_to_disk(path_prefix, a, b=None, k=10, block_size=DEFAULT_BLOCK_SIZE,
+                      normalized=False, exclude_self=None):
+    """
+    類似度結合の結果を <path_prefix>_ids.npy (int32) と <path_prefix>_scores.npy (float32) に
+    クエリのブロックごとに書き出します。ピークメモリは全体の行数に依存しません。
+    """
+    n = len(a)
+    ids_out = np.lib.format.open_memmap(f"{path_prefix}_ids.npy", mode="w+", dtype=np.int32, shape=(n, k))
+    scores_out = np.lib.format.open_memmap(f"{path_prefix}_scores.npy", mode="w+", dtype=np.float32,
+                                           shape=(n, k))
+    for i, ids, scores in iter_topk_join(a, b, k, block_size, normalized, exclude_self):
+        ids_out[i:i + len(ids)] = ids
+        scores_out[i:i + len(ids)] = scores
+    ids_out.flush()
+    scores_out.flush()
+    return ids_out, scores_out
@@ -0,0 +1,248 @@
+import cv2
+import numpy as np
+
+# 従来の総当たり探索と同じ 60 段階の縮尺 (大きい方から順に試す)
+DEFAULT_SCALES = np.linspace(0.1, 2.5, 60)[::-1]
+PYRAMID_LEVELS = 4        # ページ画像のピラミッド段数 (1, 1/2, 1/4, 1/8)
+COARSE_MIN_SIDE = 16      # 粗い段で縮小したロゴの短辺がこれ未満にならないようにする
+DEFAULT_TOP_K = 6         # 原寸で精査する候補 (縮尺, 位置) の数
+PRIOR_NEIGHBOURS = 2      # 前のページで見つかった縮尺の前後何段階を先に試すか
+PRIOR_MEMORY = 3          # 先に試す縮尺として覚えておく直近のヒット数
+
+
+def load_logo_gray(logo_path):
+    """
+    ロゴ画像をグレースケールで読み込みます。
+    透過(アルファ)チャンネルがあれば白背景に合成してから変換します。
+    """
+    logo_img = cv2.imread(logo_path, cv2.IMREAD_UNCHANGED)
+    if logo_img is None:
+        raise FileNotFoundError(f"ロゴ画像が見つかりません。ファイル名を確認してください: {logo_path}")
+
+    if len(logo_img.shape) == 3 and logo_img.shape[2] == 4:
+        # アルファチャンネルを使って背景を白にする
+        alpha = logo_img[:, :, 3] / 255.0
+        bg = np.ones_like(logo_img[:, :, :3]) * 255
+        fg = logo_img[:, :, :3]
+        for c in range(3):
+            bg[:, :, c] = alpha * fg[:, :, c] + (1 - alpha) * bg[:, :, c]
+        return cv2.cvtColor(bg.astype(np.uint8), cv2.COLOR_BGR2GRAY)
+    return cv2.cvtColor(logo_img, cv2.COLOR_BGR2GRAY) if len(logo_img.shape) == 3 else logo_img
+
+
+def resize_logo(logo_gray, scale, interpolation=cv2.INTER_LINEAR):
+    """ロゴを縮尺 scale に変換します。幅か高さが 0 になる場合は None を返します。"""
+    new_width = int(logo_gray.shape[1] * scale)
+    new_height = int(logo_gray.shape[0] * scale)
+    if new_width == 0 or new_height == 0:
+        return None
+    return cv2.resize(logo_gray, (new_width, new_height), interpolation=interpolation)
+
+
+def template_stats(template):
+    """テンプレートの (平均, 平均を引いた値の L2 ノルム) を返します。ノルム 0 は無地の画像です。"""
+    values = template.astype(np.float64)
+    mean = values.mean()
+    return mean, float(np.sqrt(((values - mean) ** 2).sum()))
+
+
+class LogoTemplates:
+    """
+    縮尺 (とピラミッド段) ごとのリサイズ済みロゴと統計量のキャッシュ。
+    ページごとに cv2.resize をやり直さないよう、1つの文書の処理中は同じインスタンスを使い回します。
+    """
+
+    def __init__(self, logo_gray, scales=DEFAULT_SCALES):
+        self.logo = logo_gray
+        self.shape = logo_gray.shape
+        self.scales = np.asarray(scales)
+        self._cache = {}
+
+    def get(self, scale, level=0):
+        """
+        縮尺 scale のロゴをピラミッド段 level (1/2**level) に縮小した (画像, 統計量) を返します。
+        縮小すると 0 画素になる場合や無地になる場合は (None, None) です。
+        """
+        key = (round(float(scale), 6), level)
+        if key not in self._cache:
+            template = resize_logo(self.logo, scale / 2 ** level,
+                                   cv2.INTER_AREA if level else cv2.INTER_LINEAR)
+            stats = template_stats(template) if template is not None else None
+            if stats is not None and stats[1] == 0:
+                template, stats = None, None
+            self._cache[key] = (template, stats)
+        return self._cache[key]
+
+
+def as_templates(logo, scales=None):
+    """ndarray のロゴはその場限りの LogoTemplates に包みます。"""
+    if isinstance(logo, LogoTemplates):
+        return logo
+    return LogoTemplates(logo, DEFAULT_SCALES if scales is None else scales)
+
+
+class ScalePrior:
+    """
+    文書内ではロゴがほぼ同じ縮尺で現れることを利用し、前のページでヒットした縮尺と
+    その前後を先に試すための記録です。ヒットしなければ残りの縮尺に広げて探します。
+    """
+
+    def __init__(self, scales=DEFAULT_SCALES, neighbours=PRIOR_NEIGHBOURS, memory=PRIOR_MEMORY):
+        self.scales = np.asarray(scales)
+        self.neighbours = neighbours
+        self.memory = memory
+        self.recent = []          # 直近にヒットした縮尺のインデックス (新しい順)
+        self.prior_hits = 0       # 先に試した縮尺だけで見つかったページ数
+        self.widened = 0          # 残りの縮尺まで広げて探したページ数
+
+    def probe_scales(self):
+        """先に試す縮尺を、直近のヒットに近い順に返します。"""
+        order = []
+        for index in self.recent:
+            for offset in sorted(range(-self.neighbours, self.neighbours + 1), key=abs):
+                i = index + offset
+                if 0 <= i < len(self.scales) and i not in order:
+                    order.append(i)
+        return self.scales[order]
+
+    def remaining_scales(self, probed):
+        probed = set(np.round(probed, 6))
+        return np.array([s for s in self.scales if round(float(s), 6) not in probed])
+
+    def update(self, scale):
+        index = int(np.argmin(np.abs(self.scales - scale)))
+        self.recent = [index] + [i for i in self.recent if i != index][:self.memory - 1]
+
+
+def match_brute_force(page_gray, logo, threshold, scales=None):
+    """
+    原寸のページに対して全縮尺で cv2.matchTemplate を行います (従来の方式)。
+    しきい値を超えた時点で打ち切り、(スコア, 縮尺, 左上座標) を返します。
+    logo はグレースケールのロゴ画像か LogoTemplates です。
+    """
+    templates = as_templates(logo, scales)
+    scales = templates.scales if scales is None else scales
+    best = (-1.0, 1.0, None)
+    for scale in scales:
+        resized_logo, _ = templates.get(scale)
+        # ページ画像よりロゴが大きくなってしまった場合はスキップ
+        if resized_logo is None or page_gray.shape[0] < resized_logo.shape[0] \
+                or page_gray.shape[1] < resized_logo.shape[1]:
+            continue
+        result = cv2.matchTemplate(page_gray, resized_logo, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(result)
+        if max_val > best[0]:
+            best = (max_val, scale, max_loc)
+        if max_val >= threshold:
+            return max_val, scale, max_loc
+    return best
+
+
+def build_pyramid(page_gray, levels=PYRAMID_LEVELS):
+    """ページ画像のピラミッド [原寸, 1/2, 1/4, ...] を作ります。"""
+    pyramid = [page_gray]
+    for _ in range(levels - 1):
+        if min(pyramid[-1].shape[:2]) < 2 * COARSE_MIN_SIDE:
+            break
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+def coarse_level(logo_shape, scale, levels):
+    """縮小したロゴの短辺が COARSE_MIN_SIDE 以上に保てる、最も粗いピラミッド段を返します。"""
+    side = min(logo_shape[:2]) * scale
+    level = 0
+    while level + 1 < levels and side / 2 ** (level + 1) >= COARSE_MIN_SIDE:
+        level += 1
+    return level
+
+
+def match_pyramid(page_gray, logo, threshold, scales=None, top_k=DEFAULT_TOP_K, pyramid=None):
+    """
+    粗密探索によるマルチスケールのテンプレートマッチング。
+
+    1. 全縮尺を、ロゴが十分な大きさを保てる範囲で最も粗いピラミッド段で探索する
+    2. 粗い段のスコアが高い上位 top_k 個の (縮尺, 位置) だけを原寸で精査する
+
+    原寸での精査は候補位置の周辺だけで matchTemplate を行うため、得られるスコアは
+    総当たりと同じ TM_CCOEFF_NORMED の値です。返り値は match_brute_force と同じ
+    (スコア, 縮尺, 左上座標) です。
+    """
+    templates = as_templates(logo, scales)
+    scales = templates.scales if scales is None else scales
+    pyramid = pyramid or build_pyramid(page_gray)
+    page_h, page_w = page_gray.shape[:2]
+
+    candidates = []
+    for scale in scales:
+        full_logo, _ = templates.get(scale)
+        if full_logo is None or page_h < full_logo.shape[0] or page_w < full_logo.shape[1]:
+            continue
+        level = coarse_level(templates.shape, scale, len(pyramid))
+        if level == 0:
+            # 小さなロゴは縮小すると特徴が潰れるので原寸で探索する (ここで確定値が得られる)
+            result = cv2.matchTemplate(page_gray, full_logo, cv2.TM_CCOEFF_NORMED)
+            _, max_val, _, max_loc = cv2.minMaxLoc(result)
+            candidates.append((max_val, scale, max_loc, 0))
+            continue
+        factor = 2 ** level
+        coarse_page = pyramid[level]
+        coarse_logo, _ = templates.get(scale, level)
+        if coarse_logo is None or coarse_page.shape[0] < coarse_logo.shape[0] \
+                or coarse_page.shape[1] < coarse_logo.shape[1]:
+            continue
+        result = cv2.matchTemplate(coarse_page, coarse_logo, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, (x, y) = cv2.minMaxLoc(result)
+        candidates.append((max_val, scale, (x * factor, y * factor), level))
+
+    best = (-1.0, 1.0, None)
+    exact = [c for c in candidates if c[3] == 0]
+    for max_val, scale, loc, _ in exact:
+        if max_val > best[0]:
+            best = (max_val, scale, loc)
+    if best[0] >= threshold:
+        return best
+
+    coarse = sorted((c for c in candidates if c[3] > 0), key=lambda c: -c[0])[:top_k]
+    for _, scale, (x, y), level in coarse:
+        full_logo, _ = templates.get(scale)
+        h, w = full_logo.shape[:2]
+        # 粗い段の 1 画素は原寸で 2**level 画素なので、その分の余白を付けて精査する
+        margin = 2 ** (level + 1)
+        x0, y0 = max(0, x - margin), max(0, y - margin)
+        x1, y1 = min(page_w, x + w + margin), min(page_h, y + h + margin)
+        result = cv2.matchTemplate(page_gray[y0:y1, x0:x1], full_logo, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, (rx, ry) = cv2.minMaxLoc(result)
+        if max_val > best[0]:
+            best = (max_val, scale, (x0 + rx, y0 + ry))
+        if max_val >= threshold:
+            break
+    return best
+
+
+def match_with_prior(page_gray, templates, threshold, prior, method=match_pyramid):
+    """
+    前のページまでにヒットした縮尺 (prior) を先に試し、見つからなければ残りの縮尺に
+    広げて探します。ヒットした縮尺は prior に記録されます。method には match_pyramid か
+    match_brute_force を渡します。返り値は (スコア, 縮尺, 左上座標) です。
+    """
+    pyramid = build_pyramid(page_gray) if method is match_pyramid else None
+    extra = {"pyramid": pyramid} if pyramid is not None else {}
+
+    probe = prior.probe_scales()
+    best = (-1.0, 1.0, None)
+    if len(probe):
+        best = method(page_gray, templates, threshold, scales=probe, **extra)
+        if best[0] >= threshold:
+            prior.prior_hits += 1
+            prior.update(best[1])
+            return best
+
+    prior.widened += 1
+    rest = prior.remaining_scales(probe)
+    if len(rest):
+        wide = method(page_gray, templates, threshold, scales=rest, **extra)
+        best = max(best, wide, key=lambda r: r[0])
+    if best[0] >= threshold:
+        prior.update(best[1])
+    return best
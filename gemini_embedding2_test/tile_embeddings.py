@@ -0,0 +1,166 @@
+import hashlib
+import numpy as np
+from embedding_batch import MAX_BATCH_ITEMS, embed_batch
+from image_payload import image_payload
+from page_raster import rasterize_pages
+
+TILE_GRIDS = (3,)           # ページを何分割した大きさのタイルにするか (例: (2, 3) で2段階の縮尺)
+TILE_OVERLAP = 0.5          # 隣り合うタイルの重なり (0.5 ならタイルの半分ずつずらす)
+TILE_MAX_PIXELS = 512 * 512 # 1タイルあたりの画素数の目安 (3分割なら A4 で zoom=2.0 程度)
+BLANK_STD = 2.0             # 画素値の標準偏差がこれ未満のタイルは余白とみなして埋め込まない
+
+
+def tile_boxes(height, width, grid, overlap=TILE_OVERLAP):
+    """
+    (高さ, 幅) の画像を、1辺が 1/grid のタイルで overlap ずつ重ねて覆う
+    (x0, y0, x1, y1) のリストを返します。端のタイルは画像の端にそろえます。
+    """
+    def starts(size):
+        tile = max(1, int(round(size / grid)))
+        stride = max(size / grid * (1.0 - overlap), 1.0)
+        count = int(round(max(size - tile, 0) / stride)) + 1
+        positions = np.round(np.linspace(0, max(size - tile, 0), count)).astype(int)
+        return [(int(p), int(p) + tile) for p in positions]
+
+    return [(x0, y0, x1, y1) for y0, y1 in starts(height) for x0, x1 in starts(width)]
+
+
+def iter_tiles(img_array, grids=TILE_GRIDS, overlap=TILE_OVERLAP):
+    """ページ画像から (分割数, (x0, y0, x1, y1), タイルの画素) を順に返します (画素はビュー)。"""
+    h, w = img_array.shape[:2]
+    for grid in grids:
+        for box in tile_boxes(h, w, grid, overlap):
+            x0, y0, x1, y1 = box
+            yield grid, box, img_array[y0:y1, x0:x1]
+
+
+def tile_hash(tile):
+    """タイルの画素からハッシュを作ります。同じ画素のタイル (繰り返しのヘッダーなど) は同じ値になります。"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr(tile.shape).encode("utf-8"))
+    h.update(np.ascontiguousarray(tile).data)
+    return h.digest()
+
+
+class TileIndex:
+    """
+    タイル単位のエンベディングのインデックス。
+    ベクトルは正規化して保持し、ページへの問い合わせはページ内の全タイルの
+    類似度の最大値 (max-pooling) で行います。ページ全体のベクトルでは埋もれてしまう
+    小さなロゴも、ロゴを含むタイルの類似度がそのままページのスコアになります。
+    """
+
+    def __init__(self, dim=None):
+        self.dim = dim
+        self.vectors = np.empty((0, dim or 0), dtype=np.float32)
+        self.pages = np.empty(0, dtype=np.int32)
+        self.boxes = np.empty((0, 4), dtype=np.float32)   # ページに対する比率 (x0, y0, x1, y1)
+        self.grids = np.empty(0, dtype=np.int16)
+
+    def __len__(self):
+        return len(self.pages)
+
+    def add(self, vectors, pages, boxes, grids):
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(pages), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1.0, norms)
+        if self.dim is None or len(self) == 0:
+            self.dim = vectors.shape[1]
+            self.vectors = self.vectors.reshape(0, self.dim)
+        self.vectors = np.concatenate([self.vectors, vectors])
+        self.pages = np.concatenate([self.pages, np.asarray(pages, dtype=np.int32)])
+        self.boxes = np.concatenate([self.boxes, np.asarray(boxes, dtype=np.float32).reshape(-1, 4)])
+        self.grids = np.concatenate([self.grids, np.asarray(grids, dtype=np.int16)])
+
+    def search_pages(self, query, k=10):
+        """
+        query に近いページを [(ページ番号, 類似度, 最も近いタイルの位置), ...] で返します。
+        類似度はページ内のタイルの最大値です。
+        """
+        if len(self) == 0:
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        sims = self.vectors @ (query / (np.linalg.norm(query) or 1.0))
+        page_ids, inverse = np.unique(self.pages, return_inverse=True)
+        best = np.full(len(page_ids), -np.inf, dtype=np.float32)
+        np.maximum.at(best, inverse, sims)
+        order = np.argsort(-best)[:k]
+        results = []
+        for i in order:
+            rows = np.flatnonzero(inverse == i)
+            row = rows[np.argmax(sims[rows])]
+            results.append((int(page_ids[i]), float(best[i]), tuple(float(v) for v in self.boxes[row])))
+        return results
+
+    def save(self, path):
+        np.savez(path, vectors=self.vectors, pages=self.pages, boxes=self.boxes, grids=self.grids)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(data["vectors"].shape[1])
+        index.vectors = data["vectors"]
+        index.pages = data["pages"]
+        index.boxes = data["boxes"]
+        index.grids = data["grids"]
+        return index
+
+
+def embed_pdf_tiles(pdf_path, model_name, grids=TILE_GRIDS, overlap=TILE_OVERLAP,
+                    tile_pixels=TILE_MAX_PIXELS, grayscale=False, embed_fn=embed_batch,
+                    batch_size=MAX_BATCH_ITEMS):
+    """
+    PDF の各ページを重なりのあるタイルに分割して埋め込み、(TileIndex, 統計) を返します。
+
+    - ページは最も細かい分割でも1タイルが tile_pixels 程度になる倍率でレンダリングする
+    - 余白だけのタイル (標準偏差が BLANK_STD 未満) は埋め込まない
+    - 同じ画素のタイル (全ページ共通のヘッダーやフッターなど) は1回だけ埋め込む
+    embed_fn は embed_batch と同じ (model_name, contents) を受け取る関数です。
+    """
+    index = TileIndex()
+    stats = {"tiles": 0, "blank": 0, "duplicate": 0, "embedded": 0, "failed": 0}
+    vectors = {}        # タイルのハッシュ → ベクトル (失敗は None)
+    placements = []     # (ハッシュ, ページ番号, 比率の位置, 分割数)
+    pending = {}        # まだ埋め込んでいないタイル (ハッシュ → ペイロード)
+
+    def flush():
+        keys = list(pending)
+        embs = embed_fn(model_name, [pending[key] for key in keys])
+        for key, emb in zip(keys, embs):
+            vectors[key] = emb
+        stats["embedded"] += len(keys)
+        pending.clear()
+
+    for page_num, img_array in rasterize_pages(pdf_path, max_pixels=tile_pixels, grayscale=grayscale,
+                                               tiles=max(grids) ** 2):
+        h, w = img_array.shape[:2]
+        for grid, (x0, y0, x1, y1), tile in iter_tiles(img_array, grids, overlap):
+            stats["tiles"] += 1
+            if tile.std() < BLANK_STD:
+                stats["blank"] += 1
+                continue
+            key = tile_hash(tile)
+            if key in vectors or key in pending:
+                stats["duplicate"] += 1
+            else:
+                # 共有メモリは次のページで解放されるため、ここでエンコードしておく
+                pending[key] = image_payload(tile)
+                if len(pending) >= batch_size:
+                    flush()
+            placements.append((key, page_num, (x0 / w, y0 / h, x1 / w, y1 / h), grid))
+    if pending:
+        flush()
+
+    kept = [p for p in placements if vectors.get(p[0]) is not None]
+    stats["failed"] = len(placements) - len(kept)
+    if kept:
+        index.add([vectors[key] for key, _, _, _ in kept], [p[1] for p in kept],
+                  [p[2] for p in kept], [p[3] for p in kept])
+    return index, stats
+
+
+def print_tile_stats(stats):
+    total = stats["tiles"] or 1
+    print(f"🧱 タイル {stats['tiles']} 枚 (余白 {stats['blank']} 枚 {stats['blank'] / total:.0%}, "
+          f"重複 {stats['duplicate']} 枚 {stats['duplicate'] / total:.0%}) → "
+          f"{stats['embedded']} 枚を埋め込みました。")
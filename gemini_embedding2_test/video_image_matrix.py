@@ -1,11 +1,19 @@
 import os
-import io
 import time
+import asyncio
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import numpy as np
-import base64
-from PIL import Image
 import google.generativeai as genai
 from dotenv import load_dotenv
+from embedding_config import MODEL_NAME, OUTPUT_DIMENSIONALITY
+from embedding_cache import file_payload_key, get_default_cache, print_cache_stats
+from image_payload import image_payload
+from async_embedding_client import embed_concurrently
+from perceptual_dedup import deduplicated, print_dedup_stats
+from video_sampling import embed_video_shots, print_video_stats
+from similarity_engine import similarity_matrix
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -18,94 +26,105 @@ if not api_key:
     exit(1)
 
 genai.configure(api_key=api_key)
-model_name = "models/gemini-embedding-2-preview"
+model_name = MODEL_NAME
 
-def get_image_embedding(image_path):
+MAX_CONCURRENT_UPLOADS = 4    # 同時にアップロードする動画の数
+POLL_INITIAL_SECONDS = 1.0    # ACTIVE になるまでの状態確認の最初の間隔
+POLL_MAX_SECONDS = 8.0        # 状態確認の間隔の上限 (1.5 倍ずつ伸ばす)
+POLL_TIMEOUT_SECONDS = 120.0  # これを過ぎても ACTIVE にならなければフォールバックする
+FALLBACK_WORKERS = 2          # フレーム抽出フォールバックを並行して実行する数
+
+def load_image_payload(image_path):
+    """
+    画像ファイルを読み込み、embed_contentに渡せるJPEG形式に変換します。
+    """
+    return image_payload(image_path)
+
+def get_video_embedding_fallback(video_path):
     """
-    画像からエンベディングを取得します。
+    動画を1回だけ読んでシーンの切れ目を検出し、シーンごとの代表フレームを
+    まとめて埋め込みます。シーンの長さで重み付けした平均ベクトルを返します。
     """
+    print(f"🔄 フォールバック: {video_path} からシーンごとのフレームを抽出中...")
     try:
-        img = Image.open(image_path).convert("RGB")
-        buffered = io.BytesIO()
-        img.save(buffered, format="JPEG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-        content = {"mime_type": "image/jpeg", "data": img_str}
-        
-        result = genai.embed_content(
-            model=model_name,
-            content=content
-        )
-        return np.array(result['embedding'])
+        result = embed_video_shots(video_path, model_name,
+                                   embed_fn=deduplicated(partial(embed_concurrently, api_key=api_key)))
     except Exception as e:
-        print(f"❌ 画像 '{image_path}' の取得エラー: {e}")
+        print(f"❌ フレームの抽出に失敗しました: {video_path} ({e})")
         return None
+    print_video_stats(video_path, result)
+    return result["clip_vector"]
 
-def get_video_embedding_fallback(video_path):
+def _video_cache_key(video_path):
+    mime_type = mimetypes.guess_type(video_path)[0] or "video/mp4"
+    return file_payload_key(model_name, video_path, mime_type, OUTPUT_DIMENSIONALITY)
+
+async def _wait_until_settled(video_file):
     """
-    OpenCVを使用して動画の中央フレームを抽出し、そのエンベディングを取得します。
+    アップロードした動画が ACTIVE か FAILED になるまで、間隔を伸ばしながら状態を確認します。
+    待っている間もイベントループは止まらないので、他の動画の処理が進みます。
     """
-    import cv2
-    print(f"🔄 フォールバック: {video_path} からフレームを抽出中...")
-    cap = cv2.VideoCapture(video_path)
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count // 2) # 中央のフレーム
-    ret, frame = cap.read()
-    cap.release()
-    
-    if not ret:
-        print(f"❌ フレームの抽出に失敗しました: {video_path}")
-        return None
-        
-    # BGRからRGBへ変換
-    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-    img = Image.fromarray(frame_rgb)
-    
-    # 画像としてエンベディング取得
-    buffered = io.BytesIO()
-    img.save(buffered, format="JPEG")
-    img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    content = {"mime_type": "image/jpeg", "data": img_str}
-    
-    result = genai.embed_content(
-        model=model_name,
-        content=content
-    )
-    return np.array(result['embedding'])
+    waited, delay = 0.0, POLL_INITIAL_SECONDS
+    while video_file.state.name not in ("ACTIVE", "FAILED") and waited < POLL_TIMEOUT_SECONDS:
+        await asyncio.sleep(delay)
+        waited += delay
+        delay = min(delay * 1.5, POLL_MAX_SECONDS)
+        video_file = await asyncio.to_thread(genai.get_file, video_file.name)
+    return video_file
+
+async def _embed_video(video_path, upload_slots, fallback_pool):
+    # 動画ファイルの中身でキャッシュを引き、ヒットすればアップロード自体を省略する
+    cache = get_default_cache()
+    key = await asyncio.to_thread(_video_cache_key, video_path)
+    cached = cache.get(key)
+    if cached is not None:
+        print(f"📦 キャッシュから取得: {video_path}")
+        return cached
+
+    loop = asyncio.get_running_loop()
+    try:
+        async with upload_slots:
+            print(f"🎥 動画をアップロード中: {video_path}...")
+            video_file = await asyncio.to_thread(genai.upload_file, path=video_path)
+        video_file = await _wait_until_settled(video_file)
+
+        if video_file.state.name == "ACTIVE":
+            print(f"✅ ACTIVE: {video_path}")
+            kwargs = {"output_dimensionality": OUTPUT_DIMENSIONALITY} if OUTPUT_DIMENSIONALITY else {}
+            result = await asyncio.to_thread(genai.embed_content, model=model_name, content=video_file, **kwargs)
+            emb = np.asarray(result['embedding'], dtype=np.float32)
+            cache.put(key, emb)
+            return emb
+        print(f"⚠️ API直接処理が失敗またはタイムアウトしました: {video_path} (State: {video_file.state.name})")
+    except Exception as e:
+        print(f"⚠️ APIエラー: {video_path}: {e}")
+    # フレーム抽出はワーカープールで行い、他の動画のアップロードや待機は止めない
+    return await loop.run_in_executor(fallback_pool, get_video_embedding_fallback, video_path)
+
+async def _embed_videos(video_paths, max_uploads, fallback_workers):
+    upload_slots = asyncio.Semaphore(max_uploads)
+    with ThreadPoolExecutor(max_workers=fallback_workers) as fallback_pool:
+        return await asyncio.gather(*(_embed_video(path, upload_slots, fallback_pool)
+                                      for path in video_paths))
+
+def get_video_embeddings(video_paths, max_uploads=MAX_CONCURRENT_UPLOADS,
+                         fallback_workers=FALLBACK_WORKERS):
+    """
+    複数の動画を並行してアップロードし、ACTIVE になったものから順にエンベディングを取得します。
+    FAILED やタイムアウトになった動画は、フレーム抽出フォールバックをワーカープールで実行します。
+    入力と同じ順序のリスト (失敗は None) を返します。
+    """
+    start = time.perf_counter()
+    embs = asyncio.run(_embed_videos(video_paths, max_uploads, fallback_workers))
+    print(f"⏱️ 動画 {len(video_paths)} 件を {time.perf_counter() - start:.1f} 秒で処理しました。")
+    return embs
 
 def get_video_embedding(video_path):
     """
     動画をアップロードし、ACTIVEになるのを待ってからエンベディングを取得します。
     失敗した場合はフレーム抽出フォールバックを試みます。
     """
-    try:
-        print(f"🎥 動画をアップロード中: {video_path}...")
-        video_file = genai.upload_file(path=video_path)
-        
-        # ACTIVEになるまでループで確認
-        max_retries = 30
-        for _ in range(max_retries):
-            if video_file.state.name == "ACTIVE":
-                break
-            if video_file.state.name == "FAILED":
-                break
-            print(".", end="", flush=True)
-            time.sleep(2)
-            video_file = genai.get_file(video_file.name)
-            
-        if video_file.state.name == "ACTIVE":
-            print(f" ✅ ACTIVE")
-            result = genai.embed_content(
-                model=model_name,
-                content=video_file
-            )
-            return np.array(result['embedding'])
-        else:
-            print(f" ⚠️ API直接処理が失敗またはタイムアウトしました (State: {video_file.state.name})")
-            return get_video_embedding_fallback(video_path)
-            
-    except Exception as e:
-        print(f" ⚠️ APIエラー: {e}")
-        return get_video_embedding_fallback(video_path)
+    return get_video_embeddings([video_path])[0]
 
 def main():
     # 比較対象のリスト
@@ -114,26 +133,34 @@ def main():
     
     all_items = []
     
-    # 動画の処理
+    # 動画の処理 (アップロードと ACTIVE 待ちを全動画で並行させる)
     print("--- 動画のエンベディング取得開始 ---")
     for f in video_files:
-        if os.path.exists(f):
-            emb = get_video_embedding(f)
-            if emb is not None:
-                all_items.append({"label": f"Video: {f}", "emb": emb})
-        else:
+        if not os.path.exists(f):
             print(f"⚠️ ファイルが見つかりません: {f}")
+    found_videos = [f for f in video_files if os.path.exists(f)]
+    for f, emb in zip(found_videos, get_video_embeddings(found_videos)):
+        if emb is not None:
+            all_items.append({"label": f"Video: {f}", "emb": emb})
 
-    # 画像の処理
+    # 画像の処理 (まとめて1回のバッチで送信)
     print("\n--- 画像のエンベディング取得開始 ---")
+    payloads, loaded_files = [], []
     for f in image_files:
         if os.path.exists(f):
-            emb = get_image_embedding(f)
-            if emb is not None:
-                all_items.append({"label": f"Image: {f}", "emb": emb})
-            print(f"✅ Image: {f} 完了")
+            try:
+                payloads.append(load_image_payload(f))
+                loaded_files.append(f)
+            except Exception as e:
+                print(f"❌ 画像 '{f}' の読み込みエラー: {e}")
         else:
             print(f"⚠️ ファイルが見つかりません: {f}")
+    for f, emb in zip(loaded_files, deduplicated(partial(embed_concurrently, api_key=api_key))(model_name, payloads)):
+        if emb is not None:
+            all_items.append({"label": f"Image: {f}", "emb": emb})
+        print(f"✅ Image: {f} 完了")
+    print_cache_stats()
+    print_dedup_stats()
 
     if len(all_items) < 2:
         print("比較には少なくとも2つ以上の要素が必要です。")
@@ -141,16 +168,9 @@ def main():
 
     # 類似度マトリックスの計算
     num_items = len(all_items)
-    matrix = np.zeros((num_items, num_items))
     labels = [item["label"] for item in all_items]
     embeddings = [item["emb"] for item in all_items]
-    
-    for i in range(num_items):
-        for j in range(num_items):
-            dot = np.dot(embeddings[i], embeddings[j])
-            norm_i = np.linalg.norm(embeddings[i])
-            norm_j = np.linalg.norm(embeddings[j])
-            matrix[i, j] = dot / (norm_i * norm_j)
+    matrix = similarity_matrix(embeddings)
 
     print("\n--- 類似度マトリックスを作成中 ---")
     
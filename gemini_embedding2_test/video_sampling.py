@@ -0,0 +1,136 @@
+import time
+import cv2
+import numpy as np
+from embedding_batch import embed_batch
+from image_payload import image_payload
+
+ANALYSIS_FPS = 4.0          # シーン検出のために1秒あたり何フレームをデコードして比べるか
+ANALYSIS_WIDTH = 96         # 比較用に縮小するフレームの幅
+HIST_BINS = (16, 8)         # HSV の色相・彩度ヒストグラムのビン数
+SHOT_THRESHOLD = 0.35       # 前の比較フレームとのヒストグラム距離 (Bhattacharyya) がこれを超えたらシーンの切れ目
+MIN_SHOT_SECONDS = 0.5      # これより短いシーン (フラッシュなど) は前のシーンにまとめる
+MAX_SHOT_SECONDS = 20.0     # 長回しはこの長さごとに区切って代表フレームを取る
+
+
+class Shot:
+    """
+    1つのシーン。代表フレームは、直前の比較フレームとの差が最も小さい (ブレの少ない) フレームです。
+    シーンが終わった時点で代表フレームを JPEG/WebP にエンコードし、画素は手放します。
+    """
+
+    def __init__(self, start):
+        self.start = start          # 開始時刻 (秒)
+        self.end = start
+        self.frame = None           # 代表フレーム (RGB)。シーンが終わるまでの間だけ保持する
+        self.payload = None         # エンコード済みの代表フレーム (finalize 後)
+        self.frame_time = start
+        self.stability = np.inf     # 代表フレームの直前フレームとの差
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def finalize(self):
+        if self.frame is not None:
+            self.payload = image_payload(self.frame)
+            self.frame = None
+
+
+def _histogram(frame_bgr):
+    h, w = frame_bgr.shape[:2]
+    small = cv2.resize(frame_bgr, (ANALYSIS_WIDTH, max(1, h * ANALYSIS_WIDTH // w)),
+                       interpolation=cv2.INTER_AREA)
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([hsv], [0, 1], None, list(HIST_BINS), [0, 180, 0, 256])
+    return cv2.normalize(hist, hist).ravel()
+
+
+def detect_shots(video_path, analysis_fps=ANALYSIS_FPS, threshold=SHOT_THRESHOLD,
+                 min_shot=MIN_SHOT_SECONDS, max_shot=MAX_SHOT_SECONDS):
+    """
+    動画を先頭から1回だけ読み、シーンのリストと動画の長さ (秒) を返します。
+
+    CAP_PROP_POS_FRAMES によるシークは直前のキーフレームからのデコードになるため使わず、
+    全フレームを cap.grab() で進めながら、analysis_fps ごとのフレームだけを retrieve() して
+    縮小フレームの色ヒストグラムを比べます。フルサイズのフレームは進行中のシーンの
+    代表1枚だけを保持し、終わったシーンはエンコード済みのペイロードにするので、
+    メモリ使用量は動画の長さにほとんど依存しません。
+    """
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise FileNotFoundError(f"動画が開けません: {video_path}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    # フレーム数のメタデータは不正確なことがあるので、実際に読めたフレームで長さを決める
+    stride = max(1, int(round(fps / analysis_fps)))
+
+    shots, shot, prev_hist = [], None, None
+    index = 0
+    while cap.grab():
+        t = index / fps
+        index += 1
+        if (index - 1) % stride:
+            continue
+        ok, frame = cap.retrieve()
+        if not ok:
+            continue
+        hist = _histogram(frame)
+        diff = 0.0 if prev_hist is None else cv2.compareHist(prev_hist, hist, cv2.HISTCMP_BHATTACHARYYA)
+        prev_hist = hist
+        if shot is None or (diff > threshold and t - shot.start >= min_shot) or t - shot.start >= max_shot:
+            if shot is not None:
+                shot.finalize()
+            shot = Shot(t)
+            shots.append(shot)
+            diff = np.inf       # 切れ目のフレームは遷移中のことが多いので、代表には他を優先する
+        shot.end = t + stride / fps
+        if diff < shot.stability or shot.frame is None:
+            shot.frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            shot.frame_time = t
+            shot.stability = diff
+    cap.release()
+    duration = index / fps
+    if shots:
+        shots[-1].end = duration
+        shots[-1].finalize()
+    return shots, duration
+
+
+def embed_video_shots(video_path, model_name, embed_fn=embed_batch, **detect_kwargs):
+    """
+    シーンごとの代表フレームを1回のバッチで埋め込み、結果の辞書を返します。
+
+    - shots        : (開始秒, 終了秒, 代表フレームの時刻) のリスト (埋め込みに失敗したシーンは除く)
+    - shot_vectors : シーンごとのベクトル (シーン数, 次元)
+    - clip_vector  : シーンの長さで重み付けして平均し、正規化した動画全体のベクトル
+    - video_seconds_per_second : 1秒あたりに処理できた動画の秒数
+    embed_fn は embed_batch と同じ (model_name, contents) を受け取る関数です。
+    """
+    start = time.perf_counter()
+    shots, duration = detect_shots(video_path, **detect_kwargs)
+    detect_seconds = time.perf_counter() - start
+    embs = embed_fn(model_name, [shot.payload for shot in shots]) if shots else []
+
+    kept = [(shot, emb) for shot, emb in zip(shots, embs) if emb is not None]
+    shot_vectors = np.array([emb for _, emb in kept], dtype=np.float32)
+    clip_vector = None
+    if kept:
+        weights = np.array([max(shot.duration, 1e-3) for shot, _ in kept], dtype=np.float32)
+        normed = shot_vectors / np.linalg.norm(shot_vectors, axis=1, keepdims=True)
+        clip_vector = (weights[:, None] * normed).sum(axis=0)
+        clip_vector /= np.linalg.norm(clip_vector) or 1.0
+    wall = time.perf_counter() - start
+    return {
+        "shots": [(shot.start, shot.end, shot.frame_time) for shot, _ in kept],
+        "shot_vectors": shot_vectors,
+        "clip_vector": clip_vector,
+        "duration": duration,
+        "detect_seconds": detect_seconds,
+        "wall_seconds": wall,
+        "video_seconds_per_second": duration / wall if wall else 0.0,
+    }
+
+
+def print_video_stats(video_path, result):
+    print(f"🎞️ {video_path}: {result['duration']:.1f} 秒の動画から {len(result['shots'])} シーンを検出 "
+          f"(シーン検出 {result['detect_seconds']:.2f} 秒, 全体 {result['wall_seconds']:.2f} 秒, "
+          f"{result['video_seconds_per_second']:.1f} 動画秒/秒)")